@@ -0,0 +1,265 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Iterable
+
+from sqlalchemy.exc import DBAPIError
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+import settings
+from metrics import registry
+
+logger = logging.getLogger('admission')
+
+#  SQLSTATE query_canceled: statement_timeout, выставленный по дедлайну запроса
+QUERY_CANCELED = '57014'
+
+rejected_total = registry.counter('admission_rejected_total', 'Requests rejected before running by route and reason',
+                                  ('route', 'reason'))
+queue_wait = registry.histogram('admission_queue_wait_seconds', 'Time admitted requests spent waiting for a slot',
+                                ('route',), buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+cancelled_total = registry.counter('requests_cancelled_total', 'Requests cancelled while running by route and reason',
+                                   ('route', 'reason'))
+
+_deadline: ContextVar[float | None] = ContextVar('request_deadline', default=None)
+
+
+def deadline_remaining() -> float | None:
+    """Секунд до дедлайна текущего запроса, None вне запроса (фоновые задачи)"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class DeadlineExceeded(Exception):
+    """Дедлайн запроса истек до начала транзакции, в базу запрос уже не отправляется"""
+
+
+class Overloaded(Exception):
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RouteLimit:
+    __slots__ = ('concurrency', 'deadline')
+
+    def __init__(self, concurrency: int, deadline: float):
+        self.concurrency = concurrency
+        self.deadline = deadline
+
+    @classmethod
+    def parse_many(cls, value: str | None) -> dict[str, 'RouteLimit']:
+        """Формат "<префикс>:<параллельных запросов>:<дедлайн в секундах>" через запятую"""
+        limits = {}
+        for item in filter(None, (value or '').split(',')):
+            prefix, concurrency, deadline = item.strip().split(':')
+            limits[prefix] = cls(int(concurrency), float(deadline))
+        return limits
+
+
+class ConcurrencyLimiter:
+    """Ограничение одновременных запросов маршрута с очередью, ограниченной по длине и времени ожидания.
+
+    Если очередь не пустеет дольше standing_after, она стоячая: воркер не успевает за входящим потоком,
+    и новые запросы отклоняются сразу, а не ждут queue_timeout, чтобы все равно получить отказ.
+    """
+
+    def __init__(self, concurrency: int, max_queue: int, queue_timeout: float, standing_after: float):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.standing_after = standing_after
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._queued_since: float | None = None
+
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> None:
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return
+        now = time.monotonic()
+        if len(self._waiters) >= self.max_queue:
+            raise Overloaded('queue_full')
+        if self._queued_since is not None and now - self._queued_since > self.standing_after:
+            raise Overloaded('standing_queue')
+        waiter = asyncio.get_running_loop().create_future()
+        if not self._waiters:
+            self._queued_since = now
+        self._waiters.append(waiter)
+        try:
+            async with asyncio.timeout(self.queue_timeout):
+                await waiter
+        except (TimeoutError, asyncio.CancelledError) as error:
+            if waiter.done() and not waiter.cancelled():
+                #  слот уже передан этому запросу одновременно с отменой
+                if isinstance(error, TimeoutError):
+                    return
+                self.release()
+                raise
+            self._forget(waiter)
+            if isinstance(error, TimeoutError):
+                raise Overloaded('queue_timeout')
+            raise
+
+    def _forget(self, waiter: asyncio.Future) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        if not self._waiters:
+            self._queued_since = None
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                #  слот переходит первому ожидающему, active не меняется
+                waiter.set_result(None)
+                self._queued_since = time.monotonic() if self._waiters else None
+                return
+        self._queued_since = None
+        self.active -= 1
+
+
+def _is_deadline_error(error: BaseException) -> bool:
+    return isinstance(error, DeadlineExceeded) or \
+        isinstance(error, DBAPIError) and getattr(error.orig, 'sqlstate', None) == QUERY_CANCELED
+
+
+async def _send_error(send: Send, status_code: int, detail: str, headers: Iterable[tuple[bytes, bytes]] = ()) -> None:
+    body = json.dumps({'detail': detail}).encode()
+    await send({'type': 'http.response.start', 'status': status_code,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                            *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class AdmissionMiddleware:
+    """Контроль допуска по префиксам маршрутов, дедлайны запросов и отмена работы при отключении клиента.
+
+    Запрос занимает слот своего префикса и слот общего лимита воркера, равного по умолчанию пулу соединений.
+    Лишние запросы получают 503 с Retry-After до обращения к базе. Дедлайн доступен через
+    deadline_remaining и передается в Postgres как statement_timeout каждой транзакции.
+    Потоковые ответы (SSE) и служебные маршруты не ограничиваются.
+    """
+
+    def __init__(self, app: ASGIApp, prefixes: Iterable[str] = (), limits: dict[str, RouteLimit] | None = None,
+                 exempt: Iterable[str] = ()):
+        self.app = app
+        limits = limits or {}
+        default = RouteLimit(settings.ADMISSION_CONCURRENCY, settings.REQUEST_DEADLINE)
+        self.prefixes = {prefix: prefix for prefix in prefixes}
+        self.limits = {prefix: limits.get(prefix, default) for prefix in (*self.prefixes, 'other')}
+        self.limiters = {prefix: self._limiter(limit.concurrency) for prefix, limit in self.limits.items()}
+        self.shared = self._limiter(settings.ADMISSION_TOTAL_CONCURRENCY)
+        self.exempt = frozenset(exempt)
+        self.retry_after = str(math.ceil(settings.ADMISSION_RETRY_AFTER)).encode()
+        registry.gauge_callback('admission_queued', 'Requests waiting for a slot by route',
+                                lambda: {(prefix,): limiter.queued() for prefix, limiter in self.limiters.items()},
+                                ('route',))
+        registry.gauge_callback('admission_shared_queued', 'Requests waiting for a slot of the worker-wide limit',
+                                self.shared.queued)
+
+    @staticmethod
+    def _limiter(concurrency: int) -> ConcurrencyLimiter:
+        return ConcurrencyLimiter(concurrency, max_queue=settings.ADMISSION_QUEUE_SIZE,
+                                  queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT,
+                                  standing_after=settings.ADMISSION_STANDING_QUEUE)
+
+    async def _acquire(self, limiter: ConcurrencyLimiter) -> None:
+        await limiter.acquire()
+        try:
+            await self.shared.acquire()
+        except BaseException:
+            limiter.release()
+            raise
+
+    def route_label(self, path: str) -> str:
+        end = path.find('/', 1)
+        return self.prefixes.get(path if end == -1 else path[:end], 'other')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        path = scope.get('path', '')
+        if scope['type'] != 'http' or path in self.exempt or path.endswith('/events'):
+            await self.app(scope, receive, send)
+            return
+
+        route = self.route_label(path)
+        limiter = self.limiters[route]
+        started = time.monotonic()
+        try:
+            await self._acquire(limiter)
+        except Overloaded as overloaded:
+            rejected_total.labels(route, overloaded.reason).inc()
+            await _send_error(send, 503, 'Service overloaded, retry later', [(b'retry-after', self.retry_after)])
+            return
+        queue_wait.labels(route).observe(time.monotonic() - started)
+        token = _deadline.set(started + self.limits[route].deadline)
+        try:
+            await self._run(scope, receive, send, route)
+        finally:
+            _deadline.reset(token)
+            self.shared.release()
+            limiter.release()
+
+    async def _run(self, scope: Scope, receive: Receive, send: Send, route: str) -> None:
+        messages = asyncio.Queue()
+        disconnected = asyncio.Event()
+        response_started = False
+        response_complete = False
+
+        async def read_messages() -> None:
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message['type'] == 'http.disconnect':
+                    disconnected.set()
+                    return
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started, response_complete
+            if message['type'] == 'http.response.start':
+                response_started = True
+            elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete = True
+            await send(message)
+
+        reader = asyncio.create_task(read_messages())
+        handler = asyncio.create_task(self.app(scope, messages.get, send_wrapper))
+        waiter = asyncio.create_task(disconnected.wait())
+        try:
+            done, _ = await asyncio.wait({handler, waiter}, timeout=max(deadline_remaining(), 0),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if handler in done:
+                error = handler.exception()
+                if error is None:
+                    return
+                if not _is_deadline_error(error) or response_started:
+                    raise error
+                cancelled_total.labels(route, 'deadline').inc()
+            elif response_complete:
+                #  ответ уже отправлен, обработчик завершает уборку после него
+                await handler
+                return
+            else:
+                handler.cancel()
+                await asyncio.gather(handler, return_exceptions=True)
+                if waiter in done:
+                    #  клиенту ответ уже не нужен, запросы в базу отменены вместе с обработчиком
+                    cancelled_total.labels(route, 'disconnect').inc()
+                    return
+                cancelled_total.labels(route, 'deadline').inc()
+                if response_started:
+                    return
+            await _send_error(send, 504, 'Request deadline exceeded')
+        finally:
+            for task in (reader, waiter, handler):
+                task.cancel()
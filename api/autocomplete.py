@@ -0,0 +1,294 @@
+"""Подсказки по началу имени пользователя, названия блога и заголовка поста.
+
+Каждая сущность - отсортированный по casefold массив: тексты подряд, смещения и id в параллельных
+массивах, поиск бинарный. Массивы пишутся версией в AUTOCOMPLETE_INDEX_DIR и открываются через mmap,
+поэтому воркеры хоста делят одну копию в page cache. Версию собирает из базы один воркер хоста, взявший
+файловую блокировку, и только когда текущая старше AUTOCOMPLETE_REBUILD_INTERVAL; остальные подхватывают
+ее раз в AUTOCOMPLETE_RELOAD_INTERVAL. Записи этого воркера (через менеджеры) и посты других воркеров
+(из событий post_events) ложатся поверх версии до следующей; имена пользователей и названия блогов,
+измененные другими воркерами, видны после пересборки.
+"""
+import asyncio
+import fcntl
+import heapq
+import itertools
+import json
+import logging
+import mmap
+import os
+import shutil
+import time
+from array import array
+from bisect import bisect_left, insort
+from typing import Iterable, Iterator
+from uuid import UUID
+
+from sqlalchemy import select, and_
+from starlette import status
+from starlette.exceptions import HTTPException
+
+import settings
+from api.models import User, Blog, Post, HIDDEN_BLOG_IDS
+from database import async_session, shard_sessionmakers
+from events import post_events
+from metrics import registry
+
+logger = logging.getLogger('autocomplete')
+
+USERS = 'users'
+BLOGS = 'blogs'
+POSTS = 'posts'
+CURRENT = 'CURRENT'
+KEEP_VERSIONS = 2
+
+
+def normalize(text: str) -> str:
+    return text.casefold()
+
+
+class PrefixArray:
+    """Неизменяемая версия сущности: около len(text) + 20 байт на запись вместо сотни у списка строк и UUID"""
+
+    def __init__(self, texts: bytes | mmap.mmap, offsets: memoryview, ids: bytes | mmap.mmap):
+        self._texts = texts
+        self._offsets = offsets
+        self._ids = ids
+
+    @classmethod
+    def build(cls, entries: Iterable[tuple[UUID, str]]) -> 'PrefixArray':
+        rows = sorted((normalize(text), text, entity_id) for entity_id, text in entries)
+        texts = bytearray()
+        offsets = array('Q', [0])
+        ids = bytearray()
+        for _, text, entity_id in rows:
+            texts += text.encode()
+            offsets.append(len(texts))
+            ids += entity_id.bytes
+        if len(texts) < 1 << 32:
+            offsets = array('I', offsets)
+        return cls(bytes(texts), memoryview(offsets), bytes(ids))
+
+    @classmethod
+    def open(cls, path: str, kind: str, typecode: str) -> 'PrefixArray':
+        def load(suffix: str) -> bytes | mmap.mmap:
+            with open(os.path.join(path, f'{kind}.{suffix}'), 'rb') as file:
+                #  пустой файл не отобразить в память
+                if not os.fstat(file.fileno()).st_size:
+                    return b''
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return cls(load('texts'), memoryview(load('offsets')).cast(typecode), load('ids'))
+
+    def write(self, path: str, kind: str) -> str:
+        """Пишет массивы сущности в каталог версии, возвращает тип смещений для open"""
+        for suffix, data in (('texts', self._texts), ('offsets', self._offsets), ('ids', self._ids)):
+            with open(os.path.join(path, f'{kind}.{suffix}'), 'wb') as file:
+                file.write(data)
+        return self._offsets.format
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def nbytes(self) -> int:
+        return len(self._texts) + self._offsets.nbytes + len(self._ids)
+
+    def _text(self, position: int) -> str:
+        return self._texts[self._offsets[position]:self._offsets[position + 1]].decode()
+
+    def _lower_bound(self, key: str) -> int:
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if normalize(self._text(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def rows(self, key: str) -> Iterator[tuple[str, str, UUID]]:
+        """Записи, начинающиеся с key, в порядке массива"""
+        for position in range(self._lower_bound(key), len(self)):
+            text = self._text(position)
+            found = normalize(text)
+            if not found.startswith(key):
+                return
+            yield found, text, UUID(bytes=self._ids[16 * position:16 * position + 16])
+
+
+class PrefixIndex:
+    """Сборка и изменения после нее: измененные и удаленные id скрывают свои записи в сборке"""
+
+    def __init__(self):
+        self.built = False
+        self._array = PrefixArray.build(())
+        self._changes: dict[UUID, tuple[float, str | None]] = {}
+        self._added: list[tuple[str, str, UUID]] = []
+
+    def entries_count(self) -> int:
+        return len(self._array) + len(self._added)
+
+    def nbytes(self) -> int:
+        return self._array.nbytes()
+
+    def _forget(self, entity_id: UUID) -> None:
+        if entity_id in self._changes:
+            self._added = [row for row in self._added if row[2] != entity_id]
+
+    def put(self, entity_id: UUID, text: str) -> None:
+        self._forget(entity_id)
+        self._changes[entity_id] = (time.time(), text)
+        insort(self._added, (normalize(text), text, entity_id))
+
+    def remove(self, entity_id: UUID) -> None:
+        self._forget(entity_id)
+        self._changes[entity_id] = (time.time(), None)
+
+    def replace(self, prefix_array: PrefixArray, started: float) -> None:
+        """Новая сборка; изменения, записанные после начала ее чтения, остаются поверх"""
+        self._changes = {entity_id: change for entity_id, change in self._changes.items() if change[0] > started}
+        self._added = sorted((normalize(text), text, entity_id) for entity_id, (_, text) in self._changes.items()
+                             if text is not None)
+        self._array = prefix_array
+        self.built = True
+
+    def search(self, prefix: str, limit: int) -> list[tuple[UUID, str]]:
+        key = normalize(prefix)
+        changes = self._changes
+        built = (row for row in self._array.rows(key) if row[2] not in changes)
+        added = itertools.takewhile(lambda row: row[0].startswith(key),
+                                    itertools.islice(self._added, bisect_left(self._added, (key,)), None))
+        rows = itertools.islice(heapq.merge(built, added), limit)
+        return [(entity_id, text) for _, text, entity_id in rows]
+
+
+def suggest(index: PrefixIndex, prefix: str, limit: int) -> list[dict]:
+    if not index.built:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Autocomplete is not ready yet')
+    return [{'id': entity_id, 'text': text} for entity_id, text in index.search(prefix, limit)]
+
+
+async def _read(sessionmakers, statement) -> list[tuple[UUID, str]]:
+    entries = []
+    for sessionmaker in sessionmakers:
+        async with sessionmaker() as session:
+            result = await session.stream(statement.execution_options(yield_per=settings.AUTOCOMPLETE_BUILD_BATCH))
+            async for entity_id, text in result:
+                entries.append((entity_id, text))
+    return entries
+
+
+class Autocomplete:
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.version: str | None = None
+        self.users = PrefixIndex()
+        self.blogs = PrefixIndex()
+        self.posts = PrefixIndex()
+
+    def indexes(self) -> dict[str, PrefixIndex]:
+        return {USERS: self.users, BLOGS: self.blogs, POSTS: self.posts}
+
+    def _sources(self) -> dict[str, tuple]:
+        #  пользователи глобальные, блоги и посты собираются со всех шардов
+        return {
+            USERS: ((async_session,), select(User.id, User.name).where(User.is_active == True)),
+            BLOGS: (shard_sessionmakers.values(), select(Blog.id, Blog.title).where(Blog.is_deleted == False)),
+            POSTS: (shard_sessionmakers.values(),
+                    select(Post.id, Post.title).where(and_(Post.is_published == True, Post.is_deleted == False,
+                                                           Post.blog_id.not_in(HIDDEN_BLOG_IDS)))),
+        }
+
+    def _current(self) -> tuple[str, dict] | None:
+        try:
+            with open(os.path.join(self.directory, CURRENT)) as file:
+                name = file.read().strip()
+            with open(os.path.join(self.directory, name, 'meta.json')) as file:
+                return name, json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def reload(self) -> bool:
+        """Переходит на текущую версию из каталога, если она сменилась"""
+        current = self._current()
+        if current is None or current[0] == self.version:
+            return False
+        name, meta = current
+        path = os.path.join(self.directory, name)
+        for kind, index in self.indexes().items():
+            index.replace(PrefixArray.open(path, kind, meta['offsets'][kind]), meta['built_at'])
+        self.version = name
+        logger.info('Autocomplete index %s loaded', name)
+        return True
+
+    async def build(self, max_age: float) -> str | None:
+        """Собирает версию, если текущая старше max_age и ее не собирает другой воркер хоста"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'build.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            current = self._current()
+            if current is not None and time.time() - current[1]['built_at'] < max_age:
+                return None
+            return await self._write()
+
+    async def _write(self) -> str:
+        #  изменения после этого момента воркеры оставят поверх версии
+        started = time.time()
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+        offsets = {}
+        for kind, (sessionmakers, statement) in self._sources().items():
+            entries = await _read(sessionmakers, statement)
+            #  сортировка миллионов строк в потоке, чтобы не держать цикл событий
+            prefix_array = await asyncio.to_thread(PrefixArray.build, entries)
+            del entries
+            offsets[kind] = await asyncio.to_thread(prefix_array.write, path, kind)
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump({'built_at': started, 'offsets': offsets}, file)
+
+        current = os.path.join(self.directory, CURRENT)
+        with open(f'{current}.tmp', 'w') as file:
+            file.write(name)
+        os.replace(f'{current}.tmp', current)
+        versions = sorted(entry for entry in os.listdir(self.directory)
+                          if os.path.isdir(os.path.join(self.directory, entry)))
+        for old in versions[:-KEEP_VERSIONS]:
+            shutil.rmtree(os.path.join(self.directory, old), ignore_errors=True)
+        logger.info('Autocomplete index %s built in %.1fs', name, time.time() - started)
+        return name
+
+    def post_changed(self, event: dict) -> None:
+        if event.get('event') not in ('created', 'updated'):
+            return
+        data = event.get('data', {})
+        if data.get('is_published') is False:
+            self.posts.remove(UUID(event['post_id']))
+        elif data.get('is_published') and data.get('title'):
+            self.posts.put(UUID(event['post_id']), data['title'])
+
+    async def run(self, rebuild_interval: float, reload_interval: float) -> None:
+        while True:
+            try:
+                await self.build(rebuild_interval)
+                self.reload()
+            except Exception:
+                logger.exception('Autocomplete index refresh failed')
+            await asyncio.sleep(reload_interval)
+
+
+autocomplete = Autocomplete(settings.AUTOCOMPLETE_INDEX_DIR)
+registry.gauge_callback('autocomplete_index_entries', 'Entries in the autocomplete index by entity',
+                        lambda: {(kind,): index.entries_count() for kind, index in autocomplete.indexes().items()},
+                        ('entity',), aggregate='max')
+registry.gauge_callback('autocomplete_index_bytes', 'Size of the mapped autocomplete arrays by entity',
+                        lambda: {(kind,): index.nbytes() for kind, index in autocomplete.indexes().items()},
+                        ('entity',), aggregate='max')
+
+
+async def maintain_autocomplete_index() -> None:
+    post_events.add_listener(autocomplete.post_changed)
+    await autocomplete.run(settings.AUTOCOMPLETE_REBUILD_INTERVAL, settings.AUTOCOMPLETE_RELOAD_INTERVAL)
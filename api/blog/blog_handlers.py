@@ -1,38 +1,101 @@
+import datetime
 import uuid
 from typing import Annotated
 from uuid import UUID
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from fastapi_filter import FilterDepends
-from fastapi_pagination.links import Page
 from starlette import status
 from starlette.authentication import requires
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
+from starlette.responses import Response
 
+import settings
+from api.autocomplete import autocomplete, suggest
 from api.filters import BlogFilter
-from api.managers import BlogManager
+from api.managers import BlogManager, StatsManager, AnalyticsManager
+from api.pagination import Page
 from api.permissions import Permissions
-from api.schemas import BlogResponse, BlogCreate, AddOrRemoveAuthorToBlog, BlogResponseDetail, BlogUpdate
+from api.schemas import BlogResponse, BlogCreate, AddOrRemoveAuthorToBlog, BlogResponseDetail, BlogUpdate, \
+    BlogStatsResponse, AnalyticsPeriod, BlogAnalyticsResponse, AutocompleteResponse
+from database import unit_of_work
+from singleflight import SingleFlight
 
 blog_router = APIRouter()
+blog_flights = SingleFlight('blog')
 
 
 @blog_router.get("/all", response_model=Page[BlogResponseDetail])
 async def get_all_blogs(manager: Annotated[BlogManager, Depends()],
                         blog_filter: Annotated[BlogFilter, FilterDepends(BlogFilter)],
                         author: Annotated[str, None] = None,
-                        order_by: Annotated[str, None] = None):
-    blogs = await manager.get_all_blogs(author, order_by, blog_filter)
+                        order_by: Annotated[str, None] = None,
+                        cursor: Annotated[str, None] = None):
+    blogs = await manager.get_all_blogs(author, order_by, blog_filter, cursor)
     return blogs
 
 
+@blog_router.get("/autocomplete", response_model=list[AutocompleteResponse])
+async def autocomplete_blogs(prefix: Annotated[str, Query(min_length=1)],
+                             limit: Annotated[int, Query(ge=1, le=settings.AUTOCOMPLETE_MAX_LIMIT)] = 10):
+    return suggest(autocomplete.blogs, prefix, limit)
+
+
+async def _load_blog(blog_id: UUID) -> str | None:
+    async with unit_of_work(read_only=True) as session:
+        blog = await BlogManager(session).get_blog(blog_id)
+        if blog is None:
+            return None
+        return BlogResponseDetail.model_validate(blog).model_dump_json()
+
+
 @blog_router.get("/{blog_id}", response_model=BlogResponseDetail)
-async def get_blog(blog_id: uuid.UUID, manager: Annotated[BlogManager, Depends()]):
-    blog = await manager.get_blog(blog_id)
-    if blog is None:
+async def get_blog(blog_id: uuid.UUID):
+    body = await blog_flights.do(blog_id, lambda: _load_blog(blog_id))
+    if body is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Blog does not found')
-    return blog
+    return Response(body, media_type='application/json')
+
+
+@blog_router.get("/{blog_id}/stats", response_model=BlogStatsResponse)
+async def get_blog_stats(blog_id: UUID, manager: Annotated[StatsManager, Depends()]):
+    stats = await manager.get_blog_stats(blog_id)
+    if stats is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Blog does not found')
+    return stats
+
+
+def _local(value: datetime.datetime | None) -> datetime.datetime | None:
+    #  интервалы хранятся в локальном времени без зоны, как created_at
+    return value.astimezone().replace(tzinfo=None) if value is not None and value.tzinfo else value
+
+
+@blog_router.get("/{blog_id}/analytics", response_model=BlogAnalyticsResponse)
+@requires(['authenticated'])
+async def get_blog_analytics(blog_id: UUID, request: Request,
+                             manager: Annotated[AnalyticsManager, Depends()],
+                             permission: Annotated[Permissions, Depends()],
+                             period: AnalyticsPeriod = AnalyticsPeriod.day,
+                             start: datetime.datetime | None = None,
+                             end: datetime.datetime | None = None,
+                             post_id: UUID | None = None):
+    await permission.blog_permission(blog_id, request.user.id)
+    end = _local(end) or datetime.datetime.now()
+    start = _local(start) or end - datetime.timedelta(days=settings.ANALYTICS_DEFAULT_DAYS)
+    #  границы выравниваются по хранимым интервалам: часу для period=hour, суткам для остальных
+    start = start.replace(minute=0, second=0, microsecond=0)
+    if period != AnalyticsPeriod.hour:
+        start = start.replace(hour=0)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='start must be earlier than end')
+    if period == AnalyticsPeriod.hour and end - start > datetime.timedelta(days=settings.ANALYTICS_MAX_HOURLY_DAYS):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Hourly analytics is limited to {settings.ANALYTICS_MAX_HOURLY_DAYS} days')
+    rows = await manager.get_blog_engagement(blog_id, period.value, start, end, post_id)
+    total = {name: sum(getattr(row, name) for row in rows) for name in ('views', 'likes', 'comments')}
+    return {'blog_id': blog_id, 'post_id': post_id, 'period': period, 'start': start, 'end': end,
+            'total': total, 'buckets': rows}
 
 
 @blog_router.post("/", response_model=BlogResponse)
@@ -47,8 +110,10 @@ async def update_blog(body: BlogUpdate, blog_id: UUID, request: Request,
                       manager: Annotated[Permissions, Depends()]):
     if body.is_empty():
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Set the required fields')
-    await manager.blog_permission(blog_id=blog_id, user_id=request.user.id)
-    return await manager.blog_manager.update_blog(blog_id, body.clear())
+    blog = await manager.blog_manager.update_blog(blog_id, body.clear(), owner_id=request.user.id)
+    if blog is None:
+        await manager.blog_write_denied(blog_id)
+    return blog
 
 
 @blog_router.post("/{blog_id}/add_author", response_model=BlogResponseDetail)
@@ -73,6 +138,7 @@ async def remove_author_from_blog(body: AddOrRemoveAuthorToBlog, request: Reques
 @requires(['authenticated'])
 async def delete_blog(blog_id: UUID, request: Request,
                       manager: Annotated[Permissions, Depends()]):
-    await manager.blog_permission(blog_id, request.user.id)
-    deleted_blog_id = await manager.blog_manager.delete_blog(blog_id)
-    return {'blog_id': deleted_blog_id}
+    job = await manager.blog_manager.delete_blog(blog_id, owner_id=request.user.id)
+    if job is None:
+        await manager.blog_write_denied(blog_id)
+    return {'blog_id': blog_id, 'job_id': job.id}
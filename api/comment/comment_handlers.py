@@ -8,6 +8,7 @@ from starlette.requests import Request
 
 from api.managers import CommentManager
 from api.schemas import CommentResponse, CommentCreate, CommentUpdate, CommentResponseDetail
+from ratelimit import create_comment_limit
 
 comment_router = APIRouter()
 
@@ -19,7 +20,7 @@ async def get_comments_from_post(post_id: UUID,
     return comments
 
 
-@comment_router.post('/', response_model=CommentResponse)
+@comment_router.post('/', response_model=CommentResponse, dependencies=[Depends(create_comment_limit)])
 @requires(['authenticated'])
 async def create_comment(body: CommentCreate, request: Request,
                          manager: Annotated[CommentManager, Depends()]):
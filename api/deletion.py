@@ -0,0 +1,168 @@
+import asyncio
+import contextvars
+import logging
+from uuid import UUID
+
+from sqlalchemy import text
+
+import settings
+from database import SHARDED, async_session, shard_sessionmakers
+from metrics import registry
+from sharding import locate
+
+logger = logging.getLogger('deletion')
+
+
+def _batched(table: str, condition: str) -> str:
+    #  строки из подзапроса с LIMIT: за транзакцию удаляется не больше batch строк.
+    #  ctid уникален только внутри секции, у секционированных таблиц строку задает пара tableoid, ctid
+    return (f'DELETE FROM {table} USING (SELECT {table}.tableoid, {table}.ctid FROM {table} {condition} '
+            f'LIMIT :batch) batch WHERE {table}.tableoid = batch.tableoid AND {table}.ctid = batch.ctid')
+
+
+_BLOG_POSTS = 'JOIN posts ON posts.id = {table}.post_id WHERE posts.blog_id = :entity_id'
+
+#  зависимые строки удаляются партиями, сама сущность - последней, каскад к этому моменту уже пуст
+PHASES = {
+    'blog': (
+        text(_batched('post_engagement', 'WHERE post_engagement.blog_id = :entity_id')),
+        text(_batched('comments', _BLOG_POSTS.format(table='comments'))),
+        text(_batched('likes', _BLOG_POSTS.format(table='likes'))),
+        text(_batched('posts', 'WHERE posts.blog_id = :entity_id')),
+        text('DELETE FROM blogs WHERE id = :entity_id'),
+    ),
+    'post': (
+        text(_batched('post_engagement', 'WHERE post_engagement.post_id = :entity_id')),
+        text(_batched('comments', 'WHERE comments.post_id = :entity_id')),
+        text(_batched('likes', 'WHERE likes.post_id = :entity_id')),
+        text('DELETE FROM posts WHERE id = :entity_id'),
+    ),
+}
+
+#  названия в глобальной базе (см. sharding.claim_title) освобождаются, когда строк на шарде уже нет
+RELEASE_TITLES = {
+    'blog': text(_batched('titles', 'WHERE titles.blog_id = :entity_id')),
+    'post': text(_batched('titles', "WHERE titles.kind = 'posts' AND titles.entity_id = :entity_id")),
+}
+
+_CLAIM = text('''
+UPDATE deletion_jobs SET status = 'running', updated_at = now()
+WHERE id = :job_id AND (status = 'pending' OR status = 'running' AND updated_at < now() - make_interval(secs => :stale))
+RETURNING entity, entity_id
+''')
+_PROGRESS = text('UPDATE deletion_jobs SET deleted_rows = deleted_rows + :rows, updated_at = now() WHERE id = :job_id')
+_FINISH = text('UPDATE deletion_jobs SET status = :status, error = :error, updated_at = now() WHERE id = :job_id')
+_STALE = text('''
+SELECT id FROM deletion_jobs
+WHERE status IN ('pending', 'running') AND updated_at < now() - make_interval(secs => :stale)
+''')
+
+
+class DeletionJobs:
+    """Удаление больших блогов и постов короткими транзакциями вне запроса.
+
+    Состояние хранится в deletion_jobs, поэтому прогресс виден из любого воркера, а задачи
+    остановленного воркера подхватываются другими, когда перестают обновляться.
+    """
+
+    def __init__(self, concurrency: int, batch_size: int, pause: float, stale_after: float):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stale_after = stale_after
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: dict[UUID, asyncio.Task] = {}
+        self.running = 0
+
+    def start(self, job_id: UUID) -> None:
+        if job_id in self._tasks:
+            return
+        #  пустой контекст: задача не должна наследовать дедлайн запроса, который ее запустил
+        task = asyncio.get_running_loop().create_task(self._run(job_id), name=f'deletion-{job_id}',
+                                                      context=contextvars.Context())
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _execute(self, shard: str, statement, params: dict):
+        async with shard_sessionmakers[shard]() as session:
+            async with session.begin():
+                return await session.execute(statement, params)
+
+    async def _run(self, job_id: UUID) -> None:
+        async with self._semaphore:
+            #  задача лежит на шарде блога, который она удаляет
+            shard = await locate('deletion_jobs', job_id)
+            if shard is None:
+                return
+            claimed = (await self._execute(shard, _CLAIM, {'job_id': job_id, 'stale': self.stale_after})).first()
+            if claimed is None:
+                return
+            self.running += 1
+            try:
+                await self._delete(shard, job_id, claimed.entity, claimed.entity_id)
+            except asyncio.CancelledError:
+                #  задача останется в running и будет подхвачена после stale_after
+                raise
+            except Exception as error:
+                logger.exception('Deletion job %s failed', job_id)
+                await self._execute(shard, _FINISH, {'job_id': job_id, 'status': 'failed', 'error': repr(error)})
+            else:
+                await self._execute(shard, _FINISH, {'job_id': job_id, 'status': 'done', 'error': None})
+            finally:
+                self.running -= 1
+
+    async def _delete(self, shard: str, job_id: UUID, entity: str, entity_id: UUID) -> None:
+        params = {'entity_id': entity_id, 'batch': self.batch_size}
+        for statement in PHASES[entity]:
+            while True:
+                async with shard_sessionmakers[shard]() as session:
+                    async with session.begin():
+                        deleted = (await session.execute(statement, params)).rowcount
+                        await session.execute(_PROGRESS, {'job_id': job_id, 'rows': deleted})
+                if deleted < self.batch_size:
+                    break
+                await asyncio.sleep(self.pause)
+        if not SHARDED:
+            return
+        while True:
+            async with async_session() as session:
+                async with session.begin():
+                    released = (await session.execute(RELEASE_TITLES[entity], params)).rowcount
+            if released < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def resume_stale(self) -> None:
+        for sessionmaker in shard_sessionmakers.values():
+            async with sessionmaker() as session:
+                job_ids = (await session.scalars(_STALE, {'stale': self.stale_after})).all()
+            for job_id in job_ids:
+                self.start(job_id)
+
+
+deletion_jobs = DeletionJobs(concurrency=settings.DELETION_JOBS_PER_WORKER,
+                             batch_size=settings.DELETION_BATCH_SIZE,
+                             pause=settings.DELETION_BATCH_PAUSE,
+                             stale_after=settings.DELETION_JOB_STALE_AFTER)
+registry.gauge_callback('deletion_jobs_running', 'Deletion jobs executing in this worker',
+                        lambda: deletion_jobs.running)
+registry.gauge_callback('deletion_jobs_queued', 'Deletion jobs waiting for a free slot in this worker',
+                        lambda: len(deletion_jobs._tasks) - deletion_jobs.running)
+
+
+async def resume_deletion_jobs() -> None:
+    """Подхватывает задачи, которые не обновлялись дольше stale_after, например после падения воркера"""
+    try:
+        while True:
+            try:
+                await deletion_jobs.resume_stale()
+            except Exception:
+                logger.exception('Resuming deletion jobs failed')
+            await asyncio.sleep(settings.DELETION_JOB_STALE_AFTER)
+    finally:
+        await deletion_jobs.close()
@@ -0,0 +1,141 @@
+import asyncio
+import datetime
+import logging
+from uuid import UUID
+
+from sqlalchemy import text
+
+import settings
+from api.stats import bump_views_stats
+from database import shard_sessionmakers
+from sharding import locate_many
+from metrics import registry
+
+logger = logging.getLogger('engagement')
+
+HOUR = 'hour'
+DAY = 'day'
+
+#  блог берется из поста при сбросе, события удаленных за это время постов отбрасываются соединением.
+#  строки идут в порядке первичного ключа: воркеры, сбрасывающие одни и те же посты, блокируют их
+#  в одном порядке и не взаимоблокируются
+_UPSERT = text('''
+INSERT INTO post_engagement AS e (post_id, blog_id, period, bucket, views, likes, comments)
+SELECT p.id, p.blog_id, v.period, v.bucket, v.views, v.likes, v.comments
+FROM unnest(CAST(:post_ids AS uuid[]), CAST(:periods AS varchar[]), CAST(:buckets AS timestamp[]),
+            CAST(:views AS integer[]), CAST(:likes AS integer[]), CAST(:comments AS integer[]))
+     AS v(post_id, period, bucket, views, likes, comments)
+JOIN posts p ON p.id = v.post_id
+ORDER BY v.post_id, v.period, v.bucket
+ON CONFLICT (post_id, period, bucket) DO UPDATE
+SET views = e.views + excluded.views, likes = e.likes + excluded.likes, comments = e.comments + excluded.comments
+''')
+
+
+class EngagementBuffer:
+    """Просмотры, лайки и комментарии по постам и часам с последнего сброса.
+
+    При сбросе одним запросом прибавляются к часовым и суточным строкам post_engagement,
+    отдельных событий база не хранит. Просмотры в том же сбросе попадают в счетчики авторов и блогов.
+    """
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._pending: dict[tuple[UUID, datetime.datetime], list[int]] = {}
+        self._flush_requested = asyncio.Event()
+
+    def record(self, post_id: UUID, views: int = 0, likes: int = 0, comments: int = 0) -> None:
+        hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        counts = self._pending.get((post_id, hour))
+        if counts is None:
+            counts = self._pending[post_id, hour] = [0, 0, 0]
+            if len(self._pending) >= self.max_pending:
+                self._flush_requested.set()
+        counts[0] += views
+        counts[1] += likes
+        counts[2] += comments
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    @staticmethod
+    def _rows(pending: dict[tuple[UUID, datetime.datetime], list[int]]) -> dict[str, list]:
+        buckets = {}
+        for (post_id, hour), counts in pending.items():
+            buckets[post_id, HOUR, hour] = counts
+            day = buckets.setdefault((post_id, DAY, hour.replace(hour=0)), [0, 0, 0])
+            for position, count in enumerate(counts):
+                day[position] += count
+        keys = sorted(buckets)
+        return {'post_ids': [key[0] for key in keys], 'periods': [key[1] for key in keys],
+                'buckets': [key[2] for key in keys], 'views': [buckets[key][0] for key in keys],
+                'likes': [buckets[key][1] for key in keys], 'comments': [buckets[key][2] for key in keys]}
+
+    @staticmethod
+    def _views(pending: dict[tuple[UUID, datetime.datetime], list[int]]) -> dict[UUID, int]:
+        views = {}
+        for (post_id, _), counts in pending.items():
+            if counts[0]:
+                views[post_id] = views.get(post_id, 0) + counts[0]
+        return dict(sorted(views.items()))
+
+    def _restore(self, pending: dict[tuple[UUID, datetime.datetime], list[int]]) -> None:
+        #  не сохраненные счетчики возвращаются в буфер и попадут в следующий сброс
+        for key, counts in pending.items():
+            current = self._pending.get(key)
+            if current is not None:
+                counts = [saved + new for saved, new in zip(counts, current)]
+            self._pending[key] = counts
+
+    async def flush(self) -> int:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            shards = await locate_many('posts', {post_id for post_id, _ in pending})
+        except Exception:
+            self._restore(pending)
+            raise
+        failure = None
+        #  каждый шард получает только свои посты: при ошибке в буфер возвращаются счетчики этого шарда
+        for shard, post_ids in shards.items():
+            post_ids = set(post_ids)
+            part = {key: counts for key, counts in pending.items() if key[0] in post_ids}
+            try:
+                async with shard_sessionmakers[shard]() as session:
+                    async with session.begin():
+                        await session.execute(_UPSERT, self._rows(part))
+                        views = self._views(part)
+                        if views:
+                            await bump_views_stats(session, views)
+            except Exception as error:
+                self._restore(part)
+                failure = error
+        if failure is not None:
+            raise failure
+        return len(pending)
+
+    async def run(self, interval: float) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Engagement flush failed')
+
+
+engagement = EngagementBuffer(max_pending=settings.ENGAGEMENT_MAX_PENDING)
+registry.gauge_callback('engagement_pending_buckets', 'Post hours with engagement counts not yet flushed',
+                        engagement.pending_count)
+
+
+async def flush_engagement_periodically() -> None:
+    try:
+        await engagement.run(settings.ENGAGEMENT_FLUSH_INTERVAL)
+    finally:
+        #  при остановке воркера сохраняем накопленное
+        await engagement.flush()
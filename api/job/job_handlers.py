@@ -0,0 +1,18 @@
+from typing import Annotated
+from uuid import UUID
+from fastapi import APIRouter, Depends
+from starlette import status
+from starlette.exceptions import HTTPException
+
+from api.managers import JobManager
+from api.schemas import JobResponse
+
+job_router = APIRouter()
+
+
+@job_router.get("/{job_id}", response_model=JobResponse)
+async def get_job(job_id: UUID, manager: Annotated[JobManager, Depends()]):
+    job = await manager.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job does not found')
+    return job
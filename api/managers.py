@@ -1,44 +1,89 @@
 from fastapi import Depends
 from fastapi_filter.contrib.sqlalchemy import Filter
-from fastapi_pagination.ext.async_sqlalchemy import paginate
-from sqlalchemy import select, update, delete, and_
+from sqlalchemy import select, update, delete, and_, lambda_stmt, func, cast
+from sqlalchemy.engine import Row
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import noload
 from sqlalchemy.dialects.postgresql import UUID
+import asyncio
+import uuid
+from datetime import datetime
 from typing import Union
 
 from starlette import status
 from starlette.exceptions import HTTPException
 
-from api.models import User, Blog, BlogAuthors, Post, Comment, Likes
+import settings
+from api.autocomplete import autocomplete
+from api.engagement import engagement, HOUR, DAY
+from api.models import User, Blog, BlogAuthors, Post, Comment, Likes, UserStats, BlogStats, DeletionJob, \
+    PostEngagement, HIDDEN_BLOG_IDS, VISIBLE_BLOG, VISIBLE_POST
+from api.pagination import CountStrategy, paginate, paginate_shards, filter_key
+from api.read_models import users_statement, blogs_statement, posts_statement, load_users, \
+    load_blogs, load_posts, UserDetailRow, PostRow
 from api.schemas import BlogCreate, PostCreate, CommentCreate
+from api.stats import COUNTERS, bump_owner_stats, bump_post_stats, drop_blog_stats
 from auth import Hash
+from events import publish
 from abc import ABC
 
-from database import get_db
+from api.deletion import deletion_jobs
+from database import SHARDED, get_unit_of_work, on_commit, shard_session, all_shard_sessions
+from sharding import child_id, blog_session, entity_session, ensure_user, locate_many, user_replicas, claim_title
+
+
+async def schedule_deletion(session: AsyncSession, target: AsyncSession, entity: str, entity_id: UUID,
+                            blog_id: UUID) -> DeletionJob:
+    """Задача пишется на шард блога target, id задачи несет токен блога"""
+    job = DeletionJob(id=child_id(blog_id), entity=entity, entity_id=entity_id, status='pending')
+    target.add(job)
+    await target.flush()
+    on_commit(session, lambda: deletion_jobs.start(job.id))
+    return job
 
 
 class Manager(ABC):
-    def __init__(self, db: AsyncSession = Depends(get_db)):
+    def __init__(self, db: AsyncSession = Depends(get_unit_of_work)):
         self.db_session = db
 
+    async def blog_session(self, blog_id: UUID) -> AsyncSession:
+        return await blog_session(self.db_session, blog_id)
+
+    async def post_session(self, post_id: UUID) -> AsyncSession | None:
+        return await entity_session(self.db_session, 'posts', post_id)
+
+    async def author_ids(self, name: str) -> list[UUID]:
+        """Точное имя в id по индексу users.name в глобальной базе: на шардах списки фильтруются без users"""
+        statement = lambda_stmt(lambda: select(User.id).where(User.name == name))
+        return (await self.db_session.execute(statement)).scalars().all()
+
+    async def paginate(self, statement, strategy: str, key: tuple, load, cursor: str | None, keyset: bool):
+        """Без шардов и курсора - обычная страница, иначе слияние страниц шардов"""
+        if not SHARDED and cursor is None:
+            return await paginate(self.db_session, statement, CountStrategy(strategy), cache_key=key,
+                                  filtered=bool(key[1]), load=load)
+        return await paginate_shards(await all_shard_sessions(self.db_session), statement, CountStrategy(strategy),
+                                     cache_key=key, filtered=bool(key[1]), load=load, keyset=keyset, cursor=cursor)
+
 
 class UserManager(Manager):
 
     async def get_all_users(self, user_filter):
-        statement = user_filter.filter(select(User).where(User.is_active == True))
-        users = await paginate(self.db_session, statement)
+        statement = user_filter.filter(users_statement().where(User.is_active == True))
+        key = filter_key('users', **user_filter.model_dump())
+        users = await paginate(self.db_session, statement, CountStrategy(settings.USERS_COUNT_STRATEGY),
+                               cache_key=key, filtered=bool(key[1]), load=load_users)
         return users
 
-    async def get_user(self, id: UUID) -> Union[User, None]:
-        statement = select(User).where(and_(User.is_active == True, User.id == id))
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
-        user = result.scalar()
-        return user
+    async def get_user(self, id: UUID) -> Union[UserDetailRow, None]:
+        statement = lambda_stmt(lambda: users_statement().where(and_(User.is_active == True, User.id == id)))
+        result = await self.db_session.execute(statement)
+        users = await load_users(self.db_session, result.all())
+        return users[0] if users else None
 
     async def get_user_by_email(self, email: str) -> Union[User, None]:
-        statement = select(User).where(and_(User.is_active == True, User.email == email))
+        statement = lambda_stmt(lambda: select(User).where(and_(User.is_active == True, User.email == email)))
         result = await self.db_session.execute(statement)
         user = result.scalar()
         return user
@@ -52,231 +97,472 @@ class UserManager(Manager):
             email=email,
             password=Hash.get_hashed_password(password)
         )
-        async with self.db_session.begin():
-            self.db_session.add(new_user)
-            await self.db_session.flush()
+        self.db_session.add(new_user)
+        await self.db_session.flush()
+        self.db_session.add(UserStats(user_id=new_user.id))
+        on_commit(self.db_session, lambda: autocomplete.users.put(new_user.id, name))
         return new_user
 
-    async def update_user(self, params: dict) -> User | None:
+    async def update_user(self, params: dict) -> UserDetailRow | None:
         user_id = params.pop('id')
-        statement = update(User).where(and_(User.is_active == True, User.id == user_id)).values(params).returning(User)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
-        user = result.scalar()
-        return user
+        statement = update(User).where(and_(User.is_active == True, User.id == user_id)).values(params).\
+            returning(*users_statement().selected_columns)
+        result = await self.db_session.execute(statement)
+        users = await load_users(self.db_session, result.all())
+        if not users:
+            return None
+        on_commit(self.db_session, lambda: user_replicas.record(user_id))
+        if 'name' in params:
+            on_commit(self.db_session, lambda: autocomplete.users.put(user_id, params['name']))
+        return users[0]
 
     async def delete_user(self, user_id: UUID) -> UUID | None:
-        statement = update(User).where(User.id == user_id).values(is_active=False).returning(User.id)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+        statement = lambda_stmt(lambda: update(User).where(User.id == user_id).values(is_active=False).returning(User.id))
+        result = await self.db_session.execute(statement)
         user_id = result.scalar()
+        if user_id is not None:
+            on_commit(self.db_session, lambda: user_replicas.record(user_id))
+            on_commit(self.db_session, lambda: autocomplete.users.remove(user_id))
         return user_id
 
 
 class BlogManager(Manager):
 
-    async def get_all_blogs(self, author: str | None, order_by: str | None, blog_filter: Filter):
-        async with self.db_session.begin():
-            if author:
-                blogs = await paginate(self.db_session,
-                                       select(Blog).where(Blog.authors.any(User.name == author)).order_by(Blog.created_at.desc()))
-
-            elif order_by:
-                blogs = await paginate(self.db_session, blog_filter.sort(select(Blog)))
+    async def get_all_blogs(self, author: str | None, order_by: str | None, blog_filter: Filter,
+                            cursor: str | None = None):
+        if author:
+            author_ids = await self.author_ids(author)
+            statement = blogs_statement().\
+                where(Blog.id.in_(select(BlogAuthors.blog_id).where(BlogAuthors.author_id.in_(author_ids)))).\
+                order_by(Blog.created_at.desc())
+            key = filter_key('blogs', author=author)
+        elif order_by:
+            statement = blog_filter.sort(blogs_statement())
+            key = filter_key('blogs')
+        else:
+            statement = blog_filter.filter(blogs_statement().order_by(Blog.created_at.desc()))
+            key = filter_key('blogs', **blog_filter.model_dump(exclude={'order_by'}))
 
-            else:
-                blogs = await paginate(self.db_session,
-                                       blog_filter.filter(select(Blog).order_by(Blog.created_at.desc())))
+        blogs = await self.paginate(statement, settings.BLOGS_COUNT_STRATEGY, key, load_blogs, cursor,
+                                    keyset=not order_by or bool(author))
         return blogs
 
     async def get_blog(self, blog_id: UUID) -> Blog | None:
-        statement = select(Blog).where(Blog.id == blog_id)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+        session = await self.blog_session(blog_id)
+        statement = lambda_stmt(lambda: select(Blog).where(and_(Blog.id == blog_id, VISIBLE_BLOG)))
+        result = await session.execute(statement)
         blog = result.scalar()
         return blog
 
     async def create_blog(self, body: BlogCreate, owner_id: UUID) -> Blog:
+        #  id нужен до вставки: по нему выбирается шард
         new_blog = Blog(
+            id=uuid.uuid4(),
             title=body.title,
             description=body.description,
             owner_id=owner_id
         )
-        async with self.db_session.begin():
-            self.db_session.add(new_blog)
-            try:
-                await self.db_session.flush()
-            except IntegrityError:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                    detail='Blog with this title already exist')
-            new_blog_author = BlogAuthors(author_id=owner_id,
-                                          blog_id=new_blog.id)
-            self.db_session.add(new_blog_author)
-            await self.db_session.flush()
+        session = await self.blog_session(new_blog.id)
+        await ensure_user(self.db_session, session, owner_id)
+        session.add(new_blog)
+        try:
+            if not await claim_title(self.db_session, 'blogs', new_blog.id, new_blog.id, body.title):
+                raise LookupError(body.title)
+            await session.flush()
+        except (LookupError, IntegrityError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail='Blog with this title already exist')
+        new_blog_author = BlogAuthors(author_id=owner_id,
+                                      blog_id=new_blog.id)
+        session.add_all([new_blog_author, BlogStats(blog_id=new_blog.id)])
+        await session.flush()
+        on_commit(self.db_session, lambda: autocomplete.blogs.put(new_blog.id, new_blog.title))
         return new_blog
 
     async def create_blog_author(self, author_id: UUID, blog_id: UUID) -> Blog:
+        session = await self.blog_session(blog_id)
         item = await self.get_blog_authors(blog_id=blog_id, user_id=author_id)
         if item is None:
             new_blog_author = BlogAuthors(author_id=author_id,
                                           blog_id=blog_id)
-            async with self.db_session.begin():
-                self.db_session.add(new_blog_author)
-                try:
-                    await self.db_session.flush()
-                except IntegrityError:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                        detail='You are trying to add a non-existent user to authors')
+            try:
+                if not await ensure_user(self.db_session, session, author_id):
+                    raise LookupError(author_id)
+                session.add(new_blog_author)
+                await session.flush()
+            except (LookupError, IntegrityError):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail='You are trying to add a non-existent user to authors')
         blog = await self.get_blog(blog_id=blog_id)
+        await session.refresh(blog, attribute_names=['authors'])
         return blog
 
     async def delete_blog_author(self, author_id: UUID, blog_id: UUID) -> None:
-        statement = delete(BlogAuthors).where(and_(BlogAuthors.blog_id == blog_id, BlogAuthors.author_id == author_id)).\
-            returning(BlogAuthors.blog_id)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+        session = await self.blog_session(blog_id)
+        statement = lambda_stmt(lambda: delete(BlogAuthors).
+                                where(and_(BlogAuthors.blog_id == blog_id, BlogAuthors.author_id == author_id)).
+                                returning(BlogAuthors.blog_id))
+        result = await session.execute(statement)
         if result.scalar() is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail='This blog has not authors with this id')
 
         blog = await self.get_blog(blog_id=blog_id)
+        await session.refresh(blog, attribute_names=['authors'])
         return blog
 
     async def get_blog_authors(self, blog_id: UUID, user_id: UUID) -> BlogAuthors | None:
-        statement = select(BlogAuthors).where(and_(BlogAuthors.blog_id == blog_id, BlogAuthors.author_id == user_id))
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+        session = await self.blog_session(blog_id)
+        statement = lambda_stmt(lambda: select(BlogAuthors).join(Blog, Blog.id == BlogAuthors.blog_id).
+                                where(and_(BlogAuthors.blog_id == blog_id, BlogAuthors.author_id == user_id,
+                                           VISIBLE_BLOG)))
+        result = await session.execute(statement)
         blog_authors = result.scalar()
         return blog_authors
 
-    async def update_blog(self, blog_id: UUID, params: dict) -> Blog:
-        statement = update(Blog).where(Blog.id == blog_id).values(params).returning(Blog)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+    async def blog_exists(self, blog_id: UUID) -> bool:
+        session = await self.blog_session(blog_id)
+        statement = lambda_stmt(lambda: select(Blog.id).where(and_(Blog.id == blog_id, VISIBLE_BLOG)))
+        result = await session.execute(statement)
+        return result.scalar() is not None
+
+    async def get_blog_owner_id(self, blog_id: UUID) -> UUID | None:
+        session = await self.blog_session(blog_id)
+        statement = lambda_stmt(lambda: select(Blog.owner_id).where(and_(Blog.id == blog_id, VISIBLE_BLOG)))
+        result = await session.execute(statement)
+        return result.scalar()
+
+    async def update_blog(self, blog_id: UUID, params: dict, owner_id: UUID) -> Blog | None:
+        session = await self.blog_session(blog_id)
+        statement = update(Blog).where(and_(Blog.id == blog_id, Blog.owner_id == owner_id, Blog.is_deleted == False)).\
+            values(params).returning(Blog).execution_options(populate_existing=True)
+        result = await session.execute(statement)
         blog = result.scalar()
+        if blog is not None and 'title' in params:
+            if not await claim_title(self.db_session, 'blogs', blog_id, blog_id, params['title']):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail='Blog with this title already exist')
+            on_commit(self.db_session, lambda: autocomplete.blogs.put(blog_id, params['title']))
         return blog
 
-    async def delete_blog(self, blog_id: UUID) -> UUID:
-        statement = delete(Blog).where(Blog.id == blog_id).returning(Blog.id)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
-        deleted_blog_id = result.scalar()
-        return deleted_blog_id
+    async def delete_blog(self, blog_id: UUID, owner_id: UUID) -> DeletionJob | None:
+        """Скрывает блог сразу, посты, комментарии и лайки удаляются задачей после коммита"""
+        session = await self.blog_session(blog_id)
+        statement = lambda_stmt(lambda: update(Blog).
+                                where(and_(Blog.id == blog_id, Blog.owner_id == owner_id, Blog.is_deleted == False)).
+                                values(is_deleted=True).returning(Blog.id))
+        result = await session.execute(statement)
+        if result.scalar() is None:
+            return None
+        await drop_blog_stats(session, blog_id)
+        on_commit(self.db_session, lambda: autocomplete.blogs.remove(blog_id))
+        return await schedule_deletion(self.db_session, session, 'blog', blog_id, blog_id)
 
 
 class PostManager(Manager):
 
-    async def get_all_posts(self, author: str | None, order_by: str | None, post_filter: Filter):
-        async with self.db_session.begin():
-            if author:
-                posts = await paginate(self.db_session,
-                                       select(Post).where(and_(Post.author.has(User.name == author), Post.is_published == True)).
-                                       order_by(Post.created_at.desc()))
-            elif order_by:
-                posts = await paginate(self.db_session,
-                                       post_filter.sort(select(Post).where(Post.is_published == True)))
-            else:
-                posts = await paginate(self.db_session,
-                                       post_filter.filter(select(Post).where(Post.is_published == True).
-                                                          order_by(Post.created_at.desc())))
+    async def get_all_posts(self, author: str | None, order_by: str | None, post_filter: Filter,
+                            cursor: str | None = None):
+        if author:
+            author_ids = await self.author_ids(author)
+            statement = posts_statement().where(and_(Post.author_id.in_(author_ids), Post.is_published == True)).\
+                order_by(Post.created_at.desc())
+            key = filter_key('posts', author=author)
+        elif order_by:
+            statement = post_filter.sort(posts_statement().where(Post.is_published == True))
+            key = filter_key('posts')
+        else:
+            statement = post_filter.filter(posts_statement().where(Post.is_published == True).
+                                           order_by(Post.created_at.desc()))
+            key = filter_key('posts', **post_filter.model_dump(exclude={'order_by'}))
+
+        posts = await self.paginate(statement, settings.POSTS_COUNT_STRATEGY, key, load_posts, cursor,
+                                    keyset=not order_by or bool(author))
         return posts
 
     async def get_post(self, post_id: UUID) -> Post | None:
-        statement = select(Post).where(and_(Post.id == post_id, Post.is_published == True))
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+        session = await self.post_session(post_id)
+        if session is None:
+            return None
+        statement = lambda_stmt(lambda: select(Post).
+                                where(and_(Post.id == post_id, Post.is_published == True, VISIBLE_POST)))
+        result = await session.execute(statement)
         post = result.scalar()
         return post
 
     async def create_post(self, data: PostCreate, author: User) -> Post:
-        new_post = Post(blog_id=data.blog_id, author_id=author.id, title=data.title, body=data.body)
-        async with self.db_session.begin():
-            self.db_session.add(new_post)
-            try:
-                await self.db_session.flush()
-            except IntegrityError:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                    detail='Post with this title already exist')
+        session = await self.blog_session(data.blog_id)
+        await ensure_user(self.db_session, session, author.id)
+        new_post = Post(id=child_id(data.blog_id), blog_id=data.blog_id, author_id=author.id, title=data.title,
+                        body=data.body)
+        session.add(new_post)
+        try:
+            if not await claim_title(self.db_session, 'posts', new_post.id, data.blog_id, data.title):
+                raise LookupError(data.title)
+            await session.flush()
+        except (LookupError, IntegrityError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail='Post with this title already exist')
+        await bump_owner_stats(session, author.id, data.blog_id, posts=1)
+        await publish(session, new_post.id, 'created', {'title': data.title, 'is_published': new_post.is_published})
         return new_post
 
-    async def set_or_remove_like(self, post_id: UUID, user_id: UUID):
-        post = await self.get_post(post_id=post_id)
+    async def set_or_remove_like(self, post_id: UUID, user_id: UUID) -> PostRow:
+        session = await self.post_session(post_id)
+        post = None
+        if session is not None:
+            #  список лайкнувших не загружается: ответу и событию нужно только их число
+            statement = lambda_stmt(lambda: select(Post).
+                                    where(and_(Post.id == post_id, Post.is_published == True, VISIBLE_POST)).
+                                    options(noload(Post.likes)))
+            result = await session.execute(statement)
+            post = result.scalar()
         if post is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail='Post does not exist')
+        await ensure_user(self.db_session, session, user_id)
 
-        statement = select(Likes).where(and_(Likes.post_id == post_id, Likes.user_id == user_id))
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+        #  первичный ключ секционированной likes включает created_at и не запрещает второй лайк,
+        #  поэтому проверка и вставка идут под блокировкой пары пост-пользователь
+        statement = lambda_stmt(lambda: select(func.pg_advisory_xact_lock(
+            func.hashtextextended(func.concat(cast(post_id, UUID), cast(user_id, UUID)), 0))))
+        await session.execute(statement)
+        statement = lambda_stmt(lambda: select(Likes).where(and_(Likes.post_id == post_id, Likes.user_id == user_id)))
+        result = await session.execute(statement)
 
         if result.scalar():
-            statement = delete(Likes).where(and_(Likes.post_id == post_id, Likes.user_id == user_id))
-            async with self.db_session.begin():
-                await self.db_session.execute(statement)
+            statement = lambda_stmt(lambda: delete(Likes).where(and_(Likes.post_id == post_id, Likes.user_id == user_id)))
+            await session.execute(statement)
+            await bump_owner_stats(session, post.author_id, post.blog_id, likes=-1)
+            on_commit(self.db_session, lambda: engagement.record(post_id, likes=-1))
         else:
             like = Likes(post_id=post_id, user_id=user_id)
-            async with self.db_session.begin():
-                self.db_session.add(like)
-                await self.db_session.flush()
-        await self.db_session.close()
-
-        post1 = await self.get_post(post_id=post_id)
-        return post1
-
-    async def change_views(self, views: int, post_id: UUID) -> Post:
-        statement = update(Post).where(and_(Post.id == post_id, Post.is_published == True)).\
-            values({'views': views}).returning(Post)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+            session.add(like)
+            await session.flush()
+            await bump_owner_stats(session, post.author_id, post.blog_id, likes=1)
+            on_commit(self.db_session, lambda: engagement.record(post_id, likes=1))
+
+        statement = lambda_stmt(lambda: select(func.count()).select_from(Likes).where(Likes.post_id == post_id))
+        likes = (await session.execute(statement)).scalar()
+        await publish(session, post_id, 'likes', {'likes': likes})
+        return PostRow(post.id, post.title, post.body, post.author_id, post.blog_id, post.is_published,
+                       post.created_at, post.views, likes, post.author, post.blog)
+
+    async def add_view(self, post_id: UUID) -> Post | None:
+        session = await self.post_session(post_id)
+        if session is None:
+            return None
+        statement = lambda_stmt(lambda: update(Post).
+                                where(and_(Post.id == post_id, Post.is_published == True, Post.is_deleted == False,
+                                           Post.blog_id.not_in(HIDDEN_BLOG_IDS))).
+                                values(views=Post.views + 1).returning(Post).
+                                execution_options(populate_existing=True))
+        result = await session.execute(statement)
         post = result.scalar()
+        if post is not None:
+            #  счетчики автора и блога получат просмотр при сбросе буфера
+            on_commit(self.db_session, lambda: engagement.record(post_id, views=1))
         return post
 
-    async def update_post(self, post_id: UUID, data: dict) -> Post:
-        statement = update(Post).where(Post.id == post_id).values(data).returning(Post)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+    async def add_views(self, post_id: UUID, count: int) -> None:
+        session = await self.post_session(post_id)
+        if session is None:
+            return
+        statement = lambda_stmt(lambda: update(Post).where(Post.id == post_id).values(views=Post.views + count).
+                                returning(Post.id))
+        result = await session.execute(statement)
+        if result.scalar() is not None:
+            on_commit(self.db_session, lambda: engagement.record(post_id, views=count))
+
+    async def get_view_counts(self, post_id: UUID) -> Row | None:
+        session = await self.post_session(post_id)
+        if session is None:
+            return None
+        statement = lambda_stmt(lambda: select(Post.views, Post.viewers_hll).
+                                where(and_(Post.id == post_id, Post.is_published == True, VISIBLE_POST)))
+        result = await session.execute(statement)
+        return result.first()
+
+    async def get_post_text(self, post_id: UUID) -> Row | None:
+        session = await self.post_session(post_id)
+        if session is None:
+            return None
+        statement = lambda_stmt(lambda: select(Post.title, Post.body).
+                                where(and_(Post.id == post_id, Post.is_published == True, VISIBLE_POST)))
+        result = await session.execute(statement)
+        return result.first()
+
+    async def get_posts_by_ids(self, post_ids: list[UUID]) -> list[Row]:
+        statement = select(Post.id, Post.title, Post.body, Post.author_id, Post.blog_id, Post.is_published,
+                           Post.created_at, Post.views).where(Post.is_published == True)
+        groups = await locate_many('posts', post_ids)
+        sessions = [await shard_session(self.db_session, shard) for shard in groups]
+        results = await asyncio.gather(*(session.execute(statement.where(Post.id.in_(ids)))
+                                         for session, ids in zip(sessions, groups.values())))
+        return [row for result in results for row in result]
+
+    async def post_exists(self, post_id: UUID) -> bool:
+        session = await self.post_session(post_id)
+        if session is None:
+            return False
+        statement = lambda_stmt(lambda: select(Post.id).where(and_(Post.id == post_id, VISIBLE_POST)))
+        result = await session.execute(statement)
+        return result.scalar() is not None
+
+    async def update_post(self, post_id: UUID, data: dict, author_id: UUID) -> Post | None:
+        session = await self.post_session(post_id)
+        if session is None:
+            return None
+        statement = update(Post).where(and_(Post.id == post_id, Post.author_id == author_id, Post.is_deleted == False,
+                                        Post.blog_id.not_in(HIDDEN_BLOG_IDS))).\
+            values(data).returning(Post).execution_options(populate_existing=True)
+        result = await session.execute(statement)
         updated_post = result.scalar()
+        if updated_post is not None and 'title' in data and \
+                not await claim_title(self.db_session, 'posts', post_id, updated_post.blog_id, data['title']):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail='Post with this title already exist')
+        if updated_post is not None:
+            #  заголовок и видимость после изменения: по ним воркеры обновляют подсказки
+            await publish(session, post_id, 'updated',
+                          {**data, 'title': updated_post.title, 'is_published': updated_post.is_published})
         return updated_post
 
-    async def delete_post(self, post_id: UUID) -> UUID:
-        statement = delete(Post).where(Post.id == post_id).returning(Post.id)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
-        post_id = result.scalar()
-        return post_id
+    async def delete_post(self, post_id: UUID, author_id: UUID) -> DeletionJob | None:
+        """Скрывает пост и вычитает его из статистики, комментарии и лайки удаляются задачей после коммита"""
+        session = await self.post_session(post_id)
+        if session is None:
+            return None
+        likes = select(func.count()).where(Likes.post_id == Post.id).scalar_subquery().label('likes')
+        comments = select(func.count()).where(Comment.post_id == Post.id).scalar_subquery().label('comments')
+        statement = update(Post).where(and_(Post.id == post_id, Post.author_id == author_id, Post.is_deleted == False,
+                                        Post.blog_id.not_in(HIDDEN_BLOG_IDS))).\
+            values(is_deleted=True).returning(Post.blog_id, Post.views, likes, comments)
+        result = await session.execute(statement)
+        row = result.first()
+        if row is None:
+            return None
+        await bump_owner_stats(session, author_id, row.blog_id, posts=-1, views=-(row.views or 0),
+                               likes=-row.likes, comments=-row.comments)
+        on_commit(self.db_session, lambda: autocomplete.posts.remove(post_id))
+        return await schedule_deletion(self.db_session, session, 'post', post_id, row.blog_id)
 
 
 class CommentManager(Manager):
 
     async def get_comments(self, post_id: UUID):
-        statement = select(Comment).where(Comment.post_id == post_id)
-        async with self.db_session.begin():
-            result = await self.db_session.scalars(statement)
+        session = await self.post_session(post_id)
+        if session is None:
+            return []
+        statement = lambda_stmt(lambda: select(Comment).join(Post, Post.id == Comment.post_id).
+                                where(and_(Comment.post_id == post_id, VISIBLE_POST)))
+        result = await session.scalars(statement)
         comments = result.all()
         return comments
 
     async def create_comment(self, data: CommentCreate, author: User) -> Comment | None:
-        new_comment = Comment(post_id=data.post_id, author_id=author.id, body=data.body)
-        async with self.db_session.begin():
-            try:
-                self.db_session.add(new_comment)
-                await self.db_session.flush()
-            except IntegrityError:
-                return None
+        session = await self.post_session(data.post_id)
+        if session is None:
+            return None
+        #  на секционированную posts нет внешнего ключа: пост проверяется здесь и, как это делал бы ключ,
+        #  блокируется от удаления до конца транзакции
+        post_id = data.post_id
+        statement = lambda_stmt(lambda: select(Post.blog_id).where(and_(Post.id == post_id, VISIBLE_POST)).
+                                with_for_update(key_share=True))
+        blog_id = (await session.execute(statement)).scalar()
+        if blog_id is None:
+            return None
+        await ensure_user(self.db_session, session, author.id)
+        new_comment = Comment(id=child_id(blog_id), post_id=data.post_id, author_id=author.id, body=data.body)
+        try:
+            session.add(new_comment)
+            await session.flush()
+        except IntegrityError:
+            return None
+        await bump_post_stats(session, data.post_id, comments=1)
+        on_commit(self.db_session, lambda: engagement.record(data.post_id, comments=1))
+        await publish(session, data.post_id, 'comment',
+                      {'id': new_comment.id, 'author_id': new_comment.author_id, 'body': new_comment.body,
+                       'created_at': new_comment.created_at})
         return new_comment
 
     async def update_comment(self, comment_id: UUID, data: dict, user_id: UUID) -> Comment:
+        session = await entity_session(self.db_session, 'comments', comment_id)
+        if session is None:
+            return None
         statement = update(Comment).where(and_(Comment.id == comment_id, Comment.author_id == user_id)).\
-            values(data).returning(Comment)
-        async with self.db_session.begin():
-            result = await self.db_session.execute(statement)
+            values(data).returning(Comment).\
+            execution_options(populate_existing=True)
+        result = await session.execute(statement)
         updated_comment = result.scalar()
         return updated_comment
 
     async def delete_comment(self, comment_id: UUID, user_id: UUID) -> UUID:
-        statement = delete(Comment).where(and_(Comment.id == comment_id, Comment.author_id == user_id)).\
-            returning(Comment.id)
-        async with self.db_session.begin():
+        session = await entity_session(self.db_session, 'comments', comment_id)
+        if session is None:
+            return None
+        statement = lambda_stmt(lambda: delete(Comment).
+                                where(and_(Comment.id == comment_id, Comment.author_id == user_id)).
+                                returning(Comment.id, Comment.post_id))
+        result = await session.execute(statement)
+        row = result.first()
+        if row is None:
+            return None
+        await bump_post_stats(session, row.post_id, comments=-1)
+        return row.id
+
+
+class StatsManager(Manager):
+
+    async def get_user_stats(self, user_id: UUID) -> UserStats | dict | None:
+        """Без шардов - строка user_stats, с шардами - сумма частичных счетчиков всех шардов"""
+        statement = lambda_stmt(lambda: select(UserStats).where(UserStats.user_id == user_id))
+        if not SHARDED:
             result = await self.db_session.execute(statement)
-        comment_id = result.scalar()
-        return comment_id
+            return result.scalar()
+        if (await self.db_session.execute(select(User.id).where(User.id == user_id))).scalar() is None:
+            return None
+        sessions = await all_shard_sessions(self.db_session)
+        results = await asyncio.gather(*(session.execute(statement) for session in sessions))
+        stats = dict.fromkeys(COUNTERS, 0)
+        for row in (result.scalar() for result in results):
+            for name in COUNTERS:
+                stats[name] += getattr(row, name, 0) or 0
+        return {'user_id': user_id, **stats}
+
+    async def get_blog_stats(self, blog_id: UUID) -> BlogStats | None:
+        session = await self.blog_session(blog_id)
+        statement = lambda_stmt(lambda: select(BlogStats).where(BlogStats.blog_id == blog_id))
+        result = await session.execute(statement)
+        return result.scalar()
+
+
+class AnalyticsManager(Manager):
+
+    async def get_blog_engagement(self, blog_id: UUID, period: str, start: datetime, end: datetime,
+                                  post_id: UUID | None = None) -> list[Row]:
+        """Суммы по интервалам period из готовых часовых или суточных строк, недели и месяцы - из суточных"""
+        session = await self.blog_session(blog_id)
+        source = HOUR if period == HOUR else DAY
+        bucket = PostEngagement.bucket if period in (HOUR, DAY) else func.date_trunc(period, PostEngagement.bucket)
+        conditions = [PostEngagement.blog_id == blog_id, PostEngagement.period == source,
+                      PostEngagement.bucket >= start, PostEngagement.bucket < end]
+        if post_id is not None:
+            conditions.append(PostEngagement.post_id == post_id)
+        statement = select(bucket.label('bucket'), func.sum(PostEngagement.views).label('views'),
+                           func.sum(PostEngagement.likes).label('likes'),
+                           func.sum(PostEngagement.comments).label('comments')).\
+            where(and_(*conditions)).group_by(bucket).order_by(bucket)
+        result = await session.execute(statement)
+        return result.all()
+
+
+class JobManager(Manager):
+
+    async def get_job(self, job_id: UUID) -> DeletionJob | None:
+        session = await entity_session(self.db_session, 'deletion_jobs', job_id)
+        if session is None:
+            return None
+        statement = lambda_stmt(lambda: select(DeletionJob).where(DeletionJob.id == job_id))
+        result = await session.execute(statement)
+        return result.scalar()
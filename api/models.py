@@ -1,9 +1,11 @@
 import uuid
 import datetime
 
-from sqlalchemy import Column, String, Text, ForeignKey, TIMESTAMP, Boolean, Integer
+from sqlalchemy import Column, String, Text, ForeignKey, TIMESTAMP, Boolean, Integer, BigInteger, LargeBinary, \
+    Index, and_, event, false, func, select
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred, Session, ORMExecuteState, with_loader_criteria
+from sqlalchemy.sql.lambdas import StatementLambdaElement
 
 from database import Base
 
@@ -19,14 +21,15 @@ class Likes(Base):
     __tablename__ = 'likes'
 
     user_id = Column(ForeignKey('users.id'), primary_key=True, nullable=False)
-    post_id = Column(ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    post_id = Column(ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True, nullable=False, index=True)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
 
 
 class User(Base):
     __tablename__ = 'users'
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, index=True)
     email = Column(String, nullable=False, unique=True)
     password = Column(String, nullable=False)
     is_active = Column(Boolean(), default=True)
@@ -46,10 +49,14 @@ class Blog(Base):
     created_at = Column(TIMESTAMP, default=datetime.datetime.now)
     updated_at = Column(TIMESTAMP, default=datetime.datetime.now, onupdate=datetime.datetime.now)
     owner_id = Column(UUID(as_uuid=True), ForeignKey('users.id'))
+    is_deleted = Column(Boolean(), nullable=False, default=False, server_default=false())
     owner = relationship('User', back_populates='owner_blogs', lazy='selectin')
     authors = relationship('User', secondary='blog_authors', back_populates='author_blogs', lazy='selectin')
     posts = relationship('Post', back_populates='blog', lazy='selectin')
 
+    #  HIDDEN_BLOG_IDS в каждом запросе постов читает только этот маленький индекс
+    __table_args__ = (Index('ix_blogs_deleted', 'id', postgresql_where=is_deleted),)
+
 
 class Post(Base):
     __tablename__ = 'posts'
@@ -60,21 +67,112 @@ class Post(Base):
     title = Column(String, nullable=False, unique=True)
     body = Column(Text, default='')
     is_published = Column(Boolean(), default=True)
-    created_at = Column(TIMESTAMP, default=datetime.datetime.now)
+    created_at = Column(TIMESTAMP, nullable=False, default=datetime.datetime.now, index=True)
     likes = relationship('User', secondary='likes', back_populates='likes', lazy='selectin')
     views = Column(Integer, default=0)
+    viewers_hll = deferred(Column(LargeBinary, nullable=True))
+    is_deleted = Column(Boolean(), nullable=False, default=False, server_default=false())
     author = relationship('User', back_populates='author_posts', lazy='selectin')
     blog = relationship('Blog', back_populates='posts', lazy='selectin')
     comments = relationship('Comment', back_populates='posts', lazy='selectin')
 
 
+class Title(Base):
+    """Названия блогов и постов со всех шардов: с шардами их уникальность держит эта таблица основной базы"""
+    __tablename__ = 'titles'
+
+    kind = Column(String, primary_key=True)
+    title = Column(String, primary_key=True)
+    entity_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+    #  у блога - он сам, по нему задача удаления освобождает названия блога и его постов
+    blog_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+
+
 class Comment(Base):
     __tablename__ = 'comments'
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     author_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
-    post_id = Column(UUID(as_uuid=True), ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
+    post_id = Column(UUID(as_uuid=True), ForeignKey('posts.id', ondelete='CASCADE'), nullable=False, index=True)
     body = Column(Text, nullable=False)
-    created_at = Column(TIMESTAMP, default=datetime.datetime.now)
+    created_at = Column(TIMESTAMP, nullable=False, default=datetime.datetime.now)
     posts = relationship('Post', back_populates='comments', lazy='selectin')
     authors = relationship('User', back_populates='author_comments', lazy='selectin')
+
+
+class UserStats(Base):
+    __tablename__ = 'user_stats'
+
+    user_id = Column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    posts_count = Column(Integer, nullable=False, default=0)
+    views_count = Column(BigInteger, nullable=False, default=0)
+    likes_count = Column(Integer, nullable=False, default=0)
+    comments_count = Column(Integer, nullable=False, default=0)
+
+
+class BlogStats(Base):
+    __tablename__ = 'blog_stats'
+
+    blog_id = Column(ForeignKey('blogs.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    posts_count = Column(Integer, nullable=False, default=0)
+    views_count = Column(BigInteger, nullable=False, default=0)
+    likes_count = Column(Integer, nullable=False, default=0)
+    comments_count = Column(Integer, nullable=False, default=0)
+
+
+class PostEngagement(Base):
+    __tablename__ = 'post_engagement'
+
+    #  счетчики поста за час или сутки, начинающиеся в bucket; лайки - разница поставленных и снятых
+    post_id = Column(ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    period = Column(String(4), primary_key=True, nullable=False)
+    bucket = Column(TIMESTAMP, primary_key=True, nullable=False)
+    blog_id = Column(ForeignKey('blogs.id', ondelete='CASCADE'), nullable=False)
+    views = Column(Integer, nullable=False, default=0)
+    likes = Column(Integer, nullable=False, default=0)
+    comments = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index('ix_post_engagement_blog_bucket', 'blog_id', 'period', 'bucket'),)
+
+
+class DeletionJob(Base):
+    __tablename__ = 'deletion_jobs'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    entity = Column(String, nullable=False)
+    entity_id = Column(UUID(as_uuid=True), nullable=False)
+    status = Column(String, nullable=False, default='pending')
+    deleted_rows = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    #  время базы, с ним сравнивается updated_at при поиске зависших задач
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (Index('ix_deletion_jobs_active', 'updated_at',
+                            postgresql_where=status.in_(('pending', 'running'))),)
+
+
+#  таблица вместо модели, чтобы критерий Blog не применялся к самому подзапросу
+HIDDEN_BLOG_IDS = select(Blog.__table__.c.id).where(Blog.__table__.c.is_deleted == True)
+
+#  те же условия для lambda_stmt: хук ниже их не трогает, чтобы не терять кеш лямбды
+VISIBLE_BLOG = Blog.is_deleted == False
+VISIBLE_POST = and_(Post.is_deleted == False, Post.blog_id.not_in(HIDDEN_BLOG_IDS))
+
+_HIDE_DELETED = (
+    with_loader_criteria(Blog, lambda cls: cls.is_deleted == False, include_aliases=True),
+    #  посты скрытого блога тоже скрыты, пока задача их не удалит
+    with_loader_criteria(Post, lambda cls: and_(cls.is_deleted == False, cls.blog_id.not_in(HIDDEN_BLOG_IDS)),
+                         include_aliases=True),
+)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_deleted(execute_state: ORMExecuteState) -> None:
+    """Скрытые блоги и посты исключаются из обычных ORM-запросов.
+    lambda_stmt сами выбирают VISIBLE_BLOG/VISIBLE_POST: разворачивание лямбды ради options() стоит
+    дороже всего закешированного запроса. Задачи удаления видят скрытое с execution_options(include_deleted=True)"""
+    if execute_state.is_select and not execute_state.is_column_load and not execute_state.is_relationship_load \
+            and not isinstance(execute_state.statement, StatementLambdaElement) \
+            and not execute_state.execution_options.get('include_deleted', False):
+        execute_state.statement = execute_state.statement.options(*_HIDE_DELETED)
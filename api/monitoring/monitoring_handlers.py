@@ -0,0 +1,82 @@
+import asyncio
+import hmac
+import os
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends, Header
+from starlette import status
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, JSONResponse
+
+import settings
+from api.schemas import ProfilerStart
+from database import engine, ping_database
+from metrics import render_metrics
+from profiler import profiler
+
+monitoring_router = APIRouter()
+
+
+def require_profiler_token(x_profiler_token: Annotated[str | None, Header()] = None):
+    if not settings.PROFILER_TOKEN or x_profiler_token is None or \
+            not hmac.compare_digest(x_profiler_token, settings.PROFILER_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You have no rights')
+
+
+def require_profiler_worker(pid: int):
+    """Профайлер включается в одном воркере: остальные запросы к нему должны попасть в тот же воркер"""
+    if pid != os.getpid():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f'Profiler runs in worker {pid}, this is worker {os.getpid()}, retry the request')
+
+
+@monitoring_router.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+@monitoring_router.get('/health/live')
+async def liveness():
+    return {'status': 'ok'}
+
+
+@monitoring_router.get('/health/ready')
+async def readiness(request: Request):
+    pool = {'size': engine.pool.size(), 'checked_out': engine.pool.checkedout(), 'overflow': engine.pool.overflow()}
+    if not getattr(request.app.state, 'ready', False):
+        return JSONResponse({'status': 'starting', 'pool': pool}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    try:
+        await asyncio.wait_for(ping_database(), settings.DB_HEALTH_TIMEOUT)
+    except Exception as error:
+        return JSONResponse({'status': 'unavailable', 'error': repr(error), 'pool': pool},
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return {'status': 'ok', 'pool': pool}
+
+
+@monitoring_router.post('/profiler/start', dependencies=[Depends(require_profiler_token)])
+async def start_profiler(body: ProfilerStart):
+    await profiler.start(routes=body.routes, sample_rate=body.sample_rate, interval=body.interval_ms / 1000)
+    return {'pid': os.getpid(), 'routes': profiler.routes, 'sample_rate': profiler.sample_rate}
+
+
+@monitoring_router.post('/profiler/stop',
+                        dependencies=[Depends(require_profiler_token), Depends(require_profiler_worker)])
+async def stop_profiler():
+    await profiler.stop()
+    return {'pid': os.getpid(), 'samples': sum(profiler.samples.values())}
+
+
+@monitoring_router.get('/profiler/profile',
+                       dependencies=[Depends(require_profiler_token), Depends(require_profiler_worker)])
+async def get_profile(format: Literal['collapsed', 'speedscope'] = 'speedscope'):
+    if format == 'collapsed':
+        return PlainTextResponse(profiler.collapsed())
+    return profiler.speedscope()
+
+
+@monitoring_router.delete('/profiler/profile',
+                          dependencies=[Depends(require_profiler_token), Depends(require_profiler_worker)])
+async def reset_profile():
+    profiler.reset()
+    return {'pid': os.getpid(), 'samples': 0}
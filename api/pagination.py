@@ -0,0 +1,293 @@
+import asyncio
+import base64
+import binascii
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import time
+import uuid
+from enum import Enum
+from typing import Awaitable, Callable, Generic, Hashable, Sequence, TypeVar
+
+from fastapi_pagination import resolve_params, create_page, request
+from fastapi_pagination.links import Page as LinksPage
+from fastapi_pagination.links.bases import Links, create_links
+from sqlalchemy import Row, Select, select, func, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+from starlette import status
+from starlette.datastructures import URL
+from starlette.exceptions import HTTPException
+
+import settings
+
+T = TypeVar('T')
+
+
+class CountStrategy(str, Enum):
+    exact = 'exact'
+    cached = 'cached'
+    estimate = 'estimate'
+    none = 'none'
+
+
+class Page(LinksPage[T], Generic[T]):
+    total_estimated: bool = False
+
+
+class CountCache:
+    """Точные значения COUNT(*) на время TTL, ключ - список и нормализованные параметры фильтра"""
+
+    def __init__(self, ttl: float, max_entries: int = 10_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+
+    def get(self, key: Hashable) -> int | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        total, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        return total
+
+    def set(self, key: Hashable, total: int) -> None:
+        now = time.monotonic()
+        if len(self._entries) >= self.max_entries:
+            self._entries = {key: entry for key, entry in self._entries.items() if entry[1] >= now}
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+        self._entries[key] = (total, now + self.ttl)
+
+
+count_cache = CountCache(ttl=settings.COUNT_CACHE_TTL)
+
+
+def filter_key(listing: str, **params) -> tuple:
+    """Ключ кэша: пустые параметры отбрасываются, списки сортируются"""
+    normalized = []
+    for name, value in sorted(params.items()):
+        if value is None or value == [] or value == '':
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = tuple(sorted(map(str, value)))
+        elif isinstance(value, str):
+            value = value.strip().lower()
+        normalized.append((name, value))
+    return listing, tuple(normalized)
+
+
+async def exact_count(session: AsyncSession, statement: Select) -> int:
+    count_statement = select(func.count()).select_from(statement.order_by(None).subquery())
+    return await session.scalar(count_statement)
+
+
+async def planner_estimate(session: AsyncSession, statement: Select) -> int:
+    connection = await session.connection()
+    compiled = statement.order_by(None).compile(dialect=connection.dialect)
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup or ())
+    result = await connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', parameters)
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+async def paginate(session: AsyncSession, statement: Select, strategy: CountStrategy,
+                   cache_key: tuple, filtered: bool = False,
+                   load: Callable[[AsyncSession, Sequence[Row]], Awaitable[list]] | None = None) -> Page:
+    """Страница списка с подсчетом total выбранной стратегией.
+
+    estimate применяется только к спискам без фильтров, иначе используется cached.
+    Небольшие таблицы, где оценка планировщика ниже порога, считаются точно.
+    load собирает элементы страницы из строк выборки колонок, без него выбираются сущности.
+    """
+    params = resolve_params()
+    raw_params = params.to_raw_params()
+    limit, offset = raw_params.limit, raw_params.offset or 0
+
+    fetch_limit = limit + 1 if strategy is CountStrategy.none else limit
+    page_statement = statement.limit(fetch_limit).offset(offset)
+    if load is None:
+        items = (await session.scalars(page_statement)).unique().all()
+    else:
+        items = (await session.execute(page_statement)).all()
+
+    if strategy is CountStrategy.none:
+        has_next = len(items) > limit
+        items = items[:limit]
+        if load is not None:
+            items = await load(session, items)
+        page = params.page
+        links = create_links(first={'page': 1}, last=None,
+                             next={'page': page + 1} if has_next else None,
+                             prev={'page': page - 1} if page > 1 else None)
+        return create_page(items, total=None, params=params, links=links)
+
+    if load is not None:
+        items = await load(session, items)
+
+    if items and len(items) < limit or not items and offset == 0:
+        return create_page(items, total=offset + len(items), params=params)
+
+    if strategy is CountStrategy.estimate and filtered:
+        strategy = CountStrategy.cached
+
+    estimated = False
+    if strategy is CountStrategy.estimate:
+        total = await planner_estimate(session, statement)
+        if total < settings.COUNT_ESTIMATE_EXACT_BELOW:
+            total = await exact_count(session, statement)
+        else:
+            estimated = True
+            if items:
+                total = max(total, offset + len(items))
+    elif strategy is CountStrategy.cached:
+        total = count_cache.get(cache_key)
+        if total is None:
+            total = await exact_count(session, statement)
+            count_cache.set(cache_key, total)
+    else:
+        total = await exact_count(session, statement)
+
+    return create_page(items, total=total, params=params, total_estimated=estimated)
+
+
+def encode_cursor(row: Row) -> str:
+    value = json.dumps([row.created_at.isoformat(), str(row.id)]).encode()
+    return base64.urlsafe_b64encode(value).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, uuid.UUID]:
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return datetime.datetime.fromisoformat(created_at), uuid.UUID(row_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+
+def _sort_key(statement: Select) -> Callable[[Row], object]:
+    """Ключ слияния в порядке ORDER BY выборки: NULL больше любого значения, как в Postgres.
+    Строки сравниваются по кодам символов и могут разойтись с правилами сортировки базы"""
+    order = []
+    for clause in statement._order_by_clauses:
+        element = clause.element if isinstance(clause, UnaryExpression) else clause
+        if element.key not in statement.selected_columns:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f'Ordering by {element.key} is not supported')
+        order.append((element.key, getattr(clause, 'modifier', None) is operators.desc_op))
+
+    def compare(left: Row, right: Row) -> int:
+        for name, descending in order:
+            a, b = getattr(left, name), getattr(right, name)
+            if a == b:
+                continue
+            result = 1 if a is None else -1 if b is None else 1 if a > b else -1
+            return -result if descending else result
+        return 0
+    return functools.cmp_to_key(compare)
+
+
+def _path(url: URL) -> str:
+    return f'{url.path}?{url.query}' if url.query else url.path
+
+
+def _keyset_links(next_cursor: str | None) -> Links:
+    """Ссылки страницы по курсору: вперед - следующий курсор, first - начало списка без курсора"""
+    url = request().url
+    return Links(self=_path(url), first=_path(url.remove_query_params('cursor').include_query_params(page=1)),
+                 last=None, prev=None,
+                 next=None if next_cursor is None else _path(url.include_query_params(cursor=next_cursor)))
+
+
+async def _shard_total(sessions: list[AsyncSession], statement: Select, strategy: CountStrategy,
+                       cache_key: tuple) -> tuple[int | None, bool]:
+    async def summed(count: Callable[[AsyncSession, Select], Awaitable[int]]) -> int:
+        return sum(await asyncio.gather(*(count(session, statement) for session in sessions)))
+
+    if strategy is CountStrategy.none:
+        return None, False
+    if strategy is CountStrategy.estimate:
+        total = await summed(planner_estimate)
+        if total >= settings.COUNT_ESTIMATE_EXACT_BELOW:
+            return total, True
+        return await summed(exact_count), False
+    if strategy is CountStrategy.cached:
+        total = count_cache.get(cache_key)
+        if total is None:
+            total = await summed(exact_count)
+            count_cache.set(cache_key, total)
+        return total, False
+    return await summed(exact_count), False
+
+
+async def paginate_shards(sessions: list[AsyncSession], statement: Select, strategy: CountStrategy,
+                          cache_key: tuple, load: Callable[[AsyncSession, Sequence[Row]], Awaitable[list]],
+                          filtered: bool = False, keyset: bool = False, cursor: str | None = None) -> Page:
+    """Страница списка, разложенного по шардам: каждый шард отдает свое начало списка в том же порядке,
+    начала сливаются heapq.merge, total складывается из шардов.
+
+    С keyset порядок - created_at и id по убыванию: страница после cursor стоит каждому шарду limit строк
+    независимо от глубины, а links.next ведет на курсор. Без keyset (сортировка order_by) шарды отдают
+    offset + limit строк, поэтому глубина ограничена SHARD_MAX_MERGE_OFFSET.
+    """
+    params = resolve_params()
+    raw_params = params.to_raw_params()
+    limit, offset = raw_params.limit, raw_params.offset or 0
+    columns = statement.selected_columns
+    if keyset:
+        statement = statement.order_by(None).order_by(columns.created_at.desc(), columns.id.desc())
+    elif cursor is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='cursor cannot be combined with order_by')
+    if offset > settings.SHARD_MAX_MERGE_OFFSET and cursor is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='Page is too deep, follow the cursor from links.next')
+
+    page_statement = statement
+    if cursor is not None:
+        created_at, last_id = decode_cursor(cursor)
+        offset = 0
+        #  первое условие отсекает секции и дает диапазон по индексу created_at, второе - точная граница
+        page_statement = statement.where(columns.created_at <= created_at,
+                                         tuple_(columns.created_at, columns.id) < (created_at, last_id))
+    page_statement = page_statement.limit(offset + limit + 1)
+    results = await asyncio.gather(*(session.execute(page_statement) for session in sessions))
+
+    key = _sort_key(statement)
+    shard_rows = [[(number, row) for row in result] for number, result in enumerate(results)]
+    merged = list(itertools.islice(heapq.merge(*shard_rows, key=lambda item: key(item[1])),
+                                   offset, offset + limit + 1))
+    has_next = len(merged) > limit
+    merged = merged[:limit]
+
+    #  вложенные списки (авторы блогов и т.п.) загружаются на шарде, откуда пришла строка
+    by_shard: dict[int, list[int]] = {}
+    for position, (number, _) in enumerate(merged):
+        by_shard.setdefault(number, []).append(position)
+    items = [None] * len(merged)
+    loaded = await asyncio.gather(*(load(sessions[number], [merged[position][1] for position in positions])
+                                    for number, positions in by_shard.items()))
+    for positions, shard_items in zip(by_shard.values(), loaded):
+        for position, item in zip(positions, shard_items):
+            items[position] = item
+
+    if cursor is None and not has_next and (items or offset == 0):
+        total, estimated = offset + len(items), False
+    else:
+        total, estimated = await _shard_total(sessions, statement, strategy if strategy is not CountStrategy.estimate
+                                              or not filtered else CountStrategy.cached, cache_key)
+        if estimated and cursor is None:
+            total = max(total, offset + len(items))
+
+    if keyset:
+        links = _keyset_links(encode_cursor(merged[-1][1]) if has_next else None)
+    else:
+        page = params.page
+        links = create_links(first={'page': 1}, last=None, next={'page': page + 1} if has_next else None,
+                             prev={'page': page - 1} if page > 1 else None)
+    return create_page(items, total=total, params=params, links=links, total_estimated=estimated)
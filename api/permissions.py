@@ -1,4 +1,4 @@
-from typing import Annotated
+from typing import Annotated, NoReturn
 
 from fastapi import HTTPException, Depends
 from sqlalchemy.dialects.postgresql import UUID
@@ -19,29 +19,34 @@ class Permissions:
         self.user_manager = user_manager
 
     async def blog_permission(self, blog_id: UUID, user_id: UUID):
-        blog = await self.blog_manager.get_blog(blog_id=blog_id)
+        owner_id = await self.blog_manager.get_blog_owner_id(blog_id=blog_id)
 
-        if blog is None:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+        if owner_id is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail='Blog does not found')
 
-        if blog.owner_id != user_id:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+        if owner_id != user_id:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail='You are not owner of this blog')
 
+    async def blog_write_denied(self, blog_id: UUID) -> NoReturn:
+        """Вызывается, когда запись с проверкой владельца не затронула ни одной строки"""
+        if not await self.blog_manager.blog_exists(blog_id=blog_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail='Blog does not found')
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail='You are not owner of this blog')
+
     async def create_post_permission(self, blog_id: UUID, user: User):
         blog = await self.blog_manager.get_blog_authors(blog_id=blog_id, user_id=user.id)
         if blog is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail='You are not owner or author of this blog')
 
-    async def update_or_delete_post_permission(self, post_id: UUID, user: User):
-        post = await self.post_manager.get_post(post_id=post_id)
-
-        if post is None:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+    async def post_write_denied(self, post_id: UUID) -> NoReturn:
+        """Вызывается, когда запись с проверкой автора не затронула ни одной строки"""
+        if not await self.post_manager.post_exists(post_id=post_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail='Post does not found')
-
-        if post.author_id != user.id:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail='You are not author of this post')
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail='You are not author of this post')
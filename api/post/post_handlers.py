@@ -1,43 +1,126 @@
+import asyncio
+import contextvars
+import logging
 from typing import Annotated
 from uuid import UUID
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, WebSocket
 from fastapi_filter import FilterDepends
-from fastapi_pagination.links import Page
 from starlette import status
 from starlette.authentication import requires
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
 
+import settings
+from api.autocomplete import autocomplete, suggest
 from api.filters import PostFilter
 from api.managers import PostManager
+from api.pagination import Page
 from api.permissions import Permissions
-from api.schemas import PostCreate, PostResponse, PostResponseDetail, PostUpdate
+from api.related import related_posts
+from api.schemas import PostCreate, PostResponse, PostResponseDetail, PostUpdate, PostViewsResponse, \
+    RelatedPostResponse, AutocompleteResponse
+from api.unique_views import unique_views, viewer_key
+from database import unit_of_work
+from hyperloglog import HyperLogLog
+from events import post_events, sse_stream, websocket_stream
+from ratelimit import create_post_limit, like_limit
+from sharding import locate
+from singleflight import SingleFlight
+
+logger = logging.getLogger('posts')
 
 post_router = APIRouter()
+post_flights = SingleFlight('post')
+#  ссылки на задачи зачета просмотров, чтобы их не собрал сборщик мусора
+_crediting: set[asyncio.Task] = set()
 
 
 @post_router.get('/all', response_model=Page[PostResponseDetail])
 async def get_all_posts(manager: Annotated[PostManager, Depends()],
                         post_filter: Annotated[PostFilter, FilterDepends(PostFilter)],
                         author: Annotated[str, None] = None,
-                        order_by: Annotated[str, None] = None):
-    posts = await manager.get_all_posts(author, order_by, post_filter)
+                        order_by: Annotated[str, None] = None,
+                        cursor: Annotated[str, None] = None):
+    posts = await manager.get_all_posts(author, order_by, post_filter, cursor)
     if posts is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post does not exist')
     return posts
 
 
+@post_router.get("/autocomplete", response_model=list[AutocompleteResponse])
+async def autocomplete_posts(prefix: Annotated[str, Query(min_length=1)],
+                             limit: Annotated[int, Query(ge=1, le=settings.AUTOCOMPLETE_MAX_LIMIT)] = 10):
+    return suggest(autocomplete.posts, prefix, limit)
+
+
+async def _load_post(post_id: UUID) -> str | None:
+    async with unit_of_work() as session:
+        post = await PostManager(session).add_view(post_id)
+        body = None if post is None else PostResponseDetail.model_validate(post).model_dump_json()
+    return body
+
+
+async def _add_views(post_id: UUID, count: int) -> None:
+    try:
+        async with unit_of_work() as session:
+            await PostManager(session).add_views(post_id, count)
+    except Exception:
+        logger.exception('Crediting %d views of post %s failed', count, post_id)
+
+
+def _credit_followers(post_id: UUID, flight, task: asyncio.Task) -> None:
+    """Просмотры присоединившихся запросов засчитываются одним обновлением после загрузки, в своей задаче:
+    отмена запроса, начавшего загрузку, их не теряет"""
+    if task.cancelled() or task.exception() is not None or task.result() is None or not flight.followers:
+        return
+    #  пустой контекст: у зачета нет дедлайна запроса
+    credit = asyncio.get_running_loop().create_task(_add_views(post_id, flight.followers), name='credit-views',
+                                                    context=contextvars.Context())
+    _crediting.add(credit)
+    credit.add_done_callback(_crediting.discard)
+
+
 @post_router.get('/{post_id}', response_model=PostResponseDetail)
-async def get_post(post_id: UUID, manager: Annotated[PostManager, Depends()]):
-    post = await manager.get_post(post_id)
+async def get_post(post_id: UUID, request: Request):
+    flight, leader = post_flights.join(post_id, lambda: _load_post(post_id))
+    if leader:
+        #  вызывается после того, как загрузка снята с учета, число присоединившихся уже не изменится
+        flight.task.add_done_callback(lambda task: _credit_followers(post_id, flight, task))
+    body = await flight.wait()
+    if body is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post does not exist')
+    unique_views.record(post_id, viewer_key(request))
+    return Response(body, media_type='application/json')
+
+
+@post_router.get('/{post_id}/views', response_model=PostViewsResponse)
+async def get_post_views(post_id: UUID, manager: Annotated[PostManager, Depends()]):
+    counts = await manager.get_view_counts(post_id)
+    if counts is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post does not exist')
+    sketch = HyperLogLog.from_bytes(counts.viewers_hll) if counts.viewers_hll else HyperLogLog(unique_views.precision)
+    pending = unique_views.pending(post_id)
+    if pending is not None:
+        sketch.merge(pending)
+    return {'post_id': post_id, 'views': counts.views or 0, 'unique_viewers': sketch.count()}
+
+
+@post_router.get('/{post_id}/related', response_model=list[RelatedPostResponse])
+async def get_related_posts(post_id: UUID, manager: Annotated[PostManager, Depends()],
+                            limit: Annotated[int, Query(ge=1, le=settings.RELATED_MAX_LIMIT)] = 10):
+    post = await manager.get_post_text(post_id)
     if post is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post does not exist')
-    post = await manager.change_views(post.views + 1, post_id)
-    return post
+    #  кандидатов с запасом: среди них могут быть снятые с публикации и удаленные посты
+    similar = related_posts.similar(post_id, post.title, post.body, settings.RELATED_NEIGHBOURS)
+    posts = {row.id: row for row in await manager.get_posts_by_ids([related_id for related_id, _ in similar])}
+    return [{**posts[related_id]._mapping, 'score': score} for related_id, score in similar
+            if related_id in posts][:limit]
 
 
-@post_router.post('/', response_model=PostResponse)
+@post_router.post('/', response_model=PostResponse, dependencies=[Depends(create_post_limit)])
 @requires(['authenticated'])
 async def create_post(body: PostCreate, request: Request,
                       manager: Annotated[Permissions, Depends()]):
@@ -49,10 +132,12 @@ async def create_post(body: PostCreate, request: Request,
 @requires(['authenticated'])
 async def update_post(body: PostUpdate, request: Request, post_id: UUID,
                       manager: Annotated[Permissions, Depends()]):
-    await manager.update_or_delete_post_permission(post_id=post_id, user=request.user)
     if body.is_empty():
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Set the required fields')
-    return await manager.post_manager.update_post(post_id, body.clear())
+    post = await manager.post_manager.update_post(post_id, body.clear(), author_id=request.user.id)
+    if post is None:
+        await manager.post_write_denied(post_id)
+    return post
 
 
 @post_router.delete("/{post_id}")
@@ -60,13 +145,47 @@ async def update_post(body: PostUpdate, request: Request, post_id: UUID,
 async def delete_post(post_id: UUID, request: Request,
                       manager: Annotated[PostManager, Depends()],
                       permission: Permissions = Depends(Permissions)):
-    await permission.update_or_delete_post_permission(post_id=post_id, user=request.user)
-    deleted_post_id = await manager.delete_post(post_id)
-    return {'id': deleted_post_id}
+    job = await manager.delete_post(post_id, author_id=request.user.id)
+    if job is None:
+        await permission.post_write_denied(post_id)
+    return {'id': post_id, 'job_id': job.id}
 
 
-@post_router.patch("/{post_id}/like_button", response_model=PostResponseDetail)
+@post_router.patch("/{post_id}/like_button", response_model=PostResponseDetail, dependencies=[Depends(like_limit)])
 @requires(['authenticated'])
 async def add_or_remove_like(post_id: UUID, request: Request,
                              manager: Annotated[PostManager, Depends()]):
     return await manager.set_or_remove_like(post_id=post_id, user_id=request.user.id)
+
+
+async def _post_shard(post_id: UUID) -> str | None:
+    """Шард поста, None - поста нет"""
+    #  отдельная короткая сессия: зависимость с транзакцией держала бы соединение, пока открыт поток
+    async with unit_of_work(read_only=True) as session:
+        if not await PostManager(session).post_exists(post_id):
+            return None
+    return await locate('posts', post_id)
+
+
+@post_router.get("/{post_id}/events")
+async def post_events_stream(post_id: UUID):
+    shard = await _post_shard(post_id)
+    if shard is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post does not exist')
+    if not post_events.listening(shard):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Events are not available yet')
+    return StreamingResponse(sse_stream(post_id, shard, settings.EVENTS_HEARTBEAT), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@post_router.websocket("/{post_id}/ws")
+async def post_events_socket(websocket: WebSocket, post_id: UUID):
+    shard = await _post_shard(post_id)
+    if shard is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not post_events.listening(shard):
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    await websocket.accept()
+    await websocket_stream(websocket, post_id, shard)
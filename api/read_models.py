@@ -0,0 +1,145 @@
+"""Модели чтения для списков: только нужные колонки в объекты со __slots__, без identity map.
+
+Загрузка сущностей для /users/all, /blogs/all и /posts/all тянула каскад selectin-связей каждой строки
+и отслеживание изменений, которые схемам ответа не нужны. Здесь одна выборка колонок на страницу
+и по одному запросу на каждый вложенный список, строки собираются в DTO, которые схемы
+принимают через from_attributes.
+"""
+import asyncio
+from typing import Sequence
+from uuid import UUID
+
+from sqlalchemy import Row, Select, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from api.models import User, Blog, BlogAuthors, Post, Likes
+from database import all_shard_sessions
+
+
+class UserRow:
+    __slots__ = ('id', 'name', 'email', 'is_active')
+
+    def __init__(self, id: UUID, name: str, email: str, is_active: bool):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.is_active = is_active
+
+
+class UserDetailRow(UserRow):
+    __slots__ = ('owner_blogs', 'author_blogs')
+
+    def __init__(self, id: UUID, name: str, email: str, is_active: bool):
+        super().__init__(id, name, email, is_active)
+        self.owner_blogs = []
+        self.author_blogs = []
+
+
+class BlogRow:
+    __slots__ = ('id', 'title', 'description', 'created_at', 'updated_at')
+
+    def __init__(self, id, title, description, created_at, updated_at):
+        self.id = id
+        self.title = title
+        self.description = description
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+
+class BlogDetailRow(BlogRow):
+    __slots__ = ('owner', 'authors')
+
+    def __init__(self, id, title, description, created_at, updated_at, owner: UserRow):
+        super().__init__(id, title, description, created_at, updated_at)
+        self.owner = owner
+        self.authors = []
+
+
+class PostRow:
+    __slots__ = ('id', 'title', 'body', 'author_id', 'blog_id', 'is_published', 'created_at', 'views', 'likes',
+                 'author', 'blog')
+
+    def __init__(self, id, title, body, author_id, blog_id, is_published, created_at, views, likes: int,
+                 author: UserRow, blog: BlogRow):
+        self.id = id
+        self.title = title
+        self.body = body
+        self.author_id = author_id
+        self.blog_id = blog_id
+        self.is_published = is_published
+        self.created_at = created_at
+        self.views = views
+        self.likes = likes
+        self.author = author
+        self.blog = blog
+
+
+#  владелец блога и автор поста присоединяются под псевдонимами, чтобы фильтры по User в EXISTS
+#  (Blog.authors.any(...)) не коррелировали с внешним запросом
+blog_owner = aliased(User, name='owner')
+post_author = aliased(User, name='author')
+
+_USER_COLUMNS = (User.id, User.name, User.email, User.is_active)
+_BLOG_COLUMNS = (Blog.id, Blog.title, Blog.description, Blog.created_at, Blog.updated_at)
+_OWNER_COLUMNS = tuple(getattr(blog_owner, column.key).label(f'owner_{column.key}') for column in _USER_COLUMNS)
+_AUTHOR_COLUMNS = tuple(getattr(post_author, column.key).label(f'author_{column.key}') for column in _USER_COLUMNS)
+_POST_BLOG_COLUMNS = tuple(column.label(f'blog_{column.key}') for column in _BLOG_COLUMNS)
+_LIKES = select(func.count()).where(Likes.post_id == Post.id).scalar_subquery().label('likes')
+_POST_COLUMNS = (Post.id, Post.title, Post.body, Post.author_id, Post.blog_id, Post.is_published, Post.created_at,
+                 Post.views, _LIKES)
+
+_BLOG_END = len(_BLOG_COLUMNS)
+_POST_END = len(_POST_COLUMNS)
+_POST_AUTHOR_END = _POST_END + len(_AUTHOR_COLUMNS)
+
+
+def users_statement() -> Select:
+    return select(*_USER_COLUMNS)
+
+
+def blogs_statement() -> Select:
+    return select(*_BLOG_COLUMNS, *_OWNER_COLUMNS).join(blog_owner, blog_owner.id == Blog.owner_id)
+
+
+def posts_statement() -> Select:
+    return select(*_POST_COLUMNS, *_AUTHOR_COLUMNS, *_POST_BLOG_COLUMNS).\
+        join(post_author, post_author.id == Post.author_id).join(Blog, Blog.id == Post.blog_id)
+
+
+async def _load_user_blogs(session: AsyncSession, users: dict[UUID, UserDetailRow]) -> None:
+    owned = await session.execute(select(Blog.owner_id, *_BLOG_COLUMNS).where(Blog.owner_id.in_(users)))
+    for row in owned:
+        users[row[0]].owner_blogs.append(BlogRow(*row[1:]))
+    authored = await session.execute(select(BlogAuthors.author_id, *_BLOG_COLUMNS).
+                                     join(Blog, Blog.id == BlogAuthors.blog_id).
+                                     where(BlogAuthors.author_id.in_(users)))
+    for row in authored:
+        users[row[0]].author_blogs.append(BlogRow(*row[1:]))
+
+
+async def load_users(session: AsyncSession, rows: Sequence[Row]) -> list[UserDetailRow]:
+    """Пользователи из глобальной базы, их блоги - со всех шардов"""
+    users = {row[0]: UserDetailRow(*row) for row in rows}
+    if not users:
+        return []
+    await asyncio.gather(*(_load_user_blogs(shard, users) for shard in await all_shard_sessions(session)))
+    return list(users.values())
+
+
+async def load_blogs(session: AsyncSession, rows: Sequence[Row]) -> list[BlogDetailRow]:
+    blogs = {row[0]: BlogDetailRow(*row[:_BLOG_END], owner=UserRow(*row[_BLOG_END:])) for row in rows}
+    if not blogs:
+        return []
+    authors = await session.execute(select(BlogAuthors.blog_id, *_USER_COLUMNS).
+                                    join(User, User.id == BlogAuthors.author_id).
+                                    where(BlogAuthors.blog_id.in_(blogs)))
+    for row in authors:
+        blogs[row[0]].authors.append(UserRow(*row[1:]))
+    return list(blogs.values())
+
+
+async def load_posts(session: AsyncSession, rows: Sequence[Row]) -> list[PostRow]:
+    return [PostRow(*row[:_POST_END], author=UserRow(*row[_POST_END:_POST_AUTHOR_END]),
+                    blog=BlogRow(*row[_POST_AUTHOR_END:]))
+            for row in rows]
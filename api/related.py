@@ -0,0 +1,409 @@
+"""Похожие посты по содержанию: TF-IDF на хешированных признаках заголовка и текста.
+
+Индекс строится офлайн командой
+
+    python -m api.related build
+
+в новую версию внутри RELATED_INDEX_DIR: нормированные векторы постов, они же по признакам (списки постов
+для поиска) и ближайшие соседи каждого поста, посчитанные пакетами. Файлы открываются через
+np.load(mmap_mode='r'), поэтому все воркеры делят одну копию в page cache. Посты, созданные или измененные
+после сборки, воркер держит в памяти до следующей версии, узнавая о них из событий post_events.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import zlib
+from uuid import UUID
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+
+import settings
+from api.models import Post
+from database import shard_sessionmakers, dispose_engines
+from events import post_events
+from metrics import registry
+from sharding import locate_many
+
+logger = logging.getLogger('related')
+
+TOKEN = re.compile(r'\w{2,}')
+CURRENT = 'CURRENT'
+#  на небольших наборах частые слова не отсекаются: доля RELATED_MAX_DF там - единицы постов
+MIN_PRUNED_POSTS = 1000
+#  сколько версий оставлять: воркеры переходят на новую не сразу, а с интервалом перезагрузки
+KEEP_VERSIONS = 2
+
+query_seconds = registry.histogram('related_query_seconds', 'Time spent ranking related posts', ('source',),
+                                   buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+
+def features(title: str, body: str | None) -> tuple[np.ndarray, np.ndarray]:
+    """Номера признаков и частоты 1 + log(n), слова заголовка считаются RELATED_TITLE_WEIGHT раз"""
+    mask = (1 << settings.RELATED_FEATURE_BITS) - 1
+    hashes = [zlib.crc32(token.encode()) & mask for token in TOKEN.findall(title.lower())]
+    hashes *= settings.RELATED_TITLE_WEIGHT
+    hashes += [zlib.crc32(token.encode()) & mask for token in TOKEN.findall((body or '').lower())]
+    indices, counts = np.unique(np.array(hashes, dtype=np.int32), return_counts=True)
+    return indices, (1 + np.log(counts)).astype(np.float32)
+
+
+def weigh(indices: np.ndarray, tf: np.ndarray, idf: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    values = tf * idf[indices]
+    keep = values > 0
+    indices, values = indices[keep], values[keep]
+    norm = np.linalg.norm(values)
+    return (indices, values / norm) if norm else (indices, values)
+
+
+def _row(indices: np.ndarray, values: np.ndarray, width: int) -> sparse.csr_matrix:
+    return sparse.csr_matrix((values, indices, np.array([0, len(indices)])), shape=(1, width))
+
+
+def _top_terms(indices: np.ndarray, values: np.ndarray, terms: int) -> tuple[np.ndarray, np.ndarray]:
+    """terms самых весомых признаков вектора: списки постов по ним и дают кандидатов"""
+    if len(indices) <= terms:
+        return indices, values
+    top = np.sort(np.argpartition(-values, terms)[:terms])
+    return indices[top], values[top]
+
+
+def _search(postings: sparse.csr_matrix, indices: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Строки с ненулевой близостью к вектору и сама близость. Читаются только списки постов по признакам
+    вектора, без рабочих массивов размером со всю матрицу, как при умножении в scipy"""
+    starts, ends = postings.indptr[indices], postings.indptr[indices + 1]
+    if not len(indices) or not (ends - starts).any():
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    rows = np.concatenate([postings.indices[start:end] for start, end in zip(starts, ends)])
+    weights = np.concatenate([postings.data[start:end] * value for start, end, value in zip(starts, ends, values)])
+    rows, positions = np.unique(rows, return_inverse=True)
+    return rows, np.bincount(positions, weights=weights)
+
+
+def _top(values: np.ndarray, count: int) -> np.ndarray:
+    top = np.argpartition(-values, count)[:count] if len(values) > count else np.arange(len(values))
+    return top[np.argsort(-values[top], kind='stable')]
+
+
+def _tf_idf(counts: sparse.csr_matrix) -> tuple[sparse.csr_matrix, np.ndarray]:
+    posts = counts.shape[0]
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = (np.log((1 + posts) / (1 + df)) + 1).astype(np.float32)
+    if posts >= MIN_PRUNED_POSTS:
+        #  слова из большой доли постов почти не различают их, а списки постов по ним самые длинные
+        idf[df > settings.RELATED_MAX_DF * posts] = 0
+    vectors = counts.copy()
+    vectors.data *= idf[vectors.indices]
+    vectors.eliminate_zeros()
+    rows = np.repeat(np.arange(posts), np.diff(vectors.indptr))
+    norms = np.sqrt(np.bincount(rows, weights=vectors.data ** 2, minlength=posts)).astype(np.float32)
+    vectors.data /= norms[rows]
+    return vectors, idf
+
+
+def _changed_postings(changed: list[tuple[UUID, tuple]], idf: np.ndarray,
+                      width: int) -> tuple[list[UUID], sparse.csr_matrix]:
+    """Измененные посты и списки их по признакам"""
+    rows = [_row(*weigh(indices, tf, idf), width) for _, (_, indices, tf) in changed]
+    matrix = sparse.vstack(rows, format='csr') if rows else sparse.csr_matrix((0, width), dtype=np.float32)
+    return [post_id for post_id, _ in changed], matrix.T.tocsr()
+
+
+def _neighbours(vectors: sparse.csr_matrix, postings: sparse.csr_matrix) -> tuple[np.ndarray, np.ndarray]:
+    """Ближайшие соседи всех постов: пакет строк умножается на списки постов по признакам"""
+    posts, count = vectors.shape[0], settings.RELATED_NEIGHBOURS
+    neighbours = np.full((posts, count), -1, dtype=np.int32)
+    scores = np.zeros((posts, count), dtype=np.float32)
+    queries = sparse.vstack([_row(*_top_terms(vectors.indices[start:end], vectors.data[start:end],
+                                              settings.RELATED_QUERY_TERMS), vectors.shape[1])
+                             for start, end in zip(vectors.indptr[:-1], vectors.indptr[1:])],
+                            format='csr') if posts else vectors
+    for start in range(0, posts, settings.RELATED_BUILD_BATCH):
+        similar = (queries[start:start + settings.RELATED_BUILD_BATCH] @ postings).tocsr()
+        for offset in range(similar.shape[0]):
+            row = start + offset
+            columns = similar.indices[similar.indptr[offset]:similar.indptr[offset + 1]]
+            values = similar.data[similar.indptr[offset]:similar.indptr[offset + 1]]
+            keep = columns != row
+            columns, values = columns[keep], values[keep]
+            top = _top(values, count)
+            neighbours[row, :len(top)] = columns[top]
+            scores[row, :len(top)] = values[top]
+    return neighbours, scores
+
+
+class IndexBuilder:
+    """Частоты признаков постов по мере чтения, запись новой версии индекса"""
+
+    CHUNK = 10_000
+
+    def __init__(self):
+        #  посты, измененные после этого момента, воркеры оставят у себя в памяти
+        self.started = time.time()
+        self._ids: list[bytes] = []
+        self._chunks: list[tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._indices, self._tf, self._lengths = [], [], []
+
+    def add(self, post_id: UUID, title: str, body: str | None) -> None:
+        indices, tf = features(title, body)
+        self._ids.append(post_id.bytes)
+        self._indices.append(indices)
+        self._tf.append(tf)
+        self._lengths.append(len(indices))
+        if len(self._lengths) >= self.CHUNK:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._lengths:
+            self._chunks.append((np.concatenate(self._indices), np.concatenate(self._tf),
+                                 np.array(self._lengths, dtype=np.int64)))
+            self._indices, self._tf, self._lengths = [], [], []
+
+    def write(self, directory: str) -> str:
+        """Считает векторы и соседей, сохраняет версию и делает ее текущей, возвращает имя версии"""
+        self._flush()
+        width = 1 << settings.RELATED_FEATURE_BITS
+        ids = np.array(self._ids, dtype='S16')
+        indices = np.concatenate([chunk[0] for chunk in self._chunks] or [np.zeros(0, np.int32)])
+        tf = np.concatenate([chunk[1] for chunk in self._chunks] or [np.zeros(0, np.float32)])
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate([chunk[2] for chunk in self._chunks] or [np.zeros(0, np.int64)]), out=indptr[1:])
+        counts = sparse.csr_matrix((tf, indices, indptr), shape=(len(ids), width))
+        self._chunks = []
+        #  поиск строки поста - двоичный поиск по отсортированным id
+        order = np.argsort(ids, kind='stable')
+        ids, counts = ids[order], counts[order]
+
+        vectors, idf = _tf_idf(counts)
+        postings = vectors.T.tocsr()
+        neighbours, scores = _neighbours(vectors, postings)
+
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+        path = os.path.join(directory, name)
+        os.makedirs(path)
+        arrays = {'ids': ids, 'idf': idf, 'data': vectors.data, 'indices': vectors.indices, 'indptr': vectors.indptr,
+                  'postings_data': postings.data, 'postings_indices': postings.indices,
+                  'postings_indptr': postings.indptr, 'neighbours': neighbours, 'scores': scores}
+        for array_name, array in arrays.items():
+            np.save(os.path.join(path, f'{array_name}.npy'), array)
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump({'posts': len(ids), 'feature_bits': settings.RELATED_FEATURE_BITS,
+                       'built_at': self.started}, file)
+
+        current = os.path.join(directory, CURRENT)
+        with open(f'{current}.tmp', 'w') as file:
+            file.write(name)
+        os.replace(f'{current}.tmp', current)
+        versions = sorted(entry for entry in os.listdir(directory) if os.path.isdir(os.path.join(directory, entry)))
+        for old in versions[:-KEEP_VERSIONS]:
+            shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+        return name
+
+
+class IndexVersion:
+    """Версия индекса, отображенная в память"""
+
+    def __init__(self, directory: str, name: str):
+        path = os.path.join(directory, name)
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+
+        def load(array_name: str) -> np.ndarray:
+            return np.load(os.path.join(path, f'{array_name}.npy'), mmap_mode='r')
+
+        self.name = name
+        self.built_at = meta['built_at']
+        self.width = 1 << meta['feature_bits']
+        self.ids = load('ids')
+        self.idf = load('idf')
+        posts = len(self.ids)
+        self.vectors = sparse.csr_matrix((load('data'), load('indices'), load('indptr')), shape=(posts, self.width),
+                                         copy=False)
+        self.postings = sparse.csr_matrix((load('postings_data'), load('postings_indices'), load('postings_indptr')),
+                                          shape=(self.width, posts), copy=False)
+        self.neighbours = load('neighbours')
+        self.scores = load('scores')
+
+    def row(self, post_id: UUID) -> int | None:
+        key = np.bytes_(post_id.bytes)
+        row = int(np.searchsorted(self.ids, key))
+        return row if row < len(self.ids) and self.ids[row] == key else None
+
+    def post_id(self, row: int) -> UUID:
+        #  numpy отбрасывает нулевые байты в конце элементов S16
+        return UUID(bytes=bytes(self.ids[row]).ljust(16, b'\0'))
+
+
+class RelatedPosts:
+    """Текущая версия индекса и посты, измененные после ее сборки, в памяти воркера"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.version: IndexVersion | None = None
+        self._changed: dict[UUID, tuple[float, np.ndarray, np.ndarray]] = {}
+        #  собираются в задаче обновления после изменений, запросы только читают готовые
+        self._changed_vectors = _changed_postings([], np.zeros(0, dtype=np.float32),
+                                                  1 << settings.RELATED_FEATURE_BITS)
+        self._changed_stale = False
+        self._pending: set[UUID] = set()
+        self._refresh_requested = asyncio.Event()
+
+    def indexed_count(self) -> int:
+        return 0 if self.version is None else len(self.version.ids)
+
+    def changed_count(self) -> int:
+        return len(self._changed)
+
+    def reload(self) -> bool:
+        """Переходит на текущую версию из каталога, если она сменилась"""
+        try:
+            with open(os.path.join(self.directory, CURRENT)) as file:
+                name = file.read().strip()
+        except FileNotFoundError:
+            return False
+        if self.version is not None and self.version.name == name:
+            return False
+        version = IndexVersion(self.directory, name)
+        if version.width != 1 << settings.RELATED_FEATURE_BITS:
+            logger.warning('Related posts index %s was built with other RELATED_FEATURE_BITS, skipped', name)
+            return False
+        self.version = version
+        self._changed = {post_id: change for post_id, change in self._changed.items() if change[0] > version.built_at}
+        self._changed_stale = True
+        logger.info('Related posts index %s loaded, %d posts', name, len(version.ids))
+        return True
+
+    def content_changed(self, event: dict) -> None:
+        if event.get('event') in ('created', 'updated'):
+            self._pending.add(UUID(event['post_id']))
+            self._refresh_requested.set()
+
+    def _remember(self, post_id: UUID, title: str, body: str | None) -> None:
+        self._changed[post_id] = (time.time(), *features(title, body))
+        self._changed_stale = True
+
+    async def refresh_pending(self) -> None:
+        pending, self._pending = self._pending, set()
+        if not pending:
+            return
+        try:
+            for shard, post_ids in (await locate_many('posts', pending)).items():
+                async with shard_sessionmakers[shard]() as session:
+                    rows = await session.execute(select(Post.id, Post.title, Post.body).where(Post.id.in_(post_ids)))
+                    for post_id, title, body in rows:
+                        self._remember(post_id, title, body)
+        except Exception:
+            self._pending |= pending
+            raise
+
+    async def catch_up(self) -> None:
+        """Посты, созданные после сборки версии. Изменения старых постов, сделанные до старта воркера,
+        появятся только в следующей версии"""
+        built_at = datetime.datetime.fromtimestamp(self.version.built_at)
+        for sessionmaker in shard_sessionmakers.values():
+            async with sessionmaker() as session:
+                rows = await session.execute(select(Post.id, Post.title, Post.body).where(Post.created_at > built_at))
+                for post_id, title, body in rows:
+                    self._remember(post_id, title, body)
+
+    async def rebuild_changed(self) -> None:
+        """Пересобирает списки измененных постов в потоке, по idf текущей версии"""
+        if not self._changed_stale:
+            return
+        self._changed_stale = False
+        width = 1 << settings.RELATED_FEATURE_BITS
+        idf = np.ones(width, dtype=np.float32) if self.version is None else self.version.idf
+        self._changed_vectors = await asyncio.to_thread(_changed_postings, list(self._changed.items()), idf, width)
+
+    def similar(self, post_id: UUID, title: str, body: str | None, count: int) -> list[tuple[UUID, float]]:
+        """До count похожих постов с косинусной близостью, по убыванию"""
+        started = time.perf_counter()
+        version = self.version
+        width = 1 << settings.RELATED_FEATURE_BITS
+        idf = np.ones(width, dtype=np.float32) if version is None else version.idf
+        row = None if version is None or post_id in self._changed else version.row(post_id)
+        candidates: dict[UUID, float] = {}
+        if row is not None:
+            source = 'precomputed'
+            start, end = version.vectors.indptr[row], version.vectors.indptr[row + 1]
+            indices, values = version.vectors.indices[start:end], version.vectors.data[start:end]
+            for neighbour, score in zip(version.neighbours[row], version.scores[row]):
+                if neighbour < 0:
+                    break
+                candidates[version.post_id(neighbour)] = float(score)
+        else:
+            source = 'search'
+            change = self._changed.get(post_id)
+            indices, values = weigh(*(change[1:] if change else features(title, body)), idf)
+            if version is not None:
+                rows, scores = _search(version.postings, *_top_terms(indices, values, settings.RELATED_QUERY_TERMS))
+                for top in _top(scores, count):
+                    candidates[version.post_id(rows[top])] = float(scores[top])
+
+        #  у измененных постов оценки из версии устарели, они пересчитываются по новым векторам
+        changed_ids, changed = self._changed_vectors
+        for changed_id in changed_ids:
+            candidates.pop(changed_id, None)
+        for changed_row, score in zip(*_search(changed, indices, values)):
+            candidates[changed_ids[changed_row]] = float(score)
+        candidates.pop(post_id, None)
+        ranked = sorted(candidates.items(), key=lambda item: item[1], reverse=True)[:count]
+        query_seconds.labels(source).observe(time.perf_counter() - started)
+        return ranked
+
+    async def run(self, interval: float) -> None:
+        while True:
+            try:
+                if self.reload():
+                    await self.catch_up()
+                await self.refresh_pending()
+                await self.rebuild_changed()
+            except Exception:
+                logger.exception('Related posts index refresh failed')
+            try:
+                await asyncio.wait_for(self._refresh_requested.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._refresh_requested.clear()
+
+
+related_posts = RelatedPosts(settings.RELATED_INDEX_DIR)
+registry.gauge_callback('related_index_posts', 'Posts in the loaded related posts index', related_posts.indexed_count,
+                        aggregate='max')
+registry.gauge_callback('related_index_changed_posts', 'Posts changed since the index was built',
+                        related_posts.changed_count, aggregate='max')
+
+
+async def maintain_related_index() -> None:
+    post_events.add_listener(related_posts.content_changed)
+    await related_posts.run(settings.RELATED_RELOAD_INTERVAL)
+
+
+async def build_from_database(directory: str) -> str:
+    builder = IndexBuilder()
+    #  индекс общий для всех шардов: похожими могут быть посты разных блогов
+    for sessionmaker in shard_sessionmakers.values():
+        async with sessionmaker() as session:
+            result = await session.stream(select(Post.id, Post.title, Post.body).execution_options(yield_per=5000))
+            async for post_id, title, body in result:
+                builder.add(post_id, title, body)
+    await dispose_engines()
+    return builder.write(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Related posts index')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--directory', default=settings.RELATED_INDEX_DIR)
+    arguments = parser.parse_args()
+    os.makedirs(arguments.directory, exist_ok=True)
+    started = time.perf_counter()
+    version = asyncio.run(build_from_database(arguments.directory))
+    print(f'built {version} in {time.perf_counter() - started:.1f}s')
@@ -4,7 +4,7 @@ from enum import Enum
 from typing import Optional, List
 
 from fastapi import HTTPException
-from pydantic import BaseModel, EmailStr, constr, Field, field_serializer
+from pydantic import BaseModel, EmailStr, constr, Field, field_validator
 from starlette import status
 
 from api.models import Post, User
@@ -130,13 +130,15 @@ class PostResponse(TunedModel):
 
 class PostResponseDetail(PostResponse):
     """Используется при получении поста"""
-    likes: List[UserResponse] = []
+    likes: int = 0
     author: UserResponse
     blog: BlogResponse
 
-    @field_serializer('likes')
-    def serialize_likes(self, likes):
-        return len(likes)
+    @field_validator('likes', mode='before')
+    @classmethod
+    def count_likes(cls, likes):
+        #  сущность отдает список лайкнувших, модель чтения - готовое число
+        return len(likes) if isinstance(likes, list) else likes
 
 
 class CommentUpdate(TunedModel, UpdateMixin):
@@ -152,3 +154,87 @@ class CommentCreate(CommentUpdate):
 class CommentResponseDetail(CommentResponse):
     posts: PostResponseDetail
     authors: UserResponse
+
+
+class RelatedPostResponse(PostResponse):
+    """Используется при получении похожих постов"""
+    score: float
+
+
+class AutocompleteResponse(BaseModel):
+    """Используется в подсказках по началу имени или названия"""
+    id: uuid.UUID
+    text: str
+
+
+class PostViewsResponse(BaseModel):
+    """Используется при получении просмотров поста"""
+    post_id: uuid.UUID
+    views: int
+    unique_viewers: int
+
+
+class StatsResponse(TunedModel):
+    """Общая часть счетчиков пользователя и блога"""
+    posts_count: int
+    views_count: int
+    likes_count: int
+    comments_count: int
+
+
+class UserStatsResponse(StatsResponse):
+    """Используется при получении статистики пользователя"""
+    user_id: uuid.UUID
+
+
+class BlogStatsResponse(StatsResponse):
+    """Используется при получении статистики блога"""
+    blog_id: uuid.UUID
+
+
+class AnalyticsPeriod(str, Enum):
+    hour = 'hour'
+    day = 'day'
+    week = 'week'
+    month = 'month'
+
+
+class EngagementCounts(BaseModel):
+    """Просмотры, лайки и комментарии за интервал"""
+    views: int = 0
+    likes: int = 0
+    comments: int = 0
+
+
+class EngagementBucket(EngagementCounts):
+    bucket: datetime
+
+
+class BlogAnalyticsResponse(BaseModel):
+    """Используется при получении аналитики блога"""
+    blog_id: uuid.UUID
+    post_id: uuid.UUID | None
+    period: AnalyticsPeriod
+    start: datetime
+    end: datetime
+    total: EngagementCounts
+    buckets: list[EngagementBucket]
+
+
+class JobResponse(TunedModel):
+    """Используется при получении состояния задачи удаления"""
+    id: uuid.UUID
+    entity: str
+    entity_id: uuid.UUID
+    status: str
+    deleted_rows: int
+    error: str | None
+    created_at: datetime
+    updated_at: datetime
+
+
+class ProfilerStart(BaseModel):
+    """Используется при включении профайлера"""
+    routes: List[str]
+    sample_rate: float = Field(default=0.1, gt=0, le=1)
+    interval_ms: float = Field(default=5, ge=1, le=1000)
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+import settings
+from database import shard_engines, shard_sessionmakers
+
+logger = logging.getLogger('stats')
+
+COUNTERS = ('posts_count', 'views_count', 'likes_count', 'comments_count')
+
+_UPSERT = '''
+WITH target AS ({source}),
+user_row AS (
+    INSERT INTO user_stats AS s (user_id, posts_count, views_count, likes_count, comments_count)
+    SELECT author_id, :posts, :views, :likes, :comments FROM target
+    ON CONFLICT (user_id) DO UPDATE SET {increments}
+)
+INSERT INTO blog_stats AS s (blog_id, posts_count, views_count, likes_count, comments_count)
+SELECT blog_id, :posts, :views, :likes, :comments FROM target
+ON CONFLICT (blog_id) DO UPDATE SET {increments}
+'''
+_INCREMENTS = ', '.join(f'{name} = s.{name} + excluded.{name}' for name in COUNTERS)
+
+#  счетчики поста по автору и блогу, когда сам пост еще существует
+_BY_POST = text(_UPSERT.format(source='SELECT author_id, blog_id FROM posts WHERE id = :post_id AND NOT is_deleted',
+                               increments=_INCREMENTS))
+#  автор и блог уже известны, например из RETURNING удаленного поста
+_BY_OWNER = text(_UPSERT.format(source='SELECT CAST(:author_id AS UUID) AS author_id, '
+                                       'CAST(:blog_id AS UUID) AS blog_id',
+                                increments=_INCREMENTS))
+
+#  просмотры постов из буфера вовлеченности: одна строка на автора и блог за сброс вместо трех на каждый просмотр.
+#  удаленные посты тоже считаются - при удалении из счетчиков вычтены posts.views вместе с еще не сброшенными;
+#  строки скрытого блога удалятся вместе с ним. Порядок строк один у всех сбросов, взаимоблокировок нет.
+#  Сверка между просмотром и сбросом уже берет его из posts.views, и до следующей сверки он учтен дважды
+_VIEWS = text('''
+WITH counted AS (
+    SELECT p.author_id, p.blog_id, b.is_deleted AS blog_deleted, v.views
+    FROM unnest(CAST(:post_ids AS uuid[]), CAST(:views AS integer[])) AS v(post_id, views)
+    JOIN posts p ON p.id = v.post_id
+    JOIN blogs b ON b.id = p.blog_id
+),
+user_rows AS (
+    INSERT INTO user_stats AS s (user_id, posts_count, views_count, likes_count, comments_count)
+    SELECT author_id, 0, sum(views), 0, 0 FROM counted GROUP BY author_id ORDER BY author_id
+    ON CONFLICT (user_id) DO UPDATE SET views_count = s.views_count + excluded.views_count
+)
+INSERT INTO blog_stats AS s (blog_id, posts_count, views_count, likes_count, comments_count)
+SELECT blog_id, 0, sum(views), 0, 0 FROM counted WHERE NOT blog_deleted GROUP BY blog_id ORDER BY blog_id
+ON CONFLICT (blog_id) DO UPDATE SET views_count = s.views_count + excluded.views_count
+''')
+
+_POST_TOTALS = '''
+    SELECT p.id, p.author_id, p.blog_id, COALESCE(p.views, 0) AS views,
+           (SELECT count(*) FROM likes WHERE likes.post_id = p.id) AS likes,
+           (SELECT count(*) FROM comments WHERE comments.post_id = p.id) AS comments
+    FROM posts p
+    JOIN blogs b ON b.id = p.blog_id
+    WHERE NOT p.is_deleted AND {condition}
+'''
+
+#  посты скрытого блога вычитаются из счетчиков авторов сразу, счетчики самого блога удалятся вместе с ним
+_DROP_BLOG = text('''
+UPDATE user_stats AS s
+SET posts_count = s.posts_count - totals.posts, views_count = s.views_count - totals.views,
+    likes_count = s.likes_count - totals.likes, comments_count = s.comments_count - totals.comments
+FROM (
+    SELECT author_id, count(*) AS posts, COALESCE(sum(views), 0) AS views,
+           COALESCE(sum(likes), 0) AS likes, COALESCE(sum(comments), 0) AS comments
+    FROM ({post_totals}) post_totals
+    GROUP BY author_id
+) totals
+WHERE s.user_id = totals.author_id
+'''.format(post_totals=_POST_TOTALS.format(condition='p.blog_id = :blog_id')))
+
+#  владельцы сверяются пачками по ключу. Строки счетчиков пачки сначала блокируются, и только затем
+#  отдельным запросом пересчитываются: снимок пересчета берется после коммита писателей, ждавших эти строки,
+#  поэтому их приращения не затираются, а писатели ждут не дольше одной пачки
+_RECONCILE_OWNERS = 'SELECT id FROM {owners} WHERE id > :after ORDER BY id LIMIT :batch'
+_RECONCILE_ENSURE = '''
+INSERT INTO {table} ({key}, posts_count, views_count, likes_count, comments_count)
+SELECT id, 0, 0, 0, 0 FROM unnest(CAST(:ids AS uuid[])) AS id
+ON CONFLICT ({key}) DO NOTHING
+'''
+_RECONCILE_LOCK_ROWS = 'SELECT {key} FROM {table} WHERE {key} = ANY(CAST(:ids AS uuid[])) ORDER BY {key} FOR UPDATE'
+_RECONCILE = '''
+UPDATE {table} AS s SET {assignments}
+FROM (
+    SELECT owner.id, count(totals.id) AS posts_count, COALESCE(sum(totals.views), 0) AS views_count,
+           COALESCE(sum(totals.likes), 0) AS likes_count, COALESCE(sum(totals.comments), 0) AS comments_count
+    FROM unnest(CAST(:ids AS uuid[])) AS owner(id)
+    LEFT JOIN ({post_totals}) totals ON totals.{owner_column} = owner.id
+    GROUP BY owner.id
+) recount
+WHERE s.{key} = recount.id AND ({current}) IS DISTINCT FROM ({recounted})
+'''
+
+
+def _reconcile_statements(table: str, key: str, owners: str, owner_column: str) -> tuple:
+    condition = f'NOT b.is_deleted AND p.{owner_column} = ANY(CAST(:ids AS uuid[]))'
+    return (
+        text(_RECONCILE_OWNERS.format(owners=owners)),
+        text(_RECONCILE_ENSURE.format(table=table, key=key)),
+        text(_RECONCILE_LOCK_ROWS.format(table=table, key=key)),
+        text(_RECONCILE.format(
+            table=table, key=key, owner_column=owner_column,
+            post_totals=_POST_TOTALS.format(condition=condition),
+            assignments=', '.join(f'{name} = recount.{name}' for name in COUNTERS),
+            current=', '.join(f's.{name}' for name in COUNTERS),
+            recounted=', '.join(f'recount.{name}' for name in COUNTERS),
+        )),
+    )
+
+
+_RECONCILE_USERS = _reconcile_statements('user_stats', 'user_id', 'users', 'author_id')
+_RECONCILE_BLOGS = _reconcile_statements('blog_stats', 'blog_id', 'blogs', 'blog_id')
+#  пересчет запускается в каждом воркере, но выполняет его только тот, кто первым взял блокировку
+_RECONCILE_LOCK = "hashtext('stats_reconcile')"
+_FIRST_ID = UUID(int=0)
+
+
+async def bump_post_stats(session: AsyncSession, post_id: UUID, *, posts: int = 0, views: int = 0,
+                          likes: int = 0, comments: int = 0) -> None:
+    """Прибавляет изменения к счетчикам автора поста и его блога одним запросом"""
+    await session.execute(_BY_POST, {'post_id': post_id, 'posts': posts, 'views': views,
+                                     'likes': likes, 'comments': comments})
+
+
+async def bump_owner_stats(session: AsyncSession, author_id: UUID, blog_id: UUID, *, posts: int = 0,
+                           views: int = 0, likes: int = 0, comments: int = 0) -> None:
+    await session.execute(_BY_OWNER, {'author_id': author_id, 'blog_id': blog_id, 'posts': posts,
+                                      'views': views, 'likes': likes, 'comments': comments})
+
+
+async def bump_views_stats(session: AsyncSession, views: dict[UUID, int]) -> None:
+    """Прибавляет просмотры постов к счетчикам их авторов и блогов"""
+    await session.execute(_VIEWS, {'post_ids': list(views), 'views': list(views.values())})
+
+
+async def drop_blog_stats(session: AsyncSession, blog_id: UUID) -> None:
+    await session.execute(_DROP_BLOG, {'blog_id': blog_id})
+
+
+async def _reconcile_table(sessionmaker: async_sessionmaker, statements: tuple, batch: int) -> int:
+    owners, ensure, lock, recount = statements
+    repaired, after = 0, _FIRST_ID
+    while True:
+        async with sessionmaker() as session:
+            async with session.begin():
+                ids = (await session.execute(owners, {'after': after, 'batch': batch})).scalars().all()
+                if not ids:
+                    return repaired
+                await session.execute(ensure, {'ids': ids})
+                await session.execute(lock, {'ids': ids})
+                repaired += (await session.execute(recount, {'ids': ids})).rowcount
+        after = ids[-1]
+
+
+async def reconcile_stats(shard: str, batch: int = settings.STATS_RECONCILE_BATCH) -> tuple[int, int] | None:
+    """Пересчитывает счетчики шарда по исходным таблицам и перезаписывает только разошедшиеся строки.
+    None - сверку уже выполняет другой воркер"""
+    async with shard_engines[shard].connect() as connection:
+        if not (await connection.execute(text(f'SELECT pg_try_advisory_lock({_RECONCILE_LOCK})'))).scalar():
+            return None
+        await connection.commit()
+        try:
+            sessionmaker = shard_sessionmakers[shard]
+            return (await _reconcile_table(sessionmaker, _RECONCILE_USERS, batch),
+                    await _reconcile_table(sessionmaker, _RECONCILE_BLOGS, batch))
+        finally:
+            await connection.execute(text(f'SELECT pg_advisory_unlock({_RECONCILE_LOCK})'))
+            await connection.commit()
+
+
+async def reconcile_stats_periodically(interval: float = settings.STATS_RECONCILE_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        #  на каждом шарде свои счетчики: user_stats шарда считает только посты его блогов
+        for shard in shard_sessionmakers:
+            try:
+                repaired = await reconcile_stats(shard)
+            except Exception:
+                logger.exception('Stats reconciliation failed on shard %s', shard)
+                continue
+            if repaired and any(repaired):
+                logger.warning('Stats reconciliation repaired %d user rows and %d blog rows on shard %s',
+                               *repaired, shard)
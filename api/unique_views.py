@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import logging
+from uuid import UUID
+
+from sqlalchemy import select, update, bindparam
+from starlette.requests import Request
+
+import settings
+from api.models import Post
+from database import shard_sessionmakers
+from hyperloglog import HyperLogLog
+from metrics import registry
+from ratelimit import client_ip
+from sharding import locate_many
+
+logger = logging.getLogger('unique_views')
+
+
+def viewer_key(request: Request) -> str:
+    """id пользователя, для анонимов - хеш IP и User-Agent, сами адреса нигде не сохраняются"""
+    if 'authenticated' in request.auth.scopes:
+        return f'user:{request.user.id}'
+    fingerprint = f'{client_ip(request)}|{request.headers.get("user-agent", "")}'
+    return 'anon:' + hashlib.blake2b(fingerprint.encode(), digest_size=16).hexdigest()
+
+
+class UniqueViewTracker:
+    """Скетчи просмотров с последнего сброса, по одному на пост, объединяются с сохраненными в posts.viewers_hll"""
+
+    def __init__(self, precision: int, max_pending: int):
+        self.precision = precision
+        self.max_pending = max_pending
+        self._pending: dict[UUID, HyperLogLog] = {}
+        self._flush_requested = asyncio.Event()
+
+    def record(self, post_id: UUID, viewer: str) -> None:
+        sketch = self._pending.get(post_id)
+        if sketch is None:
+            sketch = self._pending[post_id] = HyperLogLog(self.precision)
+            if len(self._pending) >= self.max_pending:
+                self._flush_requested.set()
+        sketch.add(viewer)
+
+    def pending(self, post_id: UUID) -> HyperLogLog | None:
+        return self._pending.get(post_id)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def _restore(self, pending: dict[UUID, HyperLogLog]) -> None:
+        #  не сохраненные скетчи возвращаются в очередь и попадут в следующий сброс
+        for post_id, sketch in pending.items():
+            current = self._pending.get(post_id)
+            if current is not None:
+                sketch.merge(current)
+            self._pending[post_id] = sketch
+
+    async def _flush_shard(self, shard: str, pending: dict[UUID, HyperLogLog]) -> int:
+        async with shard_sessionmakers[shard]() as session:
+            async with session.begin():
+                #  FOR UPDATE: воркеры сбрасывают скетчи одних и тех же постов, объединение не должно теряться
+                statement = select(Post.id, Post.viewers_hll).where(Post.id.in_(list(pending))).\
+                    order_by(Post.id).with_for_update()
+                rows = (await session.execute(statement)).all()
+                for post_id, stored in rows:
+                    if stored is not None:
+                        pending[post_id].merge(HyperLogLog.from_bytes(stored))
+                if rows:
+                    await session.execute(
+                        update(Post.__table__).where(Post.__table__.c.id == bindparam('post_id')).
+                        values(viewers_hll=bindparam('sketch')),
+                        [{'post_id': post_id, 'sketch': pending[post_id].to_bytes()} for post_id, _ in rows])
+        return len(rows)
+
+    async def flush(self) -> int:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            shards = await locate_many('posts', pending)
+        except Exception:
+            self._restore(pending)
+            raise
+        flushed, failure = 0, None
+        for shard, post_ids in shards.items():
+            part = {post_id: pending[post_id] for post_id in post_ids}
+            try:
+                flushed += await self._flush_shard(shard, part)
+            except Exception as error:
+                self._restore(part)
+                failure = error
+        if failure is not None:
+            raise failure
+        return flushed
+
+    async def run(self, interval: float) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Unique views flush failed')
+
+
+unique_views = UniqueViewTracker(precision=settings.UNIQUE_VIEWS_PRECISION,
+                                 max_pending=settings.UNIQUE_VIEWS_MAX_PENDING)
+registry.gauge_callback('unique_views_pending_posts', 'Posts with view sketches not yet flushed',
+                        unique_views.pending_count)
+
+
+async def flush_unique_views_periodically() -> None:
+    try:
+        await unique_views.run(settings.UNIQUE_VIEWS_FLUSH_INTERVAL)
+    finally:
+        #  при остановке воркера сохраняем накопленное
+        await unique_views.flush()
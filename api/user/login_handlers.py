@@ -7,11 +7,12 @@ from api.models import User
 from api.managers import UserManager
 from api.schemas import Token
 from auth import create_access_token, Hash
+from ratelimit import login_ip_limit, login_account_limit
 
 login_router = APIRouter()
 
 
-@login_router.post('/', response_model=Token)
+@login_router.post('/', response_model=Token, dependencies=[Depends(login_ip_limit), Depends(login_account_limit)])
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), manage: UserManager = Depends(UserManager)):
     user = await authenticate_user(form_data.username, form_data.password, manage)
     if user is None:
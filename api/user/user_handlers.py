@@ -1,17 +1,20 @@
 from typing import Annotated
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi_filter import FilterDepends
-from fastapi_pagination.links import Page
 
 from starlette import status
 from starlette.authentication import requires
 from starlette.requests import Request
 
+import settings
+from api.autocomplete import autocomplete, suggest
 from api.filters import UserFilter
-from api.managers import UserManager
-from api.schemas import UserResponseDetail, UserUpdate, UserCreate, UserResponse
+from api.managers import UserManager, StatsManager
+from api.pagination import Page
+from api.schemas import UserResponseDetail, UserUpdate, UserCreate, UserResponse, UserStatsResponse, \
+    AutocompleteResponse
 
 user_router = APIRouter()
 
@@ -22,6 +25,12 @@ async def get_all_users(manager: Annotated[UserManager, Depends()],
     return await manager.get_all_users(user_filter)
 
 
+@user_router.get("/autocomplete", response_model=list[AutocompleteResponse])
+async def autocomplete_users(prefix: Annotated[str, Query(min_length=1)],
+                             limit: Annotated[int, Query(ge=1, le=settings.AUTOCOMPLETE_MAX_LIMIT)] = 10):
+    return suggest(autocomplete.users, prefix, limit)
+
+
 @user_router.get("/{user_id}", response_model=UserResponseDetail)
 async def get_user(user_id: UUID, manager: Annotated[UserManager, Depends()]):
     user = await manager.get_user(user_id)
@@ -30,6 +39,14 @@ async def get_user(user_id: UUID, manager: Annotated[UserManager, Depends()]):
     return user
 
 
+@user_router.get("/{user_id}/stats", response_model=UserStatsResponse)
+async def get_user_stats(user_id: UUID, manager: Annotated[StatsManager, Depends()]):
+    stats = await manager.get_user_stats(user_id)
+    if stats is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+    return stats
+
+
 @user_router.patch("/{user_id}", response_model=UserResponseDetail)
 @requires(['authenticated'])
 async def update_user(user_id: UUID, body: UserUpdate, request: Request,
@@ -0,0 +1,75 @@
+"""Память и время запроса префиксного индекса подсказок на синтетических именах.
+
+Запуск из корня проекта, база не нужна:
+
+    python -m benchmarks.bench_autocomplete --entries 1000000 --queries 2000
+
+Память сборки сравнивается с тем же набором, отсортированным в список кортежей (UUID, текст), и
+приводится к миллиону записей. Запросы - префиксы из 1, 2 и 4 букв случайных имен.
+"""
+import argparse
+import random
+import string
+import time
+import tracemalloc
+import uuid
+
+import numpy as np
+
+from api.autocomplete import PrefixArray, PrefixIndex
+
+
+def names(entries: int, seed: int) -> list[tuple[uuid.UUID, str]]:
+    generator = random.Random(seed)
+    words = [''.join(generator.choices(string.ascii_lowercase, k=generator.randint(3, 9))).capitalize()
+             for _ in range(20_000)]
+    return [(uuid.UUID(int=generator.getrandbits(128), version=4),
+             f'{generator.choice(words)} {generator.choice(words)}') for _ in range(entries)]
+
+
+def percentiles(samples: list[float]) -> str:
+    p50, p99 = np.percentile(np.array(samples) * 1_000_000, [50, 99])
+    return f'p50 {p50:.1f} us, p99 {p99:.1f} us'
+
+
+def allocated(build) -> tuple[object, int]:
+    tracemalloc.start()
+    built = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, size
+
+
+def main(entries: int, queries: int) -> None:
+    sample = names(entries, seed=1)
+    mean = sum(len(text) for _, text in sample) / entries
+    scale = 1_000_000 / entries
+
+    started = time.perf_counter()
+    prefix_array = PrefixArray.build(sample)
+    built = time.perf_counter() - started
+    #  заново созданные строки и UUID, иначе они делились бы с sample и не попали в счет
+    _, listed = allocated(lambda: sorted(names(entries, seed=1), key=lambda row: row[1]))
+    print(f'{entries} entries, {mean:.1f} characters on average, built in {built:.1f}s')
+    print(f'prefix array   {prefix_array.nbytes() * scale / 2 ** 20:.1f} MiB per million entries')
+    print(f'list of tuples {listed * scale / 2 ** 20:.1f} MiB per million entries')
+
+    index = PrefixIndex()
+    index.replace(prefix_array, time.time())
+    generator = random.Random(2)
+    picks = [generator.choice(sample)[1] for _ in range(queries)]
+    for length in (1, 2, 4):
+        timings = []
+        for text in picks:
+            started = time.perf_counter()
+            index.search(text[:length], 10)
+            timings.append(time.perf_counter() - started)
+        print(f'prefix {length:<9}{percentiles(timings)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=2000)
+    arguments = parser.parse_args()
+    main(arguments.entries, arguments.queries)
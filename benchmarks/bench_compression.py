@@ -0,0 +1,99 @@
+"""Размер и процессорное время ответов списков для кодировок из negotiation.py.
+
+Запуск из корня проекта, база не нужна:
+
+    python -m benchmarks.bench_compression --items 100 --iterations 200
+
+Тело - страница Page[PostResponseDetail] из синтетических постов в том же виде, в каком его отдает
+/posts/all. Для gzip, br и zstd перебираются уровни сжатия, для MessagePack - перекодирование
+из JSON, как это делает middleware, отдельно и вместе со сжатием.
+"""
+import argparse
+import datetime
+import gzip
+import json
+import time
+import uuid
+
+from negotiation import brotli, msgpack, zstandard
+
+LEVELS = {
+    'gzip': (1, 6, 9),
+    'br': (1, 4, 6, 11),
+    'zstd': (1, 3, 9, 19),
+}
+
+
+def compressor(encoding: str, level: int):
+    if encoding == 'gzip':
+        return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == 'br':
+        return None if brotli is None else lambda data: brotli.compress(data, quality=level)
+    return None if zstandard is None else zstandard.ZstdCompressor(level=level).compress
+
+
+def page_body(items: int) -> bytes:
+    created = datetime.datetime(2024, 5, 1, 12, 0, 0)
+    posts = []
+    for number in range(items):
+        author_id, blog_id = str(uuid.uuid4()), str(uuid.uuid4())
+        posts.append({
+            'id': str(uuid.uuid4()), 'title': f'Post number {number}', 'body': 'Some text of the post. ' * 15,
+            'author_id': author_id, 'blog_id': blog_id, 'is_published': True,
+            'created_at': (created + datetime.timedelta(minutes=number)).isoformat(), 'views': number * 7,
+            'likes': number % 13,
+            'author': {'id': author_id, 'name': f'author{number}', 'email': f'author{number}@example.com',
+                       'is_active': True},
+            'blog': {'id': blog_id, 'title': f'Blog {number}', 'description': 'A blog about things',
+                     'created_at': created.isoformat(), 'updated_at': created.isoformat()},
+        })
+    page = {'items': posts, 'total': 10_000, 'page': 1, 'size': items, 'pages': 10_000 // items,
+            'total_estimated': True,
+            'links': {'first': '/posts/all?page=1', 'last': None, 'self': '/posts/all', 'next': '/posts/all?page=2',
+                      'prev': None}}
+    return json.dumps(page, separators=(',', ':')).encode()
+
+
+def timed(function, data, iterations: int) -> tuple[bytes, float]:
+    result = function(data)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function(data)
+    return result, (time.perf_counter() - started) / iterations
+
+
+def report(name: str, original: int, size: int, seconds: float | None) -> None:
+    if seconds is None:
+        timing = f'{"-":>12}{"-":>12}'
+    else:
+        timing = f'{seconds * 1e6:>12.0f}{original / seconds / 2 ** 20:>12.0f}'
+    print(f'{name:<22}{size:>10}{size / original:>9.1%}{timing}')
+
+
+def main(items: int, iterations: int) -> None:
+    body = page_body(items)
+    print(f'{"variant":<22}{"bytes":>10}{"ratio":>9}{"us/body":>12}{"MiB/s":>12}')
+    report('json', len(body), len(body), None)
+    bodies = [('json', body)]
+    if msgpack is not None:
+        #  как NegotiatedResponse: из данных модели ответа, без промежуточного JSON
+        packed, seconds = timed(msgpack.packb, json.loads(body), iterations)
+        report('msgpack', len(body), len(packed), seconds)
+        bodies.append(('msgpack', packed))
+    for label, data in bodies:
+        for encoding, levels in LEVELS.items():
+            for level in levels:
+                function = compressor(encoding, level)
+                if function is None:
+                    print(f'{label} + {encoding}: not installed')
+                    break
+                compressed, seconds = timed(function, data, iterations)
+                report(f'{label} + {encoding} {level}', len(body), len(compressed), seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=200)
+    arguments = parser.parse_args()
+    main(arguments.items, arguments.iterations)
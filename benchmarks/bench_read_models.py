@@ -0,0 +1,129 @@
+"""Память и время на страницу списка: сущности ORM против моделей чтения из api/read_models.py.
+
+Запуск из корня проекта с настроенной базой:
+
+    python -m benchmarks.bench_read_models --seed 2000
+    python -m benchmarks.bench_read_models --pages 20
+    python -m benchmarks.bench_read_models --cleanup
+
+--seed добавляет набор данных с префиксом bench_ (пользователи, по блогу и по пять постов на каждого,
+лайки от соседних пользователей), --cleanup его удаляет. Для каждого списка страница загружается
+и проверяется схемой ответа обоими способами, пиковая память считается tracemalloc.
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+import uuid
+
+from sqlalchemy import delete, insert, select
+
+from api.models import User, Blog, BlogAuthors, Post, Likes, UserStats, BlogStats
+from api.read_models import users_statement, blogs_statement, posts_statement, load_users, load_blogs, load_posts
+from api.schemas import UserResponseDetail, BlogResponseDetail, PostResponseDetail
+from database import engine, async_session
+
+PREFIX = 'bench_'
+POSTS_PER_USER = 5
+LIKES_PER_POST = 3
+
+LISTINGS = {
+    'users': (UserResponseDetail, lambda: select(User).where(User.is_active == True),
+              lambda: users_statement().where(User.is_active == True), load_users),
+    'blogs': (BlogResponseDetail, lambda: select(Blog).order_by(Blog.created_at.desc()),
+              lambda: blogs_statement().order_by(Blog.created_at.desc()), load_blogs),
+    'posts': (PostResponseDetail,
+              lambda: select(Post).where(Post.is_published == True).order_by(Post.created_at.desc()),
+              lambda: posts_statement().where(Post.is_published == True).order_by(Post.created_at.desc()),
+              load_posts),
+}
+
+
+async def seed(users: int) -> None:
+    user_rows = [{'id': uuid.uuid4(), 'name': f'{PREFIX}{i}', 'email': f'{PREFIX}{i}@example.com',
+                  'password': 'x', 'is_active': True} for i in range(users)]
+    blog_rows = [{'id': uuid.uuid4(), 'title': f'{PREFIX}blog {i}', 'description': 'benchmark blog',
+                  'owner_id': user['id']} for i, user in enumerate(user_rows)]
+    post_rows = [{'id': uuid.uuid4(), 'title': f'{PREFIX}post {i} {j}', 'body': 'benchmark post body ' * 20,
+                  'author_id': blog['owner_id'], 'blog_id': blog['id'], 'is_published': True, 'views': j}
+                 for i, blog in enumerate(blog_rows) for j in range(POSTS_PER_USER)]
+    like_rows = [{'post_id': post['id'], 'user_id': user_rows[(i + k + 1) % users]['id']}
+                 for i, post in enumerate(post_rows) for k in range(LIKES_PER_POST)]
+    async with async_session() as session:
+        async with session.begin():
+            for model, rows in ((User, user_rows), (UserStats, [{'user_id': row['id']} for row in user_rows]),
+                                (Blog, blog_rows), (BlogStats, [{'blog_id': row['id']} for row in blog_rows]),
+                                (BlogAuthors, [{'blog_id': row['id'], 'author_id': row['owner_id']}
+                                               for row in blog_rows]),
+                                (Post, post_rows), (Likes, like_rows)):
+                for start in range(0, len(rows), 5000):
+                    await session.execute(insert(model), rows[start:start + 5000])
+    print(f'seeded {users} users, {len(post_rows)} posts, {len(like_rows)} likes')
+
+
+async def cleanup() -> None:
+    users = select(User.id).where(User.name.startswith(PREFIX)).scalar_subquery()
+    posts = select(Post.id).where(Post.author_id.in_(users)).scalar_subquery()
+    blogs = select(Blog.id).where(Blog.owner_id.in_(users)).scalar_subquery()
+    async with async_session() as session:
+        async with session.begin():
+            for statement in (delete(Likes).where(Likes.post_id.in_(posts) | Likes.user_id.in_(users)),
+                              delete(Post).where(Post.id.in_(posts)),
+                              delete(BlogAuthors).where(BlogAuthors.blog_id.in_(blogs) |
+                                                        BlogAuthors.author_id.in_(users)),
+                              delete(Blog).where(Blog.id.in_(blogs)),
+                              delete(User).where(User.name.startswith(PREFIX))):
+                await session.execute(statement)
+    print('benchmark data removed')
+
+
+async def entity_page(session, build, schema, size: int, offset: int) -> list:
+    entities = (await session.scalars(build().limit(size).offset(offset))).unique().all()
+    return [schema.model_validate(entity) for entity in entities]
+
+
+async def read_model_page(session, build, load, schema, size: int, offset: int) -> list:
+    rows = (await session.execute(build().limit(size).offset(offset))).all()
+    return [schema.model_validate(item) for item in await load(session, rows)]
+
+
+async def measure(page, pages: int, size: int) -> tuple[float, float]:
+    peak, elapsed = 0, 0.0
+    for number in range(pages):
+        async with async_session() as session:
+            tracemalloc.start()
+            started = time.perf_counter()
+            await page(session, size, number * size)
+            elapsed += time.perf_counter() - started
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    return peak, elapsed / pages
+
+
+async def main(pages: int, size: int) -> None:
+    print(f'{"listing":<10}{"variant":<12}{"peak, KiB":>12}{"per row, B":>12}{"per page, ms":>14}')
+    for name, (schema, entities, columns, load) in LISTINGS.items():
+        variants = (
+            ('entities', lambda session, size, offset: entity_page(session, entities, schema, size, offset)),
+            ('read model', lambda session, size, offset: read_model_page(session, columns, load, schema, size,
+                                                                         offset)),
+        )
+        for variant, page in variants:
+            peak, per_page = await measure(page, pages, size)
+            print(f'{name:<10}{variant:<12}{peak / 1024:>12.0f}{peak / size:>12.0f}{per_page * 1000:>14.1f}')
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, help='add this many benchmark users with blogs, posts and likes')
+    parser.add_argument('--cleanup', action='store_true', help='remove benchmark data and exit')
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--size', type=int, default=100)
+    arguments = parser.parse_args()
+    if arguments.cleanup:
+        asyncio.run(cleanup())
+    elif arguments.seed:
+        asyncio.run(seed(arguments.seed))
+    else:
+        asyncio.run(main(arguments.pages, arguments.size))
@@ -0,0 +1,80 @@
+"""Сборка индекса похожих постов и время запроса к нему на синтетических постах.
+
+Запуск из корня проекта, база не нужна:
+
+    python -m benchmarks.bench_related --posts 100000 --queries 500
+
+Тексты собираются из словаря со словами по закону Ципфа, индекс пишется во временный каталог.
+Запросы идут по двум путям RelatedPosts.similar: готовые соседи поста из версии и поиск по спискам
+постов для постов, измененных после сборки (вся выборка запросов).
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from api.related import IndexBuilder, RelatedPosts
+
+TITLE_WORDS = 6
+BODY_WORDS = 80
+
+
+def documents(posts: int, vocabulary: int, seed: int):
+    generator = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = [''.join(generator.choice(letters, size=generator.integers(3, 10))) for _ in range(vocabulary)]
+    for _ in range(posts):
+        picks = np.minimum(generator.zipf(1.3, size=TITLE_WORDS + BODY_WORDS), vocabulary) - 1
+        yield (uuid.UUID(bytes=generator.bytes(16), version=4), ' '.join(words[i] for i in picks[:TITLE_WORDS]),
+               ' '.join(words[i] for i in picks[TITLE_WORDS:]))
+
+
+def percentiles(samples: list[float]) -> str:
+    p50, p99 = np.percentile(np.array(samples) * 1000, [50, 99])
+    return f'p50 {p50:.2f} ms, p99 {p99:.2f} ms'
+
+
+def main(posts: int, vocabulary: int, queries: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        builder = IndexBuilder()
+        sample = []
+        for number, (post_id, title, body) in enumerate(documents(posts, vocabulary, seed=1)):
+            builder.add(post_id, title, body)
+            if number % max(posts // queries, 1) == 0:
+                sample.append((post_id, title, body))
+        read = time.perf_counter()
+        builder.write(directory)
+        built = time.perf_counter()
+        size = sum(entry.stat().st_size for version in os.scandir(directory) if version.is_dir()
+                   for entry in os.scandir(version.path))
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >> 10
+        print(f'{posts} posts: features {read - started:.1f}s, vectors and neighbours {built - read:.1f}s, '
+              f'{size / 2 ** 20:.0f} MiB on disk, peak RSS {peak} MiB')
+
+        index = RelatedPosts(directory)
+        index.reload()
+        for source in ('precomputed', 'search'):
+            if source == 'search':
+                #  как после событий updated: посты выборки берутся из памяти воркера, соседи ищутся заново
+                for post_id, title, body in sample:
+                    index._remember(post_id, title, body)
+            timings = []
+            for post_id, title, body in sample:
+                started = time.perf_counter()
+                index.similar(post_id, title, body, 50)
+                timings.append(time.perf_counter() - started)
+            print(f'{source:<12}{percentiles(timings)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=100_000)
+    parser.add_argument('--vocabulary', type=int, default=50_000)
+    parser.add_argument('--queries', type=int, default=500)
+    arguments = parser.parse_args()
+    main(arguments.posts, arguments.vocabulary, arguments.queries)
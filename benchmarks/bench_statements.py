@@ -0,0 +1,87 @@
+"""Накладные расходы Python на построение и компиляцию горячих запросов менеджеров.
+
+Запуск из корня проекта с настроенной базой:
+
+    python -m benchmarks.bench_statements --iterations 2000
+
+Для каждого запроса сравниваются обычная конструкция select(...).where(...), которая собирается
+заново при каждом вызове, и lambda_stmt из api/managers.py. Время ожидания драйвера вычитается
+из общего времени вызова, остаток - работа SQLAlchemy и asyncpg на стороне Python.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from sqlalchemy import select, and_, event, lambda_stmt
+
+from api.models import User, Blog, BlogAuthors, Post
+from database import engine, async_session
+
+
+class DriverTimer:
+
+    def __init__(self):
+        self.total = 0.0
+        self._started = 0.0
+
+    def before(self, *args) -> None:
+        self._started = time.perf_counter()
+
+    def after(self, *args) -> None:
+        self.total += time.perf_counter() - self._started
+
+
+def plain_statements(key: uuid.UUID, email: str) -> dict:
+    return {
+        'get_user_by_email': lambda: select(User).where(and_(User.is_active == True, User.email == email)),
+        'get_post': lambda: select(Post).where(and_(Post.id == key, Post.is_published == True)),
+        'get_blog': lambda: select(Blog).where(Blog.id == key),
+        'get_blog_authors': lambda: select(BlogAuthors).where(and_(BlogAuthors.blog_id == key,
+                                                                   BlogAuthors.author_id == key)),
+    }
+
+
+def cached_statements(key: uuid.UUID, email: str) -> dict:
+    return {
+        'get_user_by_email': lambda: lambda_stmt(lambda: select(User).where(and_(User.is_active == True,
+                                                                                 User.email == email))),
+        'get_post': lambda: lambda_stmt(lambda: select(Post).where(and_(Post.id == key, Post.is_published == True))),
+        'get_blog': lambda: lambda_stmt(lambda: select(Blog).where(Blog.id == key)),
+        'get_blog_authors': lambda: lambda_stmt(lambda: select(BlogAuthors).where(and_(BlogAuthors.blog_id == key,
+                                                                                       BlogAuthors.author_id == key))),
+    }
+
+
+async def measure(build, iterations: int, timer: DriverTimer) -> tuple[float, float]:
+    async with async_session() as session:
+        for _ in range(min(iterations, 100)):
+            (await session.execute(build())).scalar()
+        timer.total = 0.0
+        started = time.perf_counter()
+        for _ in range(iterations):
+            (await session.execute(build())).scalar()
+        elapsed = time.perf_counter() - started
+    return elapsed / iterations, timer.total / iterations
+
+
+async def main(iterations: int) -> None:
+    timer = DriverTimer()
+    event.listen(engine.sync_engine, 'before_cursor_execute', timer.before)
+    event.listen(engine.sync_engine, 'after_cursor_execute', timer.after)
+
+    key, email = uuid.uuid4(), 'nobody@example.com'
+    plain, cached = plain_statements(key, email), cached_statements(key, email)
+    print(f'{"query":<20}{"variant":<10}{"per call, us":>14}{"driver, us":>12}{"python, us":>12}')
+    for name in plain:
+        for variant, build in (('select', plain[name]), ('lambda', cached[name])):
+            per_call, driver = await measure(build, iterations, timer)
+            print(f'{name:<20}{variant:<10}{per_call * 1e6:>14.1f}{driver * 1e6:>12.1f}'
+                  f'{(per_call - driver) * 1e6:>12.1f}')
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=2000)
+    asyncio.run(main(parser.parse_args().iterations))
@@ -1,20 +1,161 @@
-from typing import AsyncGenerator
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator, Callable
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from starlette.requests import Request
 
 import settings
+from admission import DeadlineExceeded, deadline_remaining
+from instrumentation import instrument_engine
+from metrics import InstrumentedPool, register_pool_metrics, register_shard_pool_metrics
 
-engine = create_async_engine(settings.DATABASE_URL, future=True, echo=True)
+MAIN_SHARD = 'main'
 
+
+def _apply_deadline(connection) -> None:
+    """Остаток дедлайна запроса становится statement_timeout транзакции: запрос, от которого клиент
+    уже не дождется ответа, отменяется самим Postgres"""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return
+    if remaining <= 0:
+        #  statement_timeout = 1 все равно выполнил бы запрос, если бы тот успел за миллисекунду
+        raise DeadlineExceeded()
+    connection.exec_driver_sql(f'SET LOCAL statement_timeout = {max(int(remaining * 1000), 1)}')
+
+
+def create_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(url, future=True, echo=settings.SQL_ECHO, poolclass=InstrumentedPool,
+                                 pool_size=settings.DB_POOL_SIZE, max_overflow=settings.DB_MAX_OVERFLOW,
+                                 query_cache_size=settings.SQL_COMPILED_CACHE_SIZE,
+                                 connect_args={'prepared_statement_cache_size':
+                                               settings.DB_PREPARED_STATEMENT_CACHE_SIZE})
+    instrument_engine(engine)
+    event.listen(engine.sync_engine, 'begin', _apply_deadline)
+    return engine
+
+
+def parse_shard_urls(value: str) -> dict[str, str]:
+    """SHARD_DATABASE_URLS вида 'имя=url,имя=url'"""
+    shards = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, url = item.partition('=')
+        shards[name.strip()] = url.strip()
+    return shards
+
+
+engine = create_engine(settings.DATABASE_URL)
+register_pool_metrics(engine)
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+#  базы с блогами и всем, что к ним относится (см. sharding.py). Без SHARD_DATABASE_URLS
+#  единственный шард - сама глобальная база, и сессия шарда в запросе - это сессия запроса
+shard_engines = {name: create_engine(url) for name, url in parse_shard_urls(settings.SHARD_DATABASE_URLS).items()} \
+    or {MAIN_SHARD: engine}
+SHARDED = engine not in shard_engines.values()
+shard_sessionmakers = {name: async_session if shard_engine is engine else
+                       async_sessionmaker(shard_engine, class_=AsyncSession, expire_on_commit=False)
+                       for name, shard_engine in shard_engines.items()}
+if SHARDED:
+    register_shard_pool_metrics(shard_engines)
+
 Base = declarative_base()
 
+READ_ONLY_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
 
 async def get_db() -> AsyncGenerator:
-    try:
-        async with async_session() as session:
-            yield session
-    finally:
-        await session.close()
+    async with async_session() as session:
+        yield session
+
+
+def read_write_transaction(request: Request) -> None:
+    """Для GET-обработчиков, которые пишут в базу (например, счетчик просмотров)"""
+    request.state.read_write = True
+
+
+@asynccontextmanager
+async def unit_of_work(read_only: bool = False) -> AsyncIterator[AsyncSession]:
+    """Транзакция глобальной базы и открытые по ходу транзакции шардов.
+
+    Шарды фиксируются по очереди перед глобальной базой, общего коммита у них нет: ошибка на втором
+    шарде не откатит первый. Колбэки on_commit вызываются после всех коммитов.
+    """
+    async with async_session() as session:
+        session.info['read_only'] = read_only
+        try:
+            async with session.begin():
+                if read_only:
+                    await session.connection(execution_options={'postgresql_readonly': True})
+                yield session
+                for shard in session.info.get('shards', {}).values():
+                    await shard.commit()
+        finally:
+            for shard in session.info.pop('shards', {}).values():
+                await shard.close()
+        run_commit_callbacks(session)
+
+
+async def get_unit_of_work(request: Request) -> AsyncGenerator:
+    """Одна транзакция на весь запрос, для GET-запросов - только на чтение"""
+    read_only = request.method in READ_ONLY_METHODS and not getattr(request.state, 'read_write', False)
+    async with unit_of_work(read_only) as session:
+        yield session
+
+
+async def shard_session(session: AsyncSession, shard: str) -> AsyncSession:
+    """Сессия шарда в единице работы session, открывается при первом обращении"""
+    if shard_engines[shard] is engine:
+        return session
+    shards = session.info.setdefault('shards', {})
+    target = shards.get(shard)
+    if target is None:
+        target = shards[shard] = shard_sessionmakers[shard](info={'shard': shard})
+        await target.begin()
+        if session.info.get('read_only'):
+            await target.connection(execution_options={'postgresql_readonly': True})
+    return target
+
+
+async def all_shard_sessions(session: AsyncSession) -> list[AsyncSession]:
+    return [await shard_session(session, shard) for shard in shard_engines]
+
+
+def on_commit(session: AsyncSession, callback: Callable[[], None]) -> None:
+    """Вызывается после коммита транзакции запроса, при откате - нет"""
+    session.info.setdefault('on_commit', []).append(callback)
+
+
+def run_commit_callbacks(session: AsyncSession) -> None:
+    """Для сессий вне get_unit_of_work: вызывается после успешного выхода из session.begin()"""
+    for callback in session.info.pop('on_commit', ()):
+        callback()
+
+
+def all_engines() -> list[AsyncEngine]:
+    return [engine, *(shard_engine for shard_engine in shard_engines.values() if shard_engine is not engine)]
+
+
+async def _ping(target: AsyncEngine) -> None:
+    async with target.connect() as connection:
+        await connection.execute(text('SELECT 1'))
+
+
+async def ping_database() -> None:
+    await asyncio.gather(*(_ping(target) for target in all_engines()))
+
+
+async def warm_up_pool() -> None:
+    """Открывает соединения пулов заранее, чтобы первые запросы не ждали подключения к базе"""
+    for target in all_engines():
+        connections = await asyncio.gather(*(target.connect() for _ in range(settings.DB_POOL_SIZE)))
+        for connection in connections:
+            await connection.execute(text('SELECT 1'))
+            await connection.close()
+
+
+async def dispose_engines() -> None:
+    await asyncio.gather(*(target.dispose() for target in all_engines()))
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Callable
+from uuid import UUID
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+from starlette.websockets import WebSocket
+
+import settings
+from database import shard_engines
+from metrics import registry
+
+logger = logging.getLogger('events')
+
+CHANNEL = 'post_events'
+#  лимит payload в NOTIFY - 8000 байт
+MAX_PAYLOAD = 7900
+
+subscribers_gauge = registry.gauge('post_event_subscribers', 'Open post event streams by transport', ('transport',))
+received_total = registry.counter('post_events_received_total', 'Notifications received on the LISTEN connection')
+dropped_total = registry.counter('post_event_slow_subscribers_total',
+                                 'Subscribers disconnected because their queue was full')
+
+_NOTIFY = text('SELECT pg_notify(:channel, :payload)')
+
+
+class Subscription:
+    """Очередь событий одного клиента. При переполнении клиент отключается и должен перечитать состояние"""
+
+    CLOSED = None
+
+    def __init__(self, post_id: str, shard: str, queue_size: int):
+        self.post_id = post_id
+        self.shard = shard
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def push(self, event: dict) -> bool:
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.queue.put_nowait(self.CLOSED)
+                return
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+
+    async def get(self, timeout: float) -> dict | None:
+        """None - подписка закрыта, пустой dict - за timeout событий не было"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return {}
+
+
+class PostEventBroker:
+    """Одно LISTEN-соединение на воркер и базу, события раздаются подписчикам и слушателям в памяти.
+    С шардами NOTIFY идет в транзакции шарда поста, поэтому слушаются все шарды, а подписки хранятся по шардам:
+    обрыв соединения одного шарда закрывает только подписки на его посты"""
+
+    def __init__(self, dsns: dict[str, str], queue_size: int, reconnect_delay: float, keepalive_interval: float,
+                 keepalive_timeout: float):
+        self.dsns = dsns
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_timeout = keepalive_timeout
+        self._subscriptions: dict[str, dict[str, set[Subscription]]] = {shard: {} for shard in dsns}
+        self._listening: set[str] = set()
+        self._listeners: list[Callable[[dict], None]] = []
+
+    def listening(self, shard: str) -> bool:
+        """Подписка на посты шарда без LISTEN-соединения молча не получала бы событий"""
+        return shard in self._listening
+
+    def subscribe(self, post_id: UUID, shard: str) -> Subscription:
+        subscription = Subscription(str(post_id), shard, self.queue_size)
+        self._subscriptions[shard].setdefault(subscription.post_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        shard_subscriptions = self._subscriptions[subscription.shard]
+        subscriptions = shard_subscriptions.get(subscription.post_id)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del shard_subscriptions[subscription.post_id]
+
+    def add_listener(self, listener: Callable[[dict], None]) -> None:
+        """Получает все события воркера, в том числе по постам без подписчиков"""
+        self._listeners.append(listener)
+
+    def close_shard(self, shard: str) -> None:
+        for subscriptions in list(self._subscriptions[shard].values()):
+            for subscription in list(subscriptions):
+                subscription.close()
+
+    def dispatch(self, shard: str, payload: str) -> None:
+        received_total.inc()
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning('Malformed notification payload %r', payload[:200])
+            return
+        for listener in self._listeners:
+            listener(event)
+        for subscription in list(self._subscriptions[shard].get(event.get('post_id'), ())):
+            if not subscription.push(event):
+                dropped_total.inc()
+                self.unsubscribe(subscription)
+                subscription.close()
+
+    async def _keep_alive(self, connection: asyncpg.Connection, closed: asyncio.Event) -> None:
+        """Ждет закрытия соединения, проверяя его запросом раз в keepalive_interval"""
+        while True:
+            try:
+                await asyncio.wait_for(closed.wait(), self.keepalive_interval)
+                return
+            except asyncio.TimeoutError:
+                await connection.fetchval('SELECT 1', timeout=self.keepalive_timeout)
+
+    async def run(self) -> None:
+        await asyncio.gather(*(self._listen(shard, dsn) for shard, dsn in self.dsns.items()))
+
+    async def _listen(self, shard: str, dsn: str) -> None:
+        def on_notification(connection, pid: int, channel: str, payload: str) -> None:
+            self.dispatch(shard, payload)
+
+        while True:
+            closed = asyncio.Event()
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn, timeout=self.keepalive_timeout)
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(CHANNEL, on_notification)
+                self._listening.add(shard)
+                await self._keep_alive(connection, closed)
+                logger.warning('LISTEN connection to shard %s lost, reconnecting', shard)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as error:
+                #  в том числе TimeoutError проверки соединения
+                logger.warning('LISTEN connection to shard %s failed: %r', shard, error)
+            finally:
+                if connection is not None and not connection.is_closed():
+                    #  без обмена с сервером: соединение могло оборваться молча
+                    connection.terminate()
+            if shard in self._listening:
+                #  пропущенные за время переподключения события клиенты восстановят перечитав состояние;
+                #  неудачные попытки переподключения закрывать уже нечего, новые подписки до него не принимаются
+                self._listening.discard(shard)
+                self.close_shard(shard)
+            await asyncio.sleep(self.reconnect_delay)
+
+
+async def publish(session: AsyncSession, post_id: UUID, event: str, data: dict) -> None:
+    """NOTIFY в транзакции запроса: подписчики получат событие только после коммита"""
+    message = {'post_id': str(post_id), 'event': event, 'data': data}
+    payload = json.dumps(message, default=str)
+    if len(payload.encode()) > MAX_PAYLOAD:
+        message['data'] = {key: value for key, value in data.items() if key != 'body'}
+        message['truncated'] = True
+        payload = json.dumps(message, default=str)
+    await session.execute(_NOTIFY, {'channel': CHANNEL, 'payload': payload})
+
+
+async def sse_stream(post_id: UUID, shard: str, heartbeat: float) -> AsyncIterator[str]:
+    """Подписывается сам: если ответ не начнут отдавать, подписка не останется в брокере"""
+    subscription = post_events.subscribe(post_id, shard)
+    subscribers_gauge.labels('sse').inc()
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            event = await subscription.get(heartbeat)
+            if event is Subscription.CLOSED:
+                return
+            if not event:
+                yield ': ping\n\n'
+                continue
+            yield f'event: {event["event"]}\ndata: {json.dumps(event)}\n\n'
+    finally:
+        subscribers_gauge.labels('sse').dec()
+        post_events.unsubscribe(subscription)
+
+
+async def websocket_stream(websocket: WebSocket, post_id: UUID, shard: str) -> None:
+    """Отправляет события, пока клиент не отключится или подписка не будет закрыта"""
+    subscription = post_events.subscribe(post_id, shard)
+    subscribers_gauge.labels('websocket').inc()
+    receiver = asyncio.ensure_future(websocket.receive())
+    getter = asyncio.ensure_future(subscription.queue.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait({receiver, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                if receiver.result()['type'] == 'websocket.disconnect':
+                    return
+                receiver = asyncio.ensure_future(websocket.receive())
+            if getter in done:
+                event = getter.result()
+                if event is Subscription.CLOSED:
+                    await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                    return
+                await websocket.send_json(event)
+                getter = asyncio.ensure_future(subscription.queue.get())
+    finally:
+        receiver.cancel()
+        getter.cancel()
+        subscribers_gauge.labels('websocket').dec()
+        post_events.unsubscribe(subscription)
+
+
+post_events = PostEventBroker(dsns={shard: shard_engine.url.set(drivername='postgresql').render_as_string(
+                                        hide_password=False) for shard, shard_engine in shard_engines.items()},
+                              queue_size=settings.EVENTS_QUEUE_SIZE,
+                              reconnect_delay=settings.EVENTS_RECONNECT_DELAY,
+                              keepalive_interval=settings.EVENTS_KEEPALIVE_INTERVAL,
+                              keepalive_timeout=settings.EVENTS_KEEPALIVE_TIMEOUT)
+
+
+async def listen_post_events() -> None:
+    await post_events.run()
@@ -0,0 +1,51 @@
+import hashlib
+import math
+import zlib
+
+FORMAT_VERSION = 1
+
+_INVERSE_POWERS = tuple(2.0 ** -rank for rank in range(65))
+
+
+class HyperLogLog:
+    """Оценка числа уникальных значений: 2^precision однобайтовых регистров, при precision=12 - 4 КБ
+    и стандартная ошибка около 1.6% независимо от числа значений"""
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision: int = 12, registers: bytearray | None = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add(self, value: str) -> None:
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches with different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(_INVERSE_POWERS[rank] for rank in self.registers)
+        if estimate <= 2.5 * size:
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = size * math.log(size / zeros)
+        return round(estimate)
+
+    def to_bytes(self) -> bytes:
+        return bytes((FORMAT_VERSION, self.precision)) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        version, precision = data[0], data[1]
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unknown sketch format {version}')
+        return cls(precision, bytearray(zlib.decompress(data[2:])))
@@ -0,0 +1,132 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+import settings
+from slow_query_log import slow_query_log
+
+logger = logging.getLogger('sql.requests')
+
+_PARAMETERS = re.compile(r'\$\d+(?:\s*,\s*\$\d+)*')
+_WHITESPACE = re.compile(r'\s+')
+
+
+class NPlusOneError(Exception):
+    pass
+
+
+class RequestQueryStats:
+    __slots__ = ('scope', 'started', 'statements', 'rows', 'db_time', 'shapes')
+
+    def __init__(self, scope: Scope):
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.rows = 0
+        self.db_time = 0.0
+        self.shapes = Counter()
+
+    def repeated_shapes(self, threshold: int) -> dict[str, int]:
+        return {shape: count for shape, count in self.shapes.items() if count > threshold}
+
+    def server_timing(self) -> str:
+        total = (time.perf_counter() - self.started) * 1000
+        return (f'db;dur={self.db_time * 1000:.2f};desc="{self.statements} statements, {self.rows} rows", '
+                f'app;dur={total:.2f}')
+
+
+_current_stats: ContextVar[RequestQueryStats | None] = ContextVar('request_query_stats', default=None)
+
+
+def current_stats() -> RequestQueryStats | None:
+    return _current_stats.get()
+
+
+def statement_shape(statement: str) -> str:
+    """IN-списки разной длины сводятся к одной форме"""
+    return _WHITESPACE.sub(' ', _PARAMETERS.sub('?', statement)).strip()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    stats = _current_stats.get()
+    slow_query_log.observe(statement, parameters, elapsed, stats.scope if stats else None, conn.engine)
+    if stats is None:
+        return
+    stats.statements += 1
+    stats.db_time += elapsed
+    if cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+    stats.shapes[statement_shape(statement)] += 1
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    slow_query_log.bind(engine)
+
+
+class QueryStatsMiddleware:
+    """Считает запросы к БД за время обработки запроса и отдает их в заголовке Server-Timing"""
+
+    def __init__(self, app: ASGIApp,
+                 n_plus_one_threshold: int = settings.SQL_N_PLUS_ONE_THRESHOLD,
+                 raise_on_n_plus_one: bool = settings.SQL_N_PLUS_ONE_RAISE):
+        self.app = app
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.raise_on_n_plus_one = raise_on_n_plus_one
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestQueryStats(scope)
+        token = _current_stats.set(stats)
+        status_code = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                repeated = stats.repeated_shapes(self.n_plus_one_threshold)
+                if repeated and self.raise_on_n_plus_one:
+                    raise NPlusOneError(f'{scope["method"]} {scope["path"]} repeated statements: {repeated}')
+                status_code = message['status']
+                headers = MutableHeaders(scope=message)
+                headers.append('Server-Timing', stats.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_stats.reset(token)
+            self.log(stats, status_code)
+
+    def log(self, stats: RequestQueryStats, status_code: int | None) -> None:
+        repeated = stats.repeated_shapes(self.n_plus_one_threshold)
+        record = {
+            'method': stats.scope['method'],
+            'path': stats.scope['path'],
+            'status': status_code,
+            'statements': stats.statements,
+            'rows': stats.rows,
+            'db_ms': round(stats.db_time * 1000, 2),
+            'total_ms': round((time.perf_counter() - stats.started) * 1000, 2),
+        }
+        if repeated:
+            record['repeated_statements'] = repeated
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
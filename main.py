@@ -1,16 +1,69 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, APIRouter
 from fastapi_pagination import add_pagination
 from starlette.middleware.authentication import AuthenticationMiddleware
 
+import settings
+from admission import AdmissionMiddleware, RouteLimit
+from api.autocomplete import maintain_autocomplete_index
 from api.blog.blog_handlers import blog_router
 from api.comment.comment_handlers import comment_router
+from api.deletion import resume_deletion_jobs
+from api.engagement import flush_engagement_periodically
+from api.job.job_handlers import job_router
+from api.monitoring.monitoring_handlers import monitoring_router
 from api.post.post_handlers import post_router
+from api.related import maintain_related_index
+from api.stats import reconcile_stats_periodically
+from api.unique_views import flush_unique_views_periodically
 from api.user.login_handlers import login_router
 from api.user.user_handlers import user_router
+from database import dispose_engines, warm_up_pool
+from events import listen_post_events
+from instrumentation import QueryStatsMiddleware
+from metrics import MetricsMiddleware, monitor_event_loop_lag, route_prefixes, registry, write_snapshots_periodically
 from middleware import BearerTokenAuthBackend
+from negotiation import ContentNegotiationMiddleware, NegotiatedResponse
+from partitions import maintain_partitions
+from profiler import ProfilerMiddleware
+from sharding import replicate_users_periodically
+
+logger = logging.getLogger('main')
+
+#  coroutine functions running for the whole life of a worker
+background_jobs = [monitor_event_loop_lag, reconcile_stats_periodically, listen_post_events,
+                   flush_unique_views_periodically, resume_deletion_jobs, maintain_related_index,
+                   flush_engagement_periodically, maintain_partitions, replicate_users_periodically,
+                   maintain_autocomplete_index, write_snapshots_periodically]
+
+startup_duration = registry.gauge('app_startup_seconds', 'Time spent in the lifespan startup phase', aggregate='max')
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    app.state.ready = False
+    await warm_up_pool()
+    tasks = [asyncio.create_task(job(), name=job.__name__) for job in background_jobs]
+    app.state.ready = True
+    startup_duration.set(time.perf_counter() - started)
+    logger.info('Worker started in %.3fs', time.perf_counter() - started)
+
+    yield
+
+    #  запросы к этому моменту уже дождался или отменил uvicorn (timeout_graceful_shutdown в server.py)
+    app.state.ready = False
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await dispose_engines()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=NegotiatedResponse)
 add_pagination(app)
 
 router = APIRouter()
@@ -19,7 +72,16 @@ router.include_router(login_router, prefix='/login', tags=['login'])
 router.include_router(blog_router, prefix='/blogs', tags=['blogs'])
 router.include_router(post_router, prefix='/posts', tags=['posts'])
 router.include_router(comment_router, prefix='/comments', tags=['comments'])
+router.include_router(job_router, prefix='/jobs', tags=['jobs'])
+router.include_router(monitoring_router, tags=['monitoring'])
 
 app.include_router(router)
 
 app.add_middleware(AuthenticationMiddleware, backend=BearerTokenAuthBackend())
+app.add_middleware(ProfilerMiddleware)
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(AdmissionMiddleware, prefixes=route_prefixes(router),
+                   limits=RouteLimit.parse_many(settings.ADMISSION_ROUTE_LIMITS),
+                   exempt=('/metrics', '/health/live', '/health/ready'))
+app.add_middleware(ContentNegotiationMiddleware)
+app.add_middleware(MetricsMiddleware, prefixes=route_prefixes(router))
@@ -0,0 +1,424 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from fastapi import APIRouter
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+import settings
+
+logger = logging.getLogger('metrics')
+
+PROCESS_STARTED_AT = float(os.environ.get('SERVER_STARTED_AT') or time.time())
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class _GaugeValue(_CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (), aggregate: str = 'sum'):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        #  как складываются значения воркеров: sum или max для одинакового у всех, например общего индекса
+        self.aggregate = aggregate
+        self._children = {}
+        if not self.label_names:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *label_values):
+        child = self._children.get(label_values)
+        if child is None:
+            child = self._children[label_values] = self._new_child()
+        return child
+
+    def _samples(self, label_values: tuple, child) -> Iterable[str]:
+        yield f'{self.name}{_format_labels(self.label_names, label_values)} {_format_value(child.value)}'
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for label_values, child in list(self._children.items()):
+            yield from self._samples(label_values, child)
+
+    def _values(self) -> Iterable[tuple[tuple, object]]:
+        return ((label_values, child.value) for label_values, child in list(self._children.items()))
+
+    def snapshot(self) -> dict:
+        return {'kind': self.kind, 'documentation': self.documentation, 'label_names': self.label_names,
+                'aggregate': self.aggregate,
+                'samples': [[label_values, value] for label_values, value in self._values()]}
+
+    def merge(self, samples: list) -> None:
+        for label_values, value in samples:
+            child = self.labels(*label_values)
+            child.value = max(child.value, value) if self.aggregate == 'max' else child.value + value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1) -> None:
+        self._children[()].inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def inc(self, amount: float = 1) -> None:
+        self._children[()].inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self._children[()].dec(amount)
+
+    def set(self, value: float) -> None:
+        self._children[()].set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _values(self) -> Iterable[tuple[tuple, object]]:
+        return ((label_values, [child.counts, child.sum, child.count])
+                for label_values, child in list(self._children.items()))
+
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), 'buckets': self.buckets}
+
+    def merge(self, samples: list) -> None:
+        for label_values, (counts, total, count) in samples:
+            child = self.labels(*label_values)
+            child.counts = [current + added for current, added in zip(child.counts, counts)]
+            child.sum += total
+            child.count += count
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._children[()].observe(value)
+
+    def _samples(self, label_values: tuple, child) -> Iterable[str]:
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, label_values, f'le="{_format_value(bound)}"')
+            yield f'{self.name}_bucket{labels} {cumulative}'
+        labels = _format_labels(self.label_names, label_values)
+        yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+        yield f'{self.name}_count{labels} {child.count}'
+
+
+class GaugeCallback(Metric):
+    """Значение вычисляется в момент выгрузки метрик, например размер кэша или буфера"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float | dict],
+                 label_names: Iterable[str] = (), aggregate: str = 'sum'):
+        self.callback = callback
+        super().__init__(name, documentation, label_names, aggregate)
+
+    def _new_child(self):
+        return None
+
+    def _values(self) -> Iterable[tuple[tuple, object]]:
+        value = self.callback()
+        return value.items() if isinstance(value, dict) else (((), value),)
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        value = self.callback()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for label_values, sample in value.items():
+            yield f'{self.name}{_format_labels(self.label_names, label_values)} {_format_value(sample)}'
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Iterable[str] = ()) -> Counter:
+        return self._metrics.get(name) or self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Iterable[str] = (), aggregate: str = 'sum') -> Gauge:
+        return self._metrics.get(name) or self.register(Gauge(name, documentation, label_names, aggregate))
+
+    def histogram(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.get(name) or self.register(Histogram(name, documentation, label_names, buckets))
+
+    def gauge_callback(self, name: str, documentation: str, callback: Callable[[], float | dict],
+                       label_names: Iterable[str] = (), aggregate: str = 'sum') -> GaugeCallback:
+        return self.register(GaugeCallback(name, documentation, callback, label_names, aggregate))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
+
+
+registry = Registry()
+
+_METRIC_TYPES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_snapshot(directory: str) -> dict:
+    snapshot = registry.snapshot()
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(f'{path}.tmp', path)
+    return snapshot
+
+
+def clear_snapshots(directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    for entry in os.listdir(directory):
+        if entry.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(directory, entry))
+
+
+def render_workers(directory: str) -> str:
+    """Метрики всех воркеров из снимков в directory: счетчики и гистограммы складываются вместе с завершившимися
+    воркерами, чтобы суммы не убывали, gauge - только по живым. Снимки других воркеров отстают не больше чем
+    на METRICS_SNAPSHOT_INTERVAL; свой пишется до ответа, иначе следующий сбор в другом воркере мог бы
+    увидеть меньше уже отданного"""
+    own = f'{os.getpid()}.json'
+    snapshots = [(True, write_snapshot(directory))]
+    for entry in sorted(os.listdir(directory)):
+        if not entry.endswith('.json') or entry == own:
+            continue
+        try:
+            with open(os.path.join(directory, entry)) as file:
+                snapshots.append((_alive(int(entry.removesuffix('.json'))), json.load(file)))
+        except (OSError, ValueError):
+            continue
+    merged: dict[str, Metric] = {}
+    for alive, snapshot in snapshots:
+        for name, data in snapshot.items():
+            if data['kind'] == 'gauge' and not alive:
+                continue
+            metric = merged.get(name)
+            if metric is None:
+                options = {'buckets': tuple(data['buckets'])} if data['kind'] == 'histogram' else {}
+                metric = merged[name] = _METRIC_TYPES[data['kind']](name, data['documentation'], data['label_names'],
+                                                                   **options)
+                metric.aggregate = data['aggregate']
+            metric.merge([(tuple(label_values), value) for label_values, value in data['samples']])
+    lines = []
+    for metric in merged.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def render_metrics() -> str:
+    if settings.METRICS_DIR:
+        return render_workers(settings.METRICS_DIR)
+    return registry.render()
+
+
+async def write_snapshots_periodically() -> None:
+    if not settings.METRICS_DIR:
+        return
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    try:
+        while True:
+            write_snapshot(settings.METRICS_DIR)
+            await asyncio.sleep(settings.METRICS_SNAPSHOT_INTERVAL)
+    finally:
+        #  последние значения остановленного воркера остаются в суммах счетчиков
+        write_snapshot(settings.METRICS_DIR)
+
+request_duration = registry.histogram('http_request_duration_seconds',
+                                      'Request latency by router prefix', ('route', 'method'))
+requests_total = registry.counter('http_requests_total', 'Finished requests by router prefix and status class',
+                                  ('route', 'status'))
+requests_in_flight = registry.gauge('http_requests_in_flight', 'Requests being processed by router prefix',
+                                    ('route',))
+pool_checkouts = registry.counter('db_pool_checkouts_total', 'Connections taken from the pool')
+pool_wait = registry.histogram('db_pool_wait_seconds', 'Time spent waiting for a pool connection',
+                               buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+event_loop_lag = registry.histogram('event_loop_lag_seconds', 'Event loop scheduling delay',
+                                    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+cold_start = registry.gauge('app_cold_start_seconds', 'Time from server launch to the first served request',
+                            aggregate='max')
+
+_STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+#  остальные методы (OPTIONS, HEAD, произвольные от клиента) идут в 'other', чтобы не плодить серии
+_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+
+    def _do_get(self):
+        started = time.perf_counter()
+        connection = super()._do_get()
+        pool_wait.observe(time.perf_counter() - started)
+        pool_checkouts.inc()
+        return connection
+
+
+def register_pool_metrics(engine: AsyncEngine) -> None:
+    pool = engine.pool
+    registry.gauge_callback('db_pool_size', 'Configured pool size', pool.size)
+    registry.gauge_callback('db_pool_checked_out', 'Connections currently checked out', pool.checkedout)
+    registry.gauge_callback('db_pool_overflow', 'Connections opened above pool size', pool.overflow)
+
+
+def register_shard_pool_metrics(engines: dict[str, AsyncEngine]) -> None:
+    registry.gauge_callback('db_shard_pool_checked_out', 'Connections currently checked out by shard',
+                            lambda: {(name, ): engine.pool.checkedout() for name, engine in engines.items()},
+                            ('shard',))
+    registry.gauge_callback('db_shard_pool_overflow', 'Connections opened above pool size by shard',
+                            lambda: {(name, ): engine.pool.overflow() for name, engine in engines.items()},
+                            ('shard',))
+
+
+def route_prefixes(router: APIRouter) -> tuple[str, ...]:
+    return tuple(sorted({'/' + route.path.split('/')[1] for route in router.routes}))
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app: ASGIApp, prefixes: Iterable[str] = ()):
+        self.app = app
+        self.first_request_pending = True
+        self.prefixes = {prefix: prefix for prefix in prefixes}
+        for prefix in (*self.prefixes, 'other'):
+            requests_in_flight.labels(prefix)
+            for method in (*_METHODS, 'other'):
+                request_duration.labels(prefix, method)
+            for status_class in _STATUS_CLASSES:
+                requests_total.labels(prefix, status_class)
+
+    def route_label(self, path: str) -> str:
+        end = path.find('/', 1)
+        return self.prefixes.get(path if end == -1 else path[:end], 'other')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = self.route_label(scope['path'])
+        method = scope['method'] if scope['method'] in _METHODS else 'other'
+        in_flight = requests_in_flight.labels(route)
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            request_duration.labels(route, method).observe(time.perf_counter() - started)
+            requests_total.labels(route, _STATUS_CLASSES[status_code // 100 - 1]).inc()
+            if self.first_request_pending:
+                self.first_request_pending = False
+                elapsed = time.time() - PROCESS_STARTED_AT
+                cold_start.set(elapsed)
+                logger.info('First request served %.3fs after launch', elapsed)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(loop.time() - expected, 0.0))
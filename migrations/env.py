@@ -26,7 +26,15 @@ if config.config_file_name is not None:
 # add your model's MetaData object here
 # for 'autogenerate' support
 from api.models import Base
+from database import parse_shard_urls
+from partitions import include_object
 target_metadata = Base.metadata
+
+#  alembic -x shard=<имя> upgrade heads мигрирует шард из SHARD_DATABASE_URLS вместо основной базы
+shard = context.get_x_argument(as_dictionary=True).get('shard')
+if shard is not None:
+    config.set_main_option('sqlalchemy.url',
+                           parse_shard_urls(os.environ.get('SHARD_DATABASE_URLS', ''))[shard].replace('%', '%%'))
 # target_metadata = None
 
 # other values from the config, defined by the needs of env.py,
@@ -51,6 +59,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -60,7 +69,7 @@ def run_migrations_offline() -> None:
 
 
 def do_run_migrations(connection: Connection) -> None:
-    context.configure(connection=connection, target_metadata=target_metadata)
+    context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object)
 
     with context.begin_transaction():
         context.run_migrations()
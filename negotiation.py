@@ -0,0 +1,195 @@
+import asyncio
+import gzip
+import json
+from contextvars import ContextVar
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+import settings
+from metrics import registry
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+COMPRESSIBLE_TYPES = ('application/json', 'application/msgpack', 'text/plain', 'text/html', 'text/csv')
+
+responses_total = registry.counter('negotiated_responses_total', 'Responses by content encoding and format',
+                                   ('encoding', 'format'))
+saved_bytes = registry.counter('compression_saved_bytes_total', 'Bytes saved by response compression', ('encoding',))
+
+#  выставляет ContentNegotiationMiddleware по Accept запроса
+msgpack_preferred: ContextVar[bool] = ContextVar('msgpack_preferred', default=False)
+
+
+def _encoders() -> dict:
+    #  порядок - предпочтение сервера при одинаковом q у клиента
+    encoders = {}
+    if zstandard is not None:
+        level = settings.COMPRESSION_ZSTD_LEVEL
+        #  компрессор не потокобезопасен, на каждый ответ создается свой
+        encoders['zstd'] = lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    if brotli is not None:
+        quality = settings.COMPRESSION_BROTLI_QUALITY
+        encoders['br'] = lambda data: brotli.compress(data, quality=quality)
+    level = settings.COMPRESSION_GZIP_LEVEL
+    encoders['gzip'] = lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    return encoders
+
+
+ENCODERS = _encoders()
+
+
+def parse_quality(header: str) -> dict[str, float]:
+    """Значения заголовка Accept или Accept-Encoding с весами q, без параметров кроме q"""
+    qualities = {}
+    for item in header.split(','):
+        value, *params = item.strip().split(';')
+        if not value:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, number = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        qualities[value.strip().lower()] = quality
+    return qualities
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    qualities = parse_quality(accept_encoding)
+    wildcard = qualities.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for encoding in ENCODERS:
+        quality = qualities.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def wants_msgpack(accept: str) -> bool:
+    if msgpack is None or not accept:
+        return False
+    qualities = parse_quality(accept)
+    quality = max(qualities.get(media_type, 0.0) for media_type in MSGPACK_TYPES)
+    return quality > 0 and quality >= qualities.get('application/json', qualities.get('*/*', 0.0))
+
+
+class NegotiatedResponse(JSONResponse):
+    """Класс ответа приложения по умолчанию: данные модели ответа кодируются сразу в MessagePack,
+    если клиент предпочел его в Accept, без промежуточного JSON"""
+
+    def render(self, content) -> bytes:
+        if msgpack_preferred.get():
+            self.media_type = MSGPACK_TYPES[0]
+            return msgpack.packb(content)
+        return super().render(content)
+
+
+def _to_msgpack(body: bytes) -> bytes:
+    #  только для JSON, собранного в обход NegotiatedResponse: ошибки, явные JSONResponse
+    return msgpack.packb(json.loads(body))
+
+
+class ContentNegotiationMiddleware:
+    """Сжатие ответов по Accept-Encoding (zstd, br, gzip) и MessagePack вместо JSON по Accept.
+
+    MessagePack для моделей ответа кодирует NegotiatedResponse, здесь перекодируется только остальной JSON.
+
+    Сжимаются только ответы одним телом больше COMPRESSION_MIN_SIZE, потоковые (SSE) проходят как есть.
+    Тела больше COMPRESSION_THREAD_THRESHOLD сжимаются и перекодируются в пуле потоков,
+    чтобы не задерживать цикл событий.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = settings.COMPRESSION_MIN_SIZE,
+                 thread_threshold: int = settings.COMPRESSION_THREAD_THRESHOLD):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.thread_threshold = thread_threshold
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers.get('accept-encoding', ''))
+        msgpack_requested = wants_msgpack(request_headers.get('accept', ''))
+        start: Message | None = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+            response_start, start = start, None
+            if message['type'] != 'http.response.body' or message.get('more_body', False):
+                await send(response_start)
+                await send(message)
+                return
+            headers = MutableHeaders(raw=response_start['headers'])
+            body = await self.transform(headers, message.get('body', b''), encoding, msgpack_requested)
+            await send(response_start)
+            await send({'type': 'http.response.body', 'body': body})
+
+        token = msgpack_preferred.set(msgpack_requested)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            msgpack_preferred.reset(token)
+
+    async def transform(self, headers: MutableHeaders, body: bytes, encoding: str | None,
+                        msgpack_requested: bool) -> bytes:
+        media_type = headers.get('content-type', '').split(';')[0].strip()
+        response_format = {'application/json': 'json', MSGPACK_TYPES[0]: 'msgpack'}.get(media_type, 'other')
+        if media_type in ('application/json', MSGPACK_TYPES[0]):
+            headers.add_vary_header('Accept')
+        if media_type == 'application/json':
+            if msgpack_requested and body:
+                body = await self._run(_to_msgpack, body)
+                media_type = 'application/msgpack'
+                response_format = 'msgpack'
+                headers['content-type'] = media_type
+                headers['content-length'] = str(len(body))
+
+        if media_type in COMPRESSIBLE_TYPES:
+            headers.add_vary_header('Accept-Encoding')
+        if encoding is None or media_type not in COMPRESSIBLE_TYPES or 'content-encoding' in headers \
+                or len(body) < self.minimum_size:
+            responses_total.labels('identity', response_format).inc()
+            return body
+
+        compressed = await self._run(ENCODERS[encoding], body)
+        if len(compressed) >= len(body):
+            responses_total.labels('identity', response_format).inc()
+            return body
+        saved_bytes.labels(encoding).inc(len(body) - len(compressed))
+        responses_total.labels(encoding, response_format).inc()
+        headers['content-encoding'] = encoding
+        headers['content-length'] = str(len(compressed))
+        return compressed
+
+    async def _run(self, function, body: bytes) -> bytes:
+        if len(body) >= self.thread_threshold:
+            return await asyncio.to_thread(function, body)
+        return function(body)
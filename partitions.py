@@ -0,0 +1,387 @@
+"""Секционирование posts, comments и likes по месяцам created_at.
+
+Существующая таблица переводится без остановки приложения:
+
+    python -m partitions migrate comments
+    python -m partitions migrate likes
+    python -m partitions migrate posts
+    python -m partitions check
+
+migrate создает секционированную копию <table>_new с секциями за все месяцы данных, ставит на исходную
+таблицу триггер, повторяющий в копии каждое изменение, переносит строки партиями по первичному ключу
+и в одной короткой транзакции меняет таблицы местами. Исходная остается как <table>_unpartitioned
+и удаляется вручную после проверки. Секции на PARTITIONS_AHEAD месяцев вперед создает фоновая
+задача maintain_partitions, check показывает, сколько секций читают запросы менеджеров.
+
+Первичный ключ секционированной таблицы обязан включать created_at, поэтому после перевода:
+- уникальность названий постов держит таблица post_titles, которую ведет триггер на posts;
+- внешние ключи на posts(id) снимаются: дочерние строки удаляют задачи из api/deletion.py,
+  комментарий к несуществующему посту не создается проверкой в менеджере;
+- повторный лайк исключает блокировка пары пост-пользователь в set_or_remove_like;
+- поиск поста по id без created_at проверяет индекс каждой секции.
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import re
+import uuid
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+import settings
+from database import shard_engines, dispose_engines
+
+logger = logging.getLogger('partitions')
+
+#  столбцы первичного ключа до перевода, после перевода к ним добавляется created_at
+TABLES = {
+    'posts': ('id',),
+    'comments': ('id',),
+    'likes': ('user_id', 'post_id'),
+}
+#  служебные таблицы перевода и секции, которых нет в моделях
+AUXILIARY_TABLES = re.compile(r'^(posts|comments|likes)_(p\d{6}|new|unpartitioned)$|^post_titles$')
+
+_PARTITIONED = text('''
+SELECT c.relname FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+WHERE c.relnamespace = 'public'::regnamespace AND c.relname = ANY(:names)
+''')
+_PARTITIONS = text('''
+SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname
+''')
+_EXISTS = text('SELECT to_regclass(:table) IS NOT NULL')
+_MAINTENANCE_LOCK = text("SELECT pg_try_advisory_xact_lock(hashtext('partition_maintenance'))")
+#  неуникальные индексы; первичный ключ и уникальность переносятся отдельно
+_INDEXES = text('''
+SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+WHERE x.indrelid = CAST(:table AS regclass) AND NOT x.indisunique ORDER BY i.relname
+''')
+_ALL_INDEXES = text('''
+SELECT i.relname FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+WHERE x.indrelid = CAST(:table AS regclass) ORDER BY i.relname
+''')
+_OUTBOUND_KEYS = text('''
+SELECT conname, pg_get_constraintdef(oid), confrelid::regclass::text FROM pg_constraint
+WHERE conrelid = CAST(:table AS regclass) AND contype = 'f' ORDER BY conname
+''')
+_INBOUND_KEYS = text('''
+SELECT conrelid::regclass::text, conname FROM pg_constraint
+WHERE confrelid = CAST(:table AS regclass) AND contype = 'f' AND conparentid = 0 ORDER BY conname
+''')
+
+_POST_TITLES = (
+    'CREATE TABLE IF NOT EXISTS post_titles (title varchar PRIMARY KEY, post_id uuid NOT NULL)',
+    '''
+CREATE OR REPLACE FUNCTION post_titles_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM post_titles WHERE title = OLD.title AND post_id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO post_titles (title, post_id) VALUES (NEW.title, NEW.id);
+    END IF;
+    RETURN NULL;
+END $$''',
+    'CREATE TRIGGER post_titles_sync AFTER INSERT OR DELETE OR UPDATE OF title ON {table} '
+    'FOR EACH ROW EXECUTE FUNCTION post_titles_sync()',
+)
+_MIRROR = '''
+CREATE FUNCTION {table}_mirror() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM {new} WHERE ({key}) = ({old_key});
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {new} VALUES (NEW.*) ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END $$'''
+
+
+def month_start(day: datetime.date) -> datetime.date:
+    return day.replace(day=1)
+
+
+def next_month(month: datetime.date) -> datetime.date:
+    return (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def months_ahead(day: datetime.date, count: int) -> datetime.date:
+    month = month_start(day)
+    for _ in range(count):
+        month = next_month(month)
+    return month
+
+
+def partition_name(table: str, month: datetime.date) -> str:
+    return f'{table}_p{month:%Y%m}'
+
+
+async def partitioned_tables(connection: AsyncConnection) -> list[str]:
+    return list((await connection.execute(_PARTITIONED, {'names': list(TABLES)})).scalars())
+
+
+async def ensure_partitions(connection: AsyncConnection, table: str, first: datetime.date, last: datetime.date,
+                            parent: str | None = None) -> list[str]:
+    """Недостающие месячные секции table с месяца first по месяц last включительно.
+
+    Секция создается отдельной таблицей и присоединяется через ATTACH PARTITION, которая
+    в отличие от CREATE TABLE ... PARTITION OF не блокирует чтение и запись в родительскую таблицу.
+    """
+    parent = parent or table
+    created = []
+    month = month_start(first)
+    while month <= last:
+        name = partition_name(table, month)
+        if not (await connection.execute(_EXISTS, {'table': name})).scalar():
+            await connection.exec_driver_sql(f'CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS)')
+            await connection.exec_driver_sql(f"ALTER TABLE {parent} ATTACH PARTITION {name} "
+                                             f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')")
+            created.append(name)
+        month = next_month(month)
+    return created
+
+
+async def create_future_partitions(engine: AsyncEngine) -> list[str]:
+    today = datetime.date.today()
+    last = months_ahead(today, settings.PARTITIONS_AHEAD)
+    created = []
+    async with engine.begin() as connection:
+        #  секции создает один воркер, остальные пропускают этот проход
+        if not (await connection.execute(_MAINTENANCE_LOCK)).scalar():
+            return created
+        #  не встаем в очередь за долгими транзакциями, следующая попытка через интервал
+        await connection.exec_driver_sql(f"SET LOCAL lock_timeout = '{settings.PARTITION_LOCK_TIMEOUT}s'")
+        for table in await partitioned_tables(connection):
+            created += await ensure_partitions(connection, table, today, last)
+    return created
+
+
+async def maintain_partitions() -> None:
+    while True:
+        for shard, engine in shard_engines.items():
+            try:
+                created = await create_future_partitions(engine)
+                if created:
+                    logger.info('Created partitions %s on shard %s', ', '.join(created), shard)
+            except Exception:
+                logger.exception('Partition maintenance failed on shard %s', shard)
+        await asyncio.sleep(settings.PARTITION_MAINTENANCE_INTERVAL)
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    """Для autogenerate: секции, таблицы перевода и снятые при переводе ограничения не считаются расхождением"""
+    if type_ == 'table' and reflected and compare_to is None:
+        return not AUXILIARY_TABLES.match(name)
+    if not reflected and compare_to is None:
+        if type_ == 'foreign_key_constraint' and object.referred_table.name == 'posts':
+            return False
+        if type_ == 'unique_constraint' and object.table.name == 'posts':
+            return False
+    return True
+
+
+class OnlineMigration:
+    """Перевод таблицы в секционированную по created_at без остановки записи в нее"""
+
+    def __init__(self, table: str, engine: AsyncEngine, batch_size: int, pause: float):
+        self.table = table
+        self.engine = engine
+        self.new = f'{table}_new'
+        self.key = TABLES[table]
+        self.batch_size = batch_size
+        self.pause = pause
+
+    async def prepare(self) -> None:
+        async with self.engine.begin() as connection:
+            if (await connection.execute(_EXISTS, {'table': self.new})).scalar():
+                logger.info('%s already exists, continuing', self.new)
+                return
+            if self.table in await partitioned_tables(connection):
+                raise RuntimeError(f'{self.table} is already partitioned')
+            missing = (await connection.exec_driver_sql(
+                f'SELECT count(*) FROM {self.table} WHERE created_at IS NULL')).scalar()
+            if missing:
+                raise RuntimeError(f'{self.table} has {missing} rows without created_at, fill them first')
+
+            key = ', '.join(self.key + ('created_at',))
+            await connection.exec_driver_sql(
+                f'CREATE TABLE {self.new} (LIKE {self.table} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)')
+            await connection.exec_driver_sql(
+                f'ALTER TABLE {self.new} ADD CONSTRAINT {self.new}_pkey PRIMARY KEY ({key})')
+            for name, definition in (await connection.execute(_INDEXES, {'table': self.table})).all():
+                columns = definition.split(' USING ', 1)[1]
+                await connection.exec_driver_sql(f'CREATE INDEX {name}_new ON {self.new} USING {columns}')
+            partitioned = await partitioned_tables(connection)
+            for name, definition, target in (await connection.execute(_OUTBOUND_KEYS, {'table': self.table})).all():
+                if target in partitioned:
+                    logger.warning('Skipping %s: %s is partitioned and cannot be referenced', name, target)
+                    continue
+                #  копия пуста, проверка ключа мгновенная; дальше его проверяет каждая перенесенная строка
+                await connection.exec_driver_sql(f'ALTER TABLE {self.new} ADD CONSTRAINT {name} {definition}')
+            if self.table == 'posts':
+                for statement in _POST_TITLES:
+                    await connection.exec_driver_sql(statement.format(table=self.new))
+
+            first, last = (await connection.exec_driver_sql(
+                f'SELECT min(created_at), max(created_at) FROM {self.table}')).one()
+            today = datetime.date.today()
+            last = max(last.date() if last else today, months_ahead(today, settings.PARTITIONS_AHEAD))
+            await ensure_partitions(connection, self.table, first.date() if first else today, last, parent=self.new)
+
+            old_key = ', '.join(f'OLD.{column}' for column in self.key + ('created_at',))
+            await connection.exec_driver_sql(_MIRROR.format(table=self.table, new=self.new, key=key, old_key=old_key))
+            await connection.exec_driver_sql(f'CREATE TRIGGER {self.table}_mirror AFTER INSERT OR UPDATE OR DELETE '
+                                             f'ON {self.table} FOR EACH ROW EXECUTE FUNCTION {self.table}_mirror()')
+        logger.info('Prepared %s with mirror trigger on %s', self.new, self.table)
+
+    async def backfill(self) -> int:
+        """Перенос строк партиями по первичному ключу; повторный запуск начинает сначала и пропускает перенесенное"""
+        key = ', '.join(self.key)
+        descending = ', '.join(f'{column} DESC' for column in self.key)
+        bounds = ', '.join(f':{column}' for column in self.key)
+        copied, batches, last = 0, 0, None
+        while True:
+            condition = '' if last is None else f'WHERE ({key}) > ({bounds})'
+            #  FOR SHARE: строку партии нельзя изменить до переноса, иначе триггер опередит копию старой версии
+            statement = text(f'''
+WITH batch AS (SELECT * FROM {self.table} {condition} ORDER BY {key} LIMIT :batch FOR SHARE),
+copied AS (INSERT INTO {self.new} SELECT * FROM batch ON CONFLICT DO NOTHING)
+SELECT {key}, count(*) OVER () AS rows FROM batch ORDER BY {descending} LIMIT 1
+''')
+            async with self.engine.begin() as connection:
+                row = (await connection.execute(statement, {'batch': self.batch_size, **(last or {})})).first()
+            if row is None:
+                break
+            last = {column: getattr(row, column) for column in self.key}
+            copied += row.rows
+            batches += 1
+            if batches % 100 == 0:
+                logger.info('%s: %d rows copied', self.table, copied)
+            await asyncio.sleep(self.pause)
+        logger.info('%s: backfill finished, %d rows copied', self.table, copied)
+        return copied
+
+    async def verify(self) -> None:
+        async with self.engine.connect() as connection:
+            #  оба счетчика в одном снимке: триггер меняет копию в той же транзакции, что и исходную таблицу
+            await connection.exec_driver_sql('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            old = (await connection.exec_driver_sql(f'SELECT count(*) FROM {self.table}')).scalar()
+            new = (await connection.exec_driver_sql(f'SELECT count(*) FROM {self.new}')).scalar()
+            await connection.rollback()
+        if old != new:
+            raise RuntimeError(f'{self.table} has {old} rows, {self.new} has {new}, run backfill again')
+
+    async def swap(self) -> None:
+        async with self.engine.begin() as connection:
+            await connection.exec_driver_sql(f"SET LOCAL lock_timeout = '{settings.PARTITION_LOCK_TIMEOUT}s'")
+            inbound = (await connection.execute(_INBOUND_KEYS, {'table': self.table})).all()
+            #  ссылающиеся таблицы блокируются раньше самой: вставка в них проверяет ключ в том же порядке,
+            #  и встречные ожидания не заканчиваются взаимоблокировкой
+            tables = list(dict.fromkeys([table for table, _ in inbound] + [self.table]))
+            await connection.exec_driver_sql(f'LOCK TABLE {", ".join(tables)} IN ACCESS EXCLUSIVE MODE')
+            await connection.exec_driver_sql(f'DROP TRIGGER {self.table}_mirror ON {self.table}')
+            await connection.exec_driver_sql(f'DROP FUNCTION {self.table}_mirror()')
+            for table, name in inbound:
+                await connection.exec_driver_sql(f'ALTER TABLE {table} DROP CONSTRAINT {name}')
+            for name in (await connection.execute(_ALL_INDEXES, {'table': self.table})).scalars():
+                await connection.exec_driver_sql(f'ALTER INDEX {name} RENAME TO {name}_unpartitioned')
+            await connection.exec_driver_sql(f'ALTER TABLE {self.table} RENAME TO {self.table}_unpartitioned')
+            for name in (await connection.execute(_ALL_INDEXES, {'table': self.new})).scalars():
+                renamed = f'{self.table}_pkey' if name == f'{self.new}_pkey' else name.removesuffix('_new')
+                await connection.exec_driver_sql(f'ALTER INDEX {name} RENAME TO {renamed}')
+            await connection.exec_driver_sql(f'ALTER TABLE {self.new} RENAME TO {self.table}')
+        logger.info('%s is partitioned, the old table is kept as %s_unpartitioned', self.table, self.table)
+
+    async def analyze(self) -> None:
+        #  у новой таблицы нет статистики, без нее планировщик сортирует все секции вместо чтения по индексу
+        async with self.engine.begin() as connection:
+            await connection.exec_driver_sql(f'ANALYZE {self.new}')
+
+    async def run(self, swap: bool = True) -> None:
+        await self.prepare()
+        await self.backfill()
+        await self.verify()
+        await self.analyze()
+        if swap:
+            await self.swap()
+
+
+_SCANNED = re.compile(r' on ((?:posts|comments|likes)_p\d{6})\b')
+
+
+def _statements() -> dict:
+    from sqlalchemy import func, select
+
+    from api.filters import PostFilter
+    from api.models import Comment, Likes, Post
+    from api.read_models import posts_statement
+
+    now = datetime.datetime.now()
+    newest = posts_statement().where(Post.is_published == True).order_by(Post.created_at.desc())
+    recent = PostFilter(created_at__gte=now - datetime.timedelta(days=30), created_at__lte=now, order_by=None)
+    return {
+        'posts, newest first': newest.limit(20),
+        'posts, after_date/before_date': recent.filter(newest).limit(20),
+        'post by id': select(Post.id).where(Post.id == uuid.uuid4()),
+        'comments of a post': select(Comment.id).where(Comment.post_id == uuid.uuid4()),
+        'likes of a post': select(func.count()).where(Likes.post_id == uuid.uuid4()),
+    }
+
+
+async def check(engine: AsyncEngine) -> None:
+    """Сколько секций читает каждый запрос: секции, отброшенные при планировании или выполнении, не считаются"""
+    async with engine.connect() as connection:
+        partitioned = await partitioned_tables(connection)
+        if not partitioned:
+            print('No partitioned tables yet')
+            return
+        totals = {table: len((await connection.execute(_PARTITIONS, {'table': table})).all()) for table in partitioned}
+        raw = (await connection.get_raw_connection()).driver_connection
+        for label, statement in _statements().items():
+            compiled = statement.compile(dialect=engine.dialect)
+            parameters = [compiled.params[name] for name in compiled.positiontup]
+            plan = await raw.fetch(f'EXPLAIN (ANALYZE, COSTS OFF, TIMING OFF, SUMMARY OFF) {compiled}', *parameters)
+            scanned = {}
+            for line in (row[0] for row in plan):
+                match = _SCANNED.search(line)
+                if match and 'never executed' not in line:
+                    scanned.setdefault(match.group(1).rsplit('_p', 1)[0], set()).add(match.group(1))
+            read = ', '.join(f'{table} {len(scanned.get(table, ()))} of {total}' for table, total in totals.items()
+                             if table in scanned or table in str(compiled))
+            print(f'{label:<32}{read}')
+
+
+async def main(arguments: argparse.Namespace) -> None:
+    try:
+        for shard in arguments.shard or shard_engines:
+            engine = shard_engines[shard]
+            if len(shard_engines) > 1:
+                print(f'shard {shard}')
+            if arguments.command == 'migrate':
+                migration = OnlineMigration(arguments.table, engine, settings.PARTITION_MIGRATION_BATCH,
+                                            settings.PARTITION_MIGRATION_PAUSE)
+                await migration.run(swap=not arguments.no_swap)
+            elif arguments.command == 'ensure':
+                print(', '.join(await create_future_partitions(engine)) or 'Nothing to create')
+            else:
+                await check(engine)
+    finally:
+        await dispose_engines()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    parser = argparse.ArgumentParser(description='Range partitioning of posts, comments and likes by created_at')
+    parser.add_argument('--shard', action='append', choices=list(shard_engines),
+                        help='run on this shard only, by default on every shard in turn')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate = commands.add_parser('migrate', help='move a table into a partitioned copy online')
+    migrate.add_argument('table', choices=list(TABLES))
+    migrate.add_argument('--no-swap', action='store_true', help='stop after backfill, leave <table>_new in sync')
+    commands.add_parser('ensure', help='create partitions for the next PARTITIONS_AHEAD months')
+    commands.add_parser('check', help='show how many partitions the manager queries read')
+    asyncio.run(main(parser.parse_args()))
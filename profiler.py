@@ -0,0 +1,158 @@
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from types import CoroutineType, FrameType, GeneratorType
+
+from starlette.types import ASGIApp, Scope, Receive, Send
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f'{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def _coroutine_chain(coro) -> list[str]:
+    """Цепочка await от корня задачи до самого вложенного ожидания, например future asyncpg"""
+    names = []
+    while isinstance(coro, (CoroutineType, GeneratorType)):
+        frame = coro.cr_frame if isinstance(coro, CoroutineType) else coro.gi_frame
+        if frame is None:
+            return names
+        names.append(_frame_name(frame))
+        coro = coro.cr_await if isinstance(coro, CoroutineType) else coro.gi_yieldfrom
+    if coro is not None:
+        names.append(f'<await {getattr(coro, "__qualname__", type(coro).__qualname__)}>')
+    return names
+
+
+def _thread_chain(frame: FrameType | None, root_code) -> tuple[list[str], bool]:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        if frame.f_code is root_code:
+            return names[::-1], True
+        frame = frame.f_back
+    return names[::-1], False
+
+
+class SamplingProfiler:
+    """Семплирующий профайлер для выбранных маршрутов, по умолчанию выключен.
+
+    Состояние и семплы у каждого воркера свои, поэтому API профайлера работает с одним воркером по pid.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.routes = ()
+        self.sample_rate = 0.0
+        self.interval = 0.005
+        self.samples = Counter()
+        self._tasks = {}
+        self._loop = None
+        self._loop_thread_id = None
+        self._thread = None
+
+    async def start(self, routes: list[str], sample_rate: float, interval: float) -> None:
+        await self.stop()
+        self.routes = tuple(route.rstrip('/') or '/' for route in routes)
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self.active = True
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self.active = False
+        if self._thread is not None:
+            #  поток досыпает текущий интервал, до секунды: ждем его вне цикла событий
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+        self._tasks.clear()
+
+    def reset(self) -> None:
+        self.samples = Counter()
+
+    def select(self, path: str) -> str | None:
+        for route in self.routes:
+            if path == route or path.startswith(route + '/'):
+                return route if random.random() < self.sample_rate else None
+        return None
+
+    def track(self, task: asyncio.Task, route: str) -> None:
+        self._tasks[task] = route
+
+    def untrack(self, task: asyncio.Task) -> None:
+        self._tasks.pop(task, None)
+
+    def _run(self) -> None:
+        while self.active:
+            time.sleep(self.interval)
+            self._sample()
+
+    def _sample(self) -> None:
+        tracked = list(self._tasks.items())
+        if not tracked:
+            return
+        running = asyncio.current_task(self._loop)
+        thread_frame = sys._current_frames().get(self._loop_thread_id)
+        for task, route in tracked:
+            coro = task.get_coro()
+            chain = _coroutine_chain(coro)
+            if task is running:
+                frames, complete = _thread_chain(thread_frame, getattr(coro, 'cr_code', None))
+                chain = frames if complete else chain + ['<greenlet>'] + frames
+            self.samples[(route, *chain)] += 1
+
+    def collapsed(self) -> str:
+        return '\n'.join(f'{";".join(stack)} {count}' for stack, count in self.samples.items()) + '\n'
+
+    def speedscope(self) -> dict:
+        frames, frame_index, profiles = [], {}, {}
+        for (route, *stack), count in self.samples.items():
+            indexes = []
+            for name in stack:
+                if name not in frame_index:
+                    frame_index[name] = len(frames)
+                    frames.append({'name': name})
+                indexes.append(frame_index[name])
+            profile = profiles.setdefault(route, {'type': 'sampled', 'name': route, 'unit': 'none',
+                                                  'startValue': 0, 'endValue': 0, 'samples': [], 'weights': []})
+            profile['samples'].append(indexes)
+            profile['weights'].append(count)
+            profile['endValue'] += count
+        return {'$schema': 'https://www.speedscope.app/file-format-schema.json',
+                'shared': {'frames': frames},
+                'profiles': list(profiles.values()),
+                'exporter': 'project_fapi sampling profiler'}
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilerMiddleware:
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not profiler.active or scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = profiler.select(scope['path'])
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        profiler.track(task, route)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.untrack(task)
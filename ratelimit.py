@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+from starlette import status
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+
+import settings
+from metrics import registry
+
+logger = logging.getLogger('ratelimit')
+
+rejections = registry.counter('rate_limit_rejections_total', 'Requests rejected by rate limits', ('scope',))
+backend_errors = registry.counter('rate_limit_backend_errors_total', 'Rate limit checks failed by the backend',
+                                  ('scope',))
+
+#  обрыв соединения, ответ с ошибкой и таймаут
+BACKEND_ERRORS = (OSError, asyncio.IncompleteReadError)
+
+
+class Rate:
+    __slots__ = ('limit', 'period')
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+
+    @classmethod
+    def parse(cls, value: str | None) -> 'Rate | None':
+        """Формат "<количество>/<секунды>", пустое значение отключает лимит"""
+        if not value:
+            return None
+        limit, period = value.split('/')
+        return cls(int(limit), float(period))
+
+
+class MemoryBackend:
+    """Token bucket в памяти процесса, у каждого воркера свои счетчики.
+
+    Не больше max_keys корзин: при переполнении вытесняется та, к которой дольше всего не обращались.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, list] = OrderedDict()
+
+    async def hit(self, key: str, rate: Rate) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+            #  корзина хранит свой лимит, ключи разных лимитов не пересекаются
+            bucket = self._buckets[key] = [float(rate.limit), now, rate]
+        else:
+            self._buckets.move_to_end(key)
+        tokens, updated, rate = bucket
+        refill = rate.limit / rate.period
+        tokens = min(rate.limit, tokens + (now - updated) * refill)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return (1 - tokens) / refill
+        bucket[0] = tokens - 1
+        return 0.0
+
+
+class RedisBackend:
+    """Скользящее окно по двум соседним счетчикам, общий для всех воркеров.
+
+    Использует только INCR/EXPIRE/GET, поэтому подходит любой сервер с протоколом Redis.
+    """
+
+    def __init__(self, url: str, prefix: str = 'ratelimit', timeout: float = 0.1):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.password = parsed.password
+        self.prefix = prefix
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(parts)
+
+    async def _read_reply(self):
+        line = (await self._reader.readline()).rstrip(b'\r\n')
+        kind, payload = line[:1], line[1:]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise ConnectionError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if kind == b'*':
+            return [await self._read_reply() for _ in range(int(payload))]
+        raise ConnectionError(f'Unexpected reply {line!r}')
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        commands = []
+        if self.password:
+            commands.append(('AUTH', self.password))
+        if self.db:
+            commands.append(('SELECT', self.db))
+        if commands:
+            await self._pipeline(commands)
+
+    async def _pipeline(self, commands: list[tuple]) -> list:
+        self._writer.write(b''.join(self._encode(*command) for command in commands))
+        await self._writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    async def execute(self, commands: list[tuple]) -> list:
+        """Таймаут считается вместе с ожиданием соединения, по истечении поднимается TimeoutError"""
+        async with asyncio.timeout(self.timeout), self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                return await self._pipeline(commands)
+            except BaseException:
+                #  и при отмене по таймауту: непрочитанные ответы сбили бы следующий конвейер
+                if self._writer is not None:
+                    self._writer.close()
+                self._reader = self._writer = None
+                raise
+
+    async def hit(self, key: str, rate: Rate) -> float:
+        now = time.time()
+        window = int(now // rate.period)
+        elapsed = now / rate.period - window
+        current_key = f'{self.prefix}:{key}:{window}'
+        current, _, previous = await self.execute([
+            ('INCR', current_key),
+            ('EXPIRE', current_key, math.ceil(rate.period * 2)),
+            ('GET', f'{self.prefix}:{key}:{window - 1}'),
+        ])
+        estimated = int(previous or 0) * (1 - elapsed) + current
+        if estimated <= rate.limit:
+            return 0.0
+        return (1 - elapsed) * rate.period
+
+
+def create_backend(url: str):
+    if url.startswith('redis://'):
+        return RedisBackend(url, timeout=settings.RATE_LIMIT_BACKEND_TIMEOUT)
+    return MemoryBackend()
+
+
+backend = create_backend(settings.RATE_LIMIT_BACKEND)
+
+
+def client_ip(request: Request) -> str:
+    if settings.RATE_LIMIT_TRUST_PROXY and 'x-real-ip' in request.headers:
+        return request.headers['x-real-ip']
+    return request.client.host if request.client else 'unknown'
+
+
+async def ip_key(request: Request) -> str:
+    return client_ip(request)
+
+
+async def user_key(request: Request) -> str:
+    if 'authenticated' in request.auth.scopes:
+        return f'user:{request.user.id}'
+    return f'ip:{client_ip(request)}'
+
+
+async def login_account_key(request: Request) -> str:
+    form = await request.form()
+    return str(form.get('username', '')).strip().lower()
+
+
+class RateLimit:
+    """Зависимость маршрута: отклоняет запрос с 429 до обращения к базе и хеширования паролей"""
+
+    def __init__(self, scope: str, rate: str | None, key: Callable[[Request], Awaitable[str]]):
+        self.scope = scope
+        self.rate = Rate.parse(rate)
+        self.key = key
+        self.rejections = rejections.labels(scope)
+        self.backend_errors = backend_errors.labels(scope)
+
+    async def __call__(self, request: Request) -> None:
+        if self.rate is None:
+            return
+        key = f'{self.scope}:{await self.key(request)}'
+        try:
+            retry_after = await backend.hit(key, self.rate)
+        except BACKEND_ERRORS as error:
+            self.backend_errors.inc()
+            logger.warning('Rate limit backend failed for %s: %r', self.scope, error)
+            if settings.RATE_LIMIT_FAIL_OPEN:
+                return
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Rate limiter is unavailable')
+        if retry_after:
+            self.rejections.inc()
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='Too many requests',
+                                headers={'Retry-After': str(math.ceil(retry_after))})
+
+
+login_ip_limit = RateLimit('login_ip', settings.LOGIN_RATE_LIMIT_PER_IP, ip_key)
+login_account_limit = RateLimit('login_account', settings.LOGIN_RATE_LIMIT_PER_ACCOUNT, login_account_key)
+create_post_limit = RateLimit('create_post', settings.CREATE_POST_RATE_LIMIT, user_key)
+create_comment_limit = RateLimit('create_comment', settings.CREATE_COMMENT_RATE_LIMIT, user_key)
+like_limit = RateLimit('like', settings.LIKE_RATE_LIMIT, user_key)
@@ -0,0 +1,44 @@
+import logging
+import os
+import tempfile
+import time
+
+import uvicorn
+
+import settings
+from metrics import clear_snapshots
+
+logger = logging.getLogger('server')
+
+
+def workers_count() -> int:
+    if settings.WEB_CONCURRENCY:
+        return settings.WEB_CONCURRENCY
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+def main():
+    os.environ.setdefault('SERVER_STARTED_AT', str(time.time()))
+    workers = workers_count()
+    if workers > 1 and not settings.RATE_LIMIT_BACKEND.startswith('redis://'):
+        logger.warning('Rate limits are counted per worker by the memory backend: with %d workers each limit '
+                       'is %d times higher, set RATE_LIMIT_BACKEND=redis://...', workers, workers)
+    if settings.METRICS_DIR:
+        #  снимки прошлого запуска иначе сложились бы с новыми счетчиками
+        clear_snapshots(settings.METRICS_DIR)
+    elif workers > 1:
+        #  запросы /metrics попадают в случайный воркер, поэтому каждый отдает сумму снимков всех воркеров
+        os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='metrics-')
+    uvicorn.run('main:app',
+                host=settings.SERVER_HOST,
+                port=settings.SERVER_PORT,
+                workers=workers,
+                loop='uvloop',
+                http='httptools',
+                lifespan='on',
+                proxy_headers=True,
+                timeout_graceful_shutdown=int(settings.SHUTDOWN_TIMEOUT))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,3 +14,120 @@ ACCESS_TOKEN_EXPIRE_MINUTES = os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES')
 ALGORITHM_TOKEN = os.environ.get('ALGORITHM_TOKEN')
 
 DATABASE_URL = f'postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}'
+
+SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', 10))
+SQL_N_PLUS_ONE_RAISE = os.environ.get('SQL_N_PLUS_ONE_RAISE', 'false').lower() == 'true'
+
+SQL_ECHO = os.environ.get('SQL_ECHO', 'false').lower() == 'true'
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+SLOW_QUERY_LOG_PATH = os.environ.get('SLOW_QUERY_LOG_PATH', 'slow_queries.log')
+SLOW_QUERY_LOG_MAX_BYTES = int(os.environ.get('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024))
+SLOW_QUERY_LOG_BACKUPS = int(os.environ.get('SLOW_QUERY_LOG_BACKUPS', 5))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', 30))
+#  EXPLAIN ANALYZE повторяет медленный запрос: не дольше стольких его длительностей и не дольше максимума в секундах
+SLOW_QUERY_EXPLAIN_TIMEOUT_FACTOR = float(os.environ.get('SLOW_QUERY_EXPLAIN_TIMEOUT_FACTOR', 2))
+SLOW_QUERY_EXPLAIN_MAX_TIMEOUT = float(os.environ.get('SLOW_QUERY_EXPLAIN_MAX_TIMEOUT', 5))
+
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN')
+
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_TRUST_PROXY = os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false').lower() == 'true'
+RATE_LIMIT_BACKEND_TIMEOUT = float(os.environ.get('RATE_LIMIT_BACKEND_TIMEOUT', 0.1))
+#  при недоступном бэкенде пропускать запросы без проверки, иначе отвечать 503
+RATE_LIMIT_FAIL_OPEN = os.environ.get('RATE_LIMIT_FAIL_OPEN', 'true').lower() == 'true'
+LOGIN_RATE_LIMIT_PER_IP = os.environ.get('LOGIN_RATE_LIMIT_PER_IP', '30/60')
+LOGIN_RATE_LIMIT_PER_ACCOUNT = os.environ.get('LOGIN_RATE_LIMIT_PER_ACCOUNT', '5/60')
+CREATE_POST_RATE_LIMIT = os.environ.get('CREATE_POST_RATE_LIMIT', '10/60')
+CREATE_COMMENT_RATE_LIMIT = os.environ.get('CREATE_COMMENT_RATE_LIMIT', '30/60')
+LIKE_RATE_LIMIT = os.environ.get('LIKE_RATE_LIMIT', '60/60')
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 8000))
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 0))
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', 30))
+#  каталог снимков метрик воркеров, из которых /metrics собирает общие значения; server.py при нескольких
+#  воркерах создает свой на каждый запуск. Пусто - /metrics отдает метрики только своего процесса
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_SNAPSHOT_INTERVAL = float(os.environ.get('METRICS_SNAPSHOT_INTERVAL', 2))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_HEALTH_TIMEOUT = float(os.environ.get('DB_HEALTH_TIMEOUT', 2))
+SQL_COMPILED_CACHE_SIZE = int(os.environ.get('SQL_COMPILED_CACHE_SIZE', 1000))
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_PREPARED_STATEMENT_CACHE_SIZE', 500))
+
+USERS_COUNT_STRATEGY = os.environ.get('USERS_COUNT_STRATEGY', 'cached')
+BLOGS_COUNT_STRATEGY = os.environ.get('BLOGS_COUNT_STRATEGY', 'estimate')
+POSTS_COUNT_STRATEGY = os.environ.get('POSTS_COUNT_STRATEGY', 'estimate')
+COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', 30))
+COUNT_ESTIMATE_EXACT_BELOW = int(os.environ.get('COUNT_ESTIMATE_EXACT_BELOW', 1000))
+
+STATS_RECONCILE_INTERVAL = float(os.environ.get('STATS_RECONCILE_INTERVAL', 3600))
+STATS_RECONCILE_BATCH = int(os.environ.get('STATS_RECONCILE_BATCH', 1000))
+
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+EVENTS_RECONNECT_DELAY = float(os.environ.get('EVENTS_RECONNECT_DELAY', 1))
+#  проверка LISTEN-соединения: без нее соединение, оборванное без RST (NAT, балансировщик), молча не получает событий
+EVENTS_KEEPALIVE_INTERVAL = float(os.environ.get('EVENTS_KEEPALIVE_INTERVAL', 30))
+EVENTS_KEEPALIVE_TIMEOUT = float(os.environ.get('EVENTS_KEEPALIVE_TIMEOUT', 5))
+
+UNIQUE_VIEWS_PRECISION = int(os.environ.get('UNIQUE_VIEWS_PRECISION', 12))
+UNIQUE_VIEWS_FLUSH_INTERVAL = float(os.environ.get('UNIQUE_VIEWS_FLUSH_INTERVAL', 10))
+UNIQUE_VIEWS_MAX_PENDING = int(os.environ.get('UNIQUE_VIEWS_MAX_PENDING', 2000))
+
+DELETION_JOBS_PER_WORKER = int(os.environ.get('DELETION_JOBS_PER_WORKER', 2))
+DELETION_BATCH_SIZE = int(os.environ.get('DELETION_BATCH_SIZE', 1000))
+DELETION_BATCH_PAUSE = float(os.environ.get('DELETION_BATCH_PAUSE', 0.05))
+DELETION_JOB_STALE_AFTER = float(os.environ.get('DELETION_JOB_STALE_AFTER', 60))
+
+#  каждый допущенный запрос держит соединение пула: общий лимит воркера по умолчанию равен пулу движка,
+#  чтобы допущенные запросы не ждали соединения без дедлайна очереди
+ADMISSION_TOTAL_CONCURRENCY = int(os.environ.get('ADMISSION_TOTAL_CONCURRENCY', DB_POOL_SIZE + DB_MAX_OVERFLOW))
+ADMISSION_CONCURRENCY = int(os.environ.get('ADMISSION_CONCURRENCY', ADMISSION_TOTAL_CONCURRENCY))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 128))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 0.5))
+ADMISSION_STANDING_QUEUE = float(os.environ.get('ADMISSION_STANDING_QUEUE', 2))
+ADMISSION_RETRY_AFTER = float(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+ADMISSION_ROUTE_LIMITS = os.environ.get('ADMISSION_ROUTE_LIMITS', '/login:16:10')
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 10))
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_THREAD_THRESHOLD = int(os.environ.get('COMPRESSION_THREAD_THRESHOLD', 64 * 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', 3))
+
+RELATED_INDEX_DIR = os.environ.get('RELATED_INDEX_DIR', 'related_index')
+RELATED_FEATURE_BITS = int(os.environ.get('RELATED_FEATURE_BITS', 20))
+RELATED_TITLE_WEIGHT = int(os.environ.get('RELATED_TITLE_WEIGHT', 3))
+RELATED_MAX_DF = float(os.environ.get('RELATED_MAX_DF', 0.02))
+RELATED_NEIGHBOURS = int(os.environ.get('RELATED_NEIGHBOURS', 50))
+RELATED_QUERY_TERMS = int(os.environ.get('RELATED_QUERY_TERMS', 32))
+RELATED_BUILD_BATCH = int(os.environ.get('RELATED_BUILD_BATCH', 1024))
+RELATED_MAX_LIMIT = int(os.environ.get('RELATED_MAX_LIMIT', 20))
+RELATED_RELOAD_INTERVAL = float(os.environ.get('RELATED_RELOAD_INTERVAL', 60))
+
+ENGAGEMENT_FLUSH_INTERVAL = float(os.environ.get('ENGAGEMENT_FLUSH_INTERVAL', 10))
+ENGAGEMENT_MAX_PENDING = int(os.environ.get('ENGAGEMENT_MAX_PENDING', 5000))
+ANALYTICS_DEFAULT_DAYS = int(os.environ.get('ANALYTICS_DEFAULT_DAYS', 30))
+ANALYTICS_MAX_HOURLY_DAYS = int(os.environ.get('ANALYTICS_MAX_HOURLY_DAYS', 31))
+
+PARTITIONS_AHEAD = int(os.environ.get('PARTITIONS_AHEAD', 3))
+PARTITION_MAINTENANCE_INTERVAL = float(os.environ.get('PARTITION_MAINTENANCE_INTERVAL', 3600))
+PARTITION_LOCK_TIMEOUT = float(os.environ.get('PARTITION_LOCK_TIMEOUT', 2))
+PARTITION_MIGRATION_BATCH = int(os.environ.get('PARTITION_MIGRATION_BATCH', 5000))
+PARTITION_MIGRATION_PAUSE = float(os.environ.get('PARTITION_MIGRATION_PAUSE', 0.05))
+
+SHARD_DATABASE_URLS = os.environ.get('SHARD_DATABASE_URLS', '')
+SHARD_VIRTUAL_NODES = int(os.environ.get('SHARD_VIRTUAL_NODES', 64))
+SHARD_LOCATION_CACHE_SIZE = int(os.environ.get('SHARD_LOCATION_CACHE_SIZE', 100_000))
+SHARD_MISSING_CACHE_TTL = float(os.environ.get('SHARD_MISSING_CACHE_TTL', 5))
+SHARD_MAX_MERGE_OFFSET = int(os.environ.get('SHARD_MAX_MERGE_OFFSET', 10_000))
+SHARD_USERS_FLUSH_INTERVAL = float(os.environ.get('SHARD_USERS_FLUSH_INTERVAL', 5))
+SHARD_USERS_RESYNC_INTERVAL = float(os.environ.get('SHARD_USERS_RESYNC_INTERVAL', 3600))
+
+AUTOCOMPLETE_INDEX_DIR = os.environ.get('AUTOCOMPLETE_INDEX_DIR', 'autocomplete_index')
+AUTOCOMPLETE_REBUILD_INTERVAL = float(os.environ.get('AUTOCOMPLETE_REBUILD_INTERVAL', 3600))
+AUTOCOMPLETE_RELOAD_INTERVAL = float(os.environ.get('AUTOCOMPLETE_RELOAD_INTERVAL', 10))
+AUTOCOMPLETE_BUILD_BATCH = int(os.environ.get('AUTOCOMPLETE_BUILD_BATCH', 10_000))
+AUTOCOMPLETE_MAX_LIMIT = int(os.environ.get('AUTOCOMPLETE_MAX_LIMIT', 20))
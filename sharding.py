@@ -0,0 +1,381 @@
+"""Размещение данных по шардам.
+
+Блог, его посты, комментарии, лайки, авторы, счетчики, аналитика и задачи удаления живут на одном шарде
+из SHARD_DATABASE_URLS, выбранном по blog_id на кольце согласованного хеширования (SHARD_VIRTUAL_NODES
+точек на шард): при добавлении шарда на него переезжает около 1/N блогов, а не почти все, как при остатке
+от деления. Схема на всех шардах одна, миграции применяются к каждому:
+
+    alembic -x shard=<имя> upgrade heads
+
+Пользователи хранятся в глобальной базе DATABASE_URL и копируются на шард при первой записи, которая
+на них ссылается, поэтому внешние ключи и соединения с users внутри шарда работают как раньше.
+Изменения пользователей доходят до копий через user_replicas, полная сверка и доли шардов на кольце:
+
+    python -m sharding sync-users
+    python -m sharding ring --add <имя>
+
+id постов, комментариев и задач удаления - UUIDv8 с токеном блога в первых 4 байтах, по нему запрос
+сразу идет на нужный шард. id, созданные до шардирования (UUIDv4), ищутся на всех шардах.
+
+Уникальные индексы названий блогов и постов работают только в пределах шарда, поэтому названия
+записываются еще и в таблицу titles глобальной базы. Названия, созданные на шардах до ее появления:
+
+    python -m sharding sync-titles
+
+Ограничения: транзакция запроса на нескольких базах не атомарна (см. database.unit_of_work),
+перенос блогов при изменении состава кольца - отдельная операция.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import time
+from typing import Iterable
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import settings
+from database import SHARDED, engine, async_session, shard_engines, shard_sessionmakers, shard_session, on_commit, \
+    dispose_engines
+from metrics import registry
+
+logger = logging.getLogger('sharding')
+
+TOKEN_SPACE = 1 << 32
+#  таблицы, строки которых ищутся по id без токена
+LOCATABLE = ('posts', 'comments', 'deletion_jobs')
+
+
+def _token(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=4).digest(), 'big')
+
+
+def blog_token(blog_id: UUID) -> int:
+    return _token(blog_id.bytes)
+
+
+def child_id(blog_id: UUID) -> UUID:
+    """Новый id сущности блога: UUIDv8 с токеном блога в первых 4 байтах"""
+    value = bytearray(blog_token(blog_id).to_bytes(4, 'big') + os.urandom(12))
+    value[6] = value[6] & 0x0F | 0x80
+    value[8] = value[8] & 0x3F | 0x80
+    return UUID(bytes=bytes(value))
+
+
+def id_token(entity_id: UUID) -> int | None:
+    return int.from_bytes(entity_id.bytes[:4], 'big') if entity_id.version == 8 else None
+
+
+class ShardMap:
+    """Кольцо согласованного хеширования: токен принадлежит шарду первой точки не меньше него"""
+
+    def __init__(self, shards: Iterable[str], virtual_nodes: int):
+        points = sorted((_token(f'{shard}#{node}'.encode()), shard)
+                        for shard in shards for node in range(virtual_nodes))
+        self._tokens = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, token: int) -> str:
+        return self._shards[bisect.bisect_left(self._tokens, token) % len(self._shards)]
+
+    def _segments(self, other: 'ShardMap') -> Iterable[tuple[int, str, str]]:
+        """Отрезки кольца, на которых владельцы в обоих кольцах не меняются: длина и оба владельца"""
+        points = sorted(set(self._tokens) | set(other._tokens))
+        previous = points[-1] - TOKEN_SPACE
+        for point in points:
+            yield point - previous, self.shard(point), other.shard(point)
+            previous = point
+
+    def shares(self) -> dict[str, float]:
+        shares = dict.fromkeys(self._shards, 0.0)
+        for length, shard, _ in self._segments(self):
+            shares[shard] += length / TOKEN_SPACE
+        return shares
+
+    def moved_share(self, other: 'ShardMap') -> float:
+        """Доля блогов, которые сменят шард при переходе на кольцо other"""
+        return sum(length for length, shard, new in self._segments(other) if shard != new) / TOKEN_SPACE
+
+
+shard_map = ShardMap(shard_engines, settings.SHARD_VIRTUAL_NODES)
+
+
+def blog_shard(blog_id: UUID) -> str:
+    return shard_map.shard(blog_token(blog_id))
+
+
+_LOCATE = {table: text(f'SELECT id FROM {table} WHERE id = ANY(:ids)') for table in LOCATABLE}
+#  шарды найденных id без токена: сущности между шардами не переезжают
+_located: dict[UUID, str] = {}
+#  id без токена, не найденные ни на одном шарде, до истечения срока: повторы не опрашивают все шарды
+_missing: dict[tuple[str, UUID], float] = {}
+
+
+async def _find(shard: str, table: str, entity_ids: list[UUID]) -> list[UUID]:
+    async with shard_engines[shard].connect() as connection:
+        return list((await connection.execute(_LOCATE[table], {'ids': entity_ids})).scalars())
+
+
+async def locate_many(table: str, entity_ids: Iterable[UUID]) -> dict[str, list[UUID]]:
+    """id по шардам: по токену в id, id без токена ищутся одним запросом на шард, ненайденные отбрасываются
+    и SHARD_MISSING_CACHE_TTL секунд не ищутся снова"""
+    if len(shard_engines) == 1:
+        entity_ids = list(entity_ids)
+        return {next(iter(shard_engines)): entity_ids} if entity_ids else {}
+    groups = {shard: [] for shard in shard_engines}
+    unknown = []
+    now = time.monotonic()
+    for entity_id in entity_ids:
+        token = id_token(entity_id)
+        shard = shard_map.shard(token) if token is not None else _located.get(entity_id)
+        if shard is not None:
+            groups[shard].append(entity_id)
+        elif _missing.get((table, entity_id), 0) <= now:
+            unknown.append(entity_id)
+    if unknown:
+        found = await asyncio.gather(*(_find(shard, table, unknown) for shard in groups))
+        for (shard, ids), found_ids in zip(groups.items(), found):
+            ids.extend(found_ids)
+            if len(_located) + len(found_ids) >= settings.SHARD_LOCATION_CACHE_SIZE:
+                _located.clear()
+            _located.update(dict.fromkeys(found_ids, shard))
+        missing = set(unknown).difference(*found)
+        if len(_missing) + len(missing) >= settings.SHARD_LOCATION_CACHE_SIZE:
+            _missing.clear()
+        _missing.update(dict.fromkeys(((table, entity_id) for entity_id in missing),
+                                      now + settings.SHARD_MISSING_CACHE_TTL))
+    return {shard: ids for shard, ids in groups.items() if ids}
+
+
+async def locate(table: str, entity_id: UUID) -> str | None:
+    """Шард сущности по id, None - ее нет ни на одном шарде"""
+    return next(iter(await locate_many(table, (entity_id, ))), None)
+
+
+async def blog_session(session: AsyncSession, blog_id: UUID) -> AsyncSession:
+    return await shard_session(session, blog_shard(blog_id))
+
+
+async def entity_session(session: AsyncSession, table: str, entity_id: UUID) -> AsyncSession | None:
+    shard = await locate(table, entity_id)
+    return None if shard is None else await shard_session(session, shard)
+
+
+_USER = text('SELECT id, name, email, is_active FROM users WHERE id = :id')
+#  пароль на шарды не копируется, вход проверяется только по глобальной базе
+_INSERT_REPLICA = text("INSERT INTO users (id, name, email, password, is_active) "
+                       "VALUES (:id, :name, :email, '', :is_active) ON CONFLICT DO NOTHING")
+_replicated: set[tuple[str, UUID]] = set()
+
+
+def _remember_replica(shard: str, user_id: UUID) -> None:
+    if len(_replicated) >= settings.SHARD_LOCATION_CACHE_SIZE:
+        _replicated.clear()
+    _replicated.add((shard, user_id))
+
+
+async def ensure_user(session: AsyncSession, target: AsyncSession, user_id: UUID) -> bool:
+    """Копия пользователя на шарде target до записи, которая на него ссылается.
+    False - пользователя нет в глобальной базе"""
+    if target is session:
+        return True
+    shard = target.info['shard']
+    if (shard, user_id) in _replicated:
+        return True
+    row = (await session.execute(_USER, {'id': user_id})).first()
+    if row is None:
+        return False
+    await target.execute(_INSERT_REPLICA, row._asdict())
+    on_commit(session, lambda: _remember_replica(shard, user_id))
+    return True
+
+
+#  при занятом названии возвращает id его владельца, строку держит блокировка до конца транзакции
+_CLAIM_TITLE = text('''
+INSERT INTO titles (kind, title, entity_id, blog_id) VALUES (:kind, :title, :id, :blog_id)
+ON CONFLICT (kind, title) DO UPDATE SET entity_id = titles.entity_id
+RETURNING entity_id
+''')
+_RELEASE_PREVIOUS_TITLES = text('DELETE FROM titles WHERE kind = :kind AND entity_id = :id AND title <> :title')
+
+
+async def claim_title(session: AsyncSession, kind: str, entity_id: UUID, blog_id: UUID, title: str) -> bool:
+    """Название блога или поста за сущностью в глобальной базе, прежнее освобождается.
+    False - название у другой сущности. Без шардов уникальность держат индексы самих таблиц"""
+    if not SHARDED:
+        return True
+    params = {'kind': kind, 'title': title, 'id': entity_id, 'blog_id': blog_id}
+    if (await session.execute(_CLAIM_TITLE, params)).scalar() != entity_id:
+        return False
+    await session.execute(_RELEASE_PREVIOUS_TITLES, params)
+    return True
+
+
+_SHARD_TITLES = {
+    'blogs': text('SELECT id, id AS blog_id, title FROM blogs WHERE id > :after ORDER BY id LIMIT :batch'),
+    'posts': text('SELECT id, blog_id, title FROM posts WHERE id > :after ORDER BY id LIMIT :batch'),
+}
+_INSERT_TITLES = text('''
+INSERT INTO titles (kind, title, entity_id, blog_id)
+SELECT :kind, * FROM unnest(CAST(:titles AS varchar[]), CAST(:ids AS uuid[]), CAST(:blog_ids AS uuid[]))
+ON CONFLICT DO NOTHING
+''')
+
+
+async def sync_titles(batch: int = 5000) -> int:
+    """Названия со всех шардов в titles глобальной базы, при совпадении остается записанное раньше"""
+    inserted = 0
+    for sessionmaker in shard_sessionmakers.values():
+        for kind, statement in _SHARD_TITLES.items():
+            after = UUID(int=0)
+            while True:
+                async with sessionmaker() as session:
+                    rows = (await session.execute(statement, {'after': after, 'batch': batch})).all()
+                if not rows:
+                    break
+                params = {'kind': kind, 'titles': [row.title for row in rows], 'ids': [row.id for row in rows],
+                          'blog_ids': [row.blog_id for row in rows]}
+                async with async_session() as session:
+                    async with session.begin():
+                        inserted += (await session.execute(_INSERT_TITLES, params)).rowcount
+                after = rows[-1].id
+    return inserted
+
+
+_USERS = text('SELECT id, name, email, is_active FROM users WHERE id = ANY(:ids)')
+_USERS_AFTER = text('SELECT id, name, email, is_active FROM users WHERE id > :after ORDER BY id LIMIT :batch')
+#  обновляются только существующие копии: пользователь попадает на шард с первой записью
+_UPDATE_REPLICAS = text('''
+UPDATE users SET name = v.name, email = v.email, is_active = v.is_active
+FROM unnest(CAST(:ids AS uuid[]), CAST(:names AS varchar[]), CAST(:emails AS varchar[]), CAST(:active AS boolean[]))
+     AS v(id, name, email, is_active)
+WHERE users.id = v.id AND (users.name, users.email, users.is_active) IS DISTINCT FROM (v.name, v.email, v.is_active)
+''')
+_SYNC_LOCK = "hashtext('user_replicas_sync')"
+
+
+async def _update_replicas(rows) -> int:
+    params = {'ids': [row.id for row in rows], 'names': [row.name for row in rows],
+              'emails': [row.email for row in rows], 'active': [bool(row.is_active) for row in rows]}
+    updated = 0
+    for sessionmaker in shard_sessionmakers.values():
+        async with sessionmaker() as session:
+            async with session.begin():
+                updated += (await session.execute(_UPDATE_REPLICAS, params)).rowcount
+    return updated
+
+
+class UserReplicas:
+    """Пользователи, измененные в глобальной базе с последнего сброса. При сбросе их текущие строки
+    переписываются в копии на всех шардах, при ошибке id возвращаются в очередь"""
+
+    def __init__(self):
+        self._pending: set[UUID] = set()
+
+    def record(self, user_id: UUID) -> None:
+        if SHARDED:
+            self._pending.add(user_id)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def flush(self) -> int:
+        pending, self._pending = self._pending, set()
+        if not pending:
+            return 0
+        try:
+            async with async_session() as session:
+                rows = (await session.execute(_USERS, {'ids': list(pending)})).all()
+            return await _update_replicas(rows)
+        except Exception:
+            self._pending |= pending
+            raise
+
+
+user_replicas = UserReplicas()
+registry.gauge_callback('user_replicas_pending', 'Users changed since the last copy to the shards',
+                        user_replicas.pending_count)
+
+
+async def sync_users(batch: int = 5000) -> int:
+    """Сверка всех копий с глобальной базой, на случай потерянного буфера упавшего воркера"""
+    updated, after = 0, UUID(int=0)
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(_USERS_AFTER, {'after': after, 'batch': batch})).all()
+        if not rows:
+            return updated
+        updated += await _update_replicas(rows)
+        after = rows[-1].id
+
+
+async def _sync_users_once() -> int | None:
+    """Полная сверка из одного воркера: остальные пропускают проход, пока держится блокировка"""
+    async with engine.connect() as connection:
+        if not (await connection.execute(text(f'SELECT pg_try_advisory_lock({_SYNC_LOCK})'))).scalar():
+            return None
+        await connection.commit()
+        try:
+            return await sync_users()
+        finally:
+            await connection.execute(text(f'SELECT pg_advisory_unlock({_SYNC_LOCK})'))
+            await connection.commit()
+
+
+async def replicate_users_periodically() -> None:
+    if not SHARDED:
+        return
+    next_sync = time.monotonic() + settings.SHARD_USERS_RESYNC_INTERVAL
+    try:
+        while True:
+            await asyncio.sleep(settings.SHARD_USERS_FLUSH_INTERVAL)
+            try:
+                await user_replicas.flush()
+                if time.monotonic() >= next_sync:
+                    next_sync = time.monotonic() + settings.SHARD_USERS_RESYNC_INTERVAL
+                    updated = await _sync_users_once()
+                    if updated:
+                        logger.warning('User sync repaired %d replica rows', updated)
+            except Exception:
+                logger.exception('User replication failed')
+    finally:
+        #  при остановке воркера отправляем накопленное
+        await user_replicas.flush()
+
+
+def print_ring(added: list[str]) -> None:
+    for shard, share in sorted(shard_map.shares().items()):
+        print(f'{shard:<16}{share:>8.1%}')
+    if added:
+        grown = ShardMap([*shard_engines, *added], settings.SHARD_VIRTUAL_NODES)
+        print(f'adding {", ".join(added)} moves {shard_map.moved_share(grown):.1%} of blogs')
+
+
+async def main(arguments: argparse.Namespace) -> None:
+    try:
+        if arguments.command == 'sync-titles':
+            inserted = await sync_titles()
+            print(f'{inserted} titles copied to the global database')
+        else:
+            updated = await sync_users()
+            print(f'{updated} replica rows updated on {len(shard_engines)} shards')
+    finally:
+        await dispose_engines()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Blog-sharded data placement')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('sync-users', help='copy current user rows from the global database to every shard')
+    commands.add_parser('sync-titles', help='copy blog and post titles from every shard to the global database')
+    ring = commands.add_parser('ring', help='show the share of blogs per shard')
+    ring.add_argument('--add', action='append', default=[], metavar='SHARD', help='show how many blogs would move')
+    arguments = parser.parse_args()
+    if arguments.command == 'ring':
+        print_ring(arguments.add)
+    else:
+        asyncio.run(main(arguments))
@@ -0,0 +1,59 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from metrics import registry
+
+T = TypeVar('T')
+
+requests_total = registry.counter('singleflight_requests_total',
+                                  'Reads that started a fetch (leader) or joined one already in flight (follower)',
+                                  ('flight', 'role'))
+
+
+class Flight(Generic[T]):
+    __slots__ = ('task', 'followers')
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.followers = 0
+
+    async def wait(self) -> T:
+        #  отмена одного ожидающего запроса не должна отменять загрузку для остальных
+        return await asyncio.shield(self.task)
+
+
+class SingleFlight:
+    """Одновременные одинаковые чтения в воркере выполняются один раз и получают общий результат.
+
+    Запись удаляется сразу после завершения загрузки, поэтому запрос, пришедший позже, всегда
+    читает заново - результат не кешируется. Загрузка выполняется в отдельной задаче и не должна
+    зависеть от сессии запроса, который ее начал.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: dict[Hashable, Flight] = {}
+
+    def join(self, key: Hashable, fetch: Callable[[], Awaitable[T]]) -> tuple[Flight[T], bool]:
+        """Возвращает загрузку по ключу и True, если ее начал этот вызов"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            requests_total.labels(self.name, 'follower').inc()
+            return flight, False
+        flight = Flight(asyncio.get_running_loop().create_task(fetch(), name=f'singleflight-{self.name}'))
+        self._flights[key] = flight
+        flight.task.add_done_callback(lambda task: self._finish(key, flight))
+        requests_total.labels(self.name, 'leader').inc()
+        return flight, True
+
+    async def do(self, key: Hashable, fetch: Callable[[], Awaitable[T]]) -> T:
+        flight, _ = self.join(key, fetch)
+        return await flight.wait()
+
+    def _finish(self, key: Hashable, flight: Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        #  все ожидающие могли быть отменены, ошибка не должна остаться непрочитанной
+        if not flight.task.cancelled():
+            flight.task.exception()
@@ -0,0 +1,140 @@
+import asyncio
+import datetime
+import json
+import logging
+import re
+import sys
+import time
+from contextvars import ContextVar, Context
+from logging.handlers import RotatingFileHandler
+
+from greenlet import getcurrent
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import settings
+from admission import QUERY_CANCELED
+
+_explaining: ContextVar[bool] = ContextVar('slow_query_explaining', default=False)
+#  блокировки строк и функции, действие которых откат транзакции не отменяет или которые ждут чужих транзакций
+_UNSAFE_TO_ANALYZE = re.compile(r'\bFOR\s+(NO\s+KEY\s+|KEY\s+)?(UPDATE|SHARE)\b'
+                                r'|pg_(try_)?advisory|pg_notify|nextval|setval', re.IGNORECASE)
+
+
+def _analyzable(statement: str) -> bool:
+    """EXPLAIN ANALYZE выполняет запрос: только простые SELECT, остальные получают план без выполнения"""
+    return statement.lstrip().upper().startswith('SELECT') and not _UNSAFE_TO_ANALYZE.search(statement)
+
+
+def _find_caller(filename_suffix: str) -> str | None:
+    """Ищет вызов из менеджера и в родительских greenlet, т.к. SQLAlchemy выполняет запрос в отдельном greenlet"""
+    frame, greenlet = sys._getframe(), getcurrent()
+    while True:
+        while frame is not None:
+            if frame.f_code.co_filename.endswith(filename_suffix):
+                return frame.f_code.co_qualname
+            frame = frame.f_back
+        greenlet = greenlet.parent
+        if greenlet is None:
+            return None
+        frame = greenlet.gr_frame
+
+
+class SlowQueryLog:
+
+    def __init__(self, path: str, threshold_ms: float, explain_interval: float, explain_timeout_factor: float,
+                 explain_max_timeout: float, max_bytes: int, backup_count: int):
+        self.path = path
+        self.threshold = threshold_ms / 1000
+        self.explain_interval = explain_interval
+        self.explain_timeout_factor = explain_timeout_factor
+        self.explain_max_timeout = explain_max_timeout
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.engines = {}
+        self._logger = None
+        self._next_explain_at = 0.0
+        self._tasks = set()
+
+    @property
+    def logger(self) -> logging.Logger:
+        if self._logger is None:
+            self._logger = logging.getLogger('sql.slow')
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                                        backupCount=self.backup_count))
+        return self._logger
+
+    def bind(self, engine: AsyncEngine) -> None:
+        #  план снимается в той же базе, где выполнялся запрос: у каждого шарда свой движок
+        self.engines[engine.sync_engine] = engine
+
+    def observe(self, statement: str, parameters, elapsed: float, scope: dict | None, source=None) -> None:
+        if elapsed < self.threshold or _explaining.get():
+            return
+
+        endpoint = scope.get('endpoint') if scope else None
+        record = {
+            'at': datetime.datetime.now().isoformat(),
+            'duration_ms': round(elapsed * 1000, 2),
+            'statement': statement,
+            'parameters': [type(value).__name__ for value in parameters or ()],
+            'handler': f'{endpoint.__module__}.{endpoint.__qualname__}' if endpoint else None,
+            'manager': _find_caller('api/managers.py'),
+        }
+
+        now = time.monotonic()
+        engine = self.engines.get(source)
+        if engine is None or now < self._next_explain_at:
+            self.write(record)
+            return
+        self._next_explain_at = now + self.explain_interval
+        task = asyncio.get_running_loop().create_task(
+            self.explain_and_write(engine, record, statement, parameters, elapsed), context=Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def explain_and_write(self, engine: AsyncEngine, record: dict, statement: str, parameters,
+                                elapsed: float) -> None:
+        _explaining.set(True)
+        #  задача идет вне запроса и без его дедлайна: время повтора ограничивается здесь
+        timeout_ms = max(int(min(elapsed * self.explain_timeout_factor, self.explain_max_timeout) * 1000), 1)
+        analyze = _analyzable(statement)
+        try:
+            try:
+                record['plan'] = await self._explain(engine, statement, parameters, analyze, timeout_ms)
+            except DBAPIError as error:
+                if not analyze or getattr(error.orig, 'sqlstate', None) != QUERY_CANCELED:
+                    raise
+                #  план без выполнения, чтобы запись все равно объясняла запрос
+                record['analyze_timeout_ms'] = timeout_ms
+                record['plan'] = await self._explain(engine, statement, parameters, False, timeout_ms)
+        except Exception as error:
+            record['plan_error'] = repr(error)
+        self.write(record)
+
+    @staticmethod
+    async def _explain(engine: AsyncEngine, statement: str, parameters, analyze: bool, timeout_ms: int) -> list[str]:
+        options = '(ANALYZE, BUFFERS)' if analyze else ''
+        async with engine.connect() as connection:
+            #  только чтение и откат: запись, пропущенная проверкой выше, завершится ошибкой, а не выполнится
+            await connection.execution_options(postgresql_readonly=True)
+            async with connection.begin() as transaction:
+                await connection.exec_driver_sql(f'SET LOCAL statement_timeout = {timeout_ms}')
+                result = await connection.exec_driver_sql(f'EXPLAIN {options} {statement}', tuple(parameters or ()))
+                plan = [row[0] for row in result]
+                await transaction.rollback()
+                return plan
+
+    def write(self, record: dict) -> None:
+        self.logger.info(json.dumps(record, default=str))
+
+
+slow_query_log = SlowQueryLog(path=settings.SLOW_QUERY_LOG_PATH,
+                              threshold_ms=settings.SLOW_QUERY_THRESHOLD_MS,
+                              explain_interval=settings.SLOW_QUERY_EXPLAIN_INTERVAL,
+                              explain_timeout_factor=settings.SLOW_QUERY_EXPLAIN_TIMEOUT_FACTOR,
+                              explain_max_timeout=settings.SLOW_QUERY_EXPLAIN_MAX_TIMEOUT,
+                              max_bytes=settings.SLOW_QUERY_LOG_MAX_BYTES,
+                              backup_count=settings.SLOW_QUERY_LOG_BACKUPS)